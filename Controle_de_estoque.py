@@ -1,9 +1,22 @@
 import streamlit as st
 import pandas as pd
 import plotly.graph_objects as go
-import os
 from datetime import datetime
-from fpdf import FPDF
+
+from agregados import carregar_agregados
+from armazenamento import DB_FILE, inicializar, load_data, inserir_medicao, periodo_aberto
+from calculos import calcular, peso_teorico
+from calibracao import carregar_calibracao
+from consultas import TAMANHOS_PAGINA, Selecao, indice_medicoes, pagina, total_paginas
+from graficos import figura_especie
+from importacao import importar_lote
+from instrumentacao import (ARQUIVO_METRICAS, etapa, finalizar_execucao, historico, iniciar_execucao, nivel_atual,
+                            texto_prometheus, totais)
+from versoes_parametros import carregar_tabela
+from particoes import historico_desde
+from patios import caminho_patio, estoque_consolidado, listar_patios, resumo_patios
+from relatorios import obter_tarefa, solicitar_relatorio
+from series_pilhas import prever_estoque, projecao_estoque, series_pilhas
 
 # Tenta importar extras para visual bonito
 try:
@@ -14,161 +27,27 @@ except ImportError:
     USE_EXTRAS = False
 
 # ==============================================================================
-# 1. PARÂMETROS DE ENGENHARIA
-# ==============================================================================
-
-DENSIDADE_MENSAL = {
-    1: {'Pinus': 580, 'Eucalipto': 820},
-    2: {'Pinus': 580, 'Eucalipto': 820},
-    3: {'Pinus': 560, 'Eucalipto': 790},
-    4: {'Pinus': 540, 'Eucalipto': 760},
-    5: {'Pinus': 520, 'Eucalipto': 740},
-    6: {'Pinus': 500, 'Eucalipto': 720},
-    7: {'Pinus': 500, 'Eucalipto': 710},
-    8: {'Pinus': 490, 'Eucalipto': 700},
-    9: {'Pinus': 510, 'Eucalipto': 730},
-    10: {'Pinus': 530, 'Eucalipto': 760},
-    11: {'Pinus': 550, 'Eucalipto': 780},
-    12: {'Pinus': 570, 'Eucalipto': 800},
-}
-
-FATOR_ARRUMADO = {
-    'Pinus': 0.65,
-    'Eucalipto': 0.60
-}
-
-DB_FILE = 'estoque_arauco_final.json'
-
-
-# ==============================================================================
-# 2. GERAÇÃO DE PDF (COM LOGOTIPO)
-# ==============================================================================
-
-class PDFReport(FPDF):
-    def header(self):
-        # Verifica se o arquivo existe para não dar erro se faltar a imagem
-        if os.path.exists('Arauco.jpg'):
-            # Logo Esquerda
-            self.image('Arauco.jpg', 10, 8, 30)
-            # Logo Direita
-            self.image('Arauco.jpg', 255, 8, 30)
-
-        self.set_font('Helvetica', 'B', 14)
-        self.cell(0, 10, 'Relatorio de Controle de Estoque - Arauco', 0, 1, 'C')
-        self.set_font('Helvetica', 'I', 10)
-        self.cell(0, 5, f'Gerado em: {datetime.now().strftime("%d/%m/%Y %H:%M")}', 0, 1, 'C')
-        self.ln(15)
-
-    def footer(self):
-        self.set_y(-15)
-        self.set_font('Helvetica', 'I', 8)
-        self.cell(0, 10, f'Pagina {self.page_no()}', 0, 0, 'C')
-
-
-def criar_pdf(df_dados):
-    pdf = PDFReport(orientation='L', unit='mm', format='A4')
-    pdf.add_page()
-
-    # 1. Sumário
-    pdf.set_font('Helvetica', 'B', 12)
-    pdf.cell(0, 10, '1. Resumo Executivo', 0, 1, 'L')
-
-    total_vol = df_dados['Volume_Drone_Estereo'].sum()
-    total_peso = df_dados['Peso_Teorico_Ton'].sum()
-
-    df_pinus = df_dados[(df_dados['Tipo_Madeira'] == 'Pinus') & (df_dados['Peso_Tickets_Ton'] > 0)]
-    df_euca = df_dados[(df_dados['Tipo_Madeira'] == 'Eucalipto') & (df_dados['Peso_Tickets_Ton'] > 0)]
-
-    erro_pinus = df_pinus['Erro_Percentual'].abs().mean() if not df_pinus.empty else 0
-    erro_euca = df_euca['Erro_Percentual'].abs().mean() if not df_euca.empty else 0
-
-    pdf.set_font('Helvetica', '', 10)
-    pdf.cell(80, 8, f"Volume Total: {total_vol:,.0f} m3", 0, 0)
-    pdf.cell(80, 8, f"Estoque Total: {total_peso:,.0f} Ton", 0, 1)
-
-    pdf.set_text_color(34, 139, 34)
-    pdf.cell(80, 8, f"Erro Medio PINUS: {erro_pinus:.2f}%", 0, 0)
-    pdf.set_text_color(0, 0, 139)
-    pdf.cell(80, 8, f"Erro Medio EUCALIPTO: {erro_euca:.2f}%", 0, 1)
-
-    pdf.set_text_color(0, 0, 0)
-    pdf.ln(5)
-
-    # 2. Tabela
-    pdf.set_font('Helvetica', 'B', 12)
-    pdf.cell(0, 10, '2. Detalhamento', 0, 1, 'L')
-
-    widths = [25, 25, 25, 30, 20, 30, 30, 25, 25]
-    headers = ['Data', 'Pilha', 'Tipo', 'Vol (m3)', 'Dens', 'Est.(t)', 'Real(t)', 'Erro %', 'Var %']
-
-    pdf.set_font('Helvetica', 'B', 9)
-    pdf.set_fill_color(230, 230, 230)
-
-    for i, h in enumerate(headers):
-        pdf.cell(widths[i], 8, h, 1, 0, 'C', True)
-    pdf.ln()
-
-    pdf.set_font('Helvetica', '', 9)
-    for index, row in df_dados.iterrows():
-        dat = row['Data'].strftime('%d/%m/%Y')
-        peso_real = f"{row['Peso_Tickets_Ton']:.0f}" if row['Peso_Tickets_Ton'] > 0 else "-"
-        erro_txt = f"{row['Erro_Percentual']:+.1f}%" if row['Peso_Tickets_Ton'] > 0 else "-"
-        var_txt = f"{row['Var_Anterior_Pct']:.1f}%"
-
-        data_row = [
-            dat, str(row['Pilha_ID']), str(row['Tipo_Madeira']),
-            f"{row['Volume_Drone_Estereo']:.0f}", f"{row['Densidade_Aplicada']:.0f}",
-            f"{row['Peso_Teorico_Ton']:.0f}", peso_real, erro_txt, var_txt
-        ]
-
-        for i, datum in enumerate(data_row):
-            pdf.cell(widths[i], 7, datum, 1, 0, 'C')
-        pdf.ln()
-
-    return pdf.output(dest='S').encode('latin-1', 'replace')
-
-
-# ==============================================================================
-# 3. FUNÇÕES DE DADOS
+# 1. FUNÇÕES DE DADOS
 # ==============================================================================
 
-def get_empty_df():
-    return pd.DataFrame(columns=[
-        'Data', 'Pilha_ID', 'Tipo_Madeira',
-        'Volume_Drone_Estereo', 'Densidade_Aplicada', 'Fator_Teorico',
-        'Peso_Teorico_Ton', 'Peso_Tickets_Ton',
-        'Fator_Conversao_Real', 'Erro_Ton', 'Erro_Percentual'
-    ])
-
-
-def load_data():
-    if os.path.exists(DB_FILE):
-        try:
-            df = pd.read_json(DB_FILE, orient='records')
-            if df.empty or 'Data' not in df.columns:
-                return get_empty_df()
-            return df
-        except ValueError:
-            return get_empty_df()
-    else:
-        return get_empty_df()
-
-
-def save_data(df):
+def registrar_medicao(medicao, caminho):
     try:
-        df.to_json(DB_FILE, orient='records', date_format='iso')
+        inserir_medicao(medicao, caminho)
         return True
     except Exception as e:
-        st.error(f"Erro ao salvar arquivo: {e}")
+        st.error(f"Erro ao salvar medição: {e}")
         return False
 
 
 # ==============================================================================
-# 4. INTERFACE
+# 2. INTERFACE
 # ==============================================================================
 
 st.set_page_config(page_title="Gestão de Pátio Arauco", layout="wide")
 
+# Medição das etapas desta execução (ESTOQUE_PERF ou ?perf=1 / ?perf=memoria)
+iniciar_execucao('dashboard', st.query_params.get('perf'))
+
 st.markdown("""
 <style>
     .stMetric { background-color: #f9f9f9; border: 1px solid #e0e0e0; padding: 10px; border-radius: 5px; }
@@ -183,7 +62,24 @@ if 'msg_sucesso' in st.session_state:
 
 st.title("🌲 Controle de Estoque: Drone vs Balança")
 
-df = load_data()
+# Um banco por pátio (patios.py); sem pátios criados, o banco da pasta atual
+patios = listar_patios()
+if patios:
+    patio_url = st.query_params.get('patio')
+    patio = st.sidebar.selectbox("Pátio", patios, index=patios.index(patio_url) if patio_url in patios else 0,
+                                 key='patio')
+    caminho = caminho_patio(patio)
+else:
+    caminho = DB_FILE
+
+inicializar(caminho)
+aberto_desde = periodo_aberto(caminho)
+with etapa('carregar_historico'):
+    df = load_data(caminho)
+    # Meses arquivados só entram quando o filtro de período começa antes do corte
+    periodo_filtro = st.session_state.get('filtro_periodo') or ()
+    if aberto_desde is not None and periodo_filtro and pd.Timestamp(periodo_filtro[0]) < aberto_desde:
+        df = historico_desde(periodo_filtro[0], caminho)
 
 # --- SIDEBAR ---
 st.sidebar.header("Nova Medição")
@@ -192,7 +88,8 @@ st.sidebar.header("Nova Medição")
 def atualizar_densidade():
     mes = st.session_state.data_input.month
     madeira = st.session_state.madeira_input
-    st.session_state.densidade_input = float(DENSIDADE_MENSAL[mes][madeira])
+    _, densidades, _ = carregar_tabela(caminho).vigente(st.session_state.data_input)
+    st.session_state.densidade_input = densidades[mes][madeira]
 
 
 if 'densidade_input' not in st.session_state:
@@ -224,23 +121,27 @@ st.sidebar.markdown("---")
 vol_drone = st.sidebar.number_input("Volume Drone (m³)", min_value=0.0, step=10.0)
 peso_tickets = st.sidebar.number_input("Peso Balança (Ton)", min_value=0.0, step=10.0)
 
+# Estimativa corrigida pelo histórico de tickets do mesmo mês e espécie
+if vol_drone > 0:
+    _, _, fatores_vigentes = carregar_tabela(caminho).vigente(data_medicao)
+    estimado = peso_teorico(vol_drone, fatores_vigentes[tipo_madeira], densidade_final)
+    k, erro_k, n_tickets, origem = carregar_calibracao(caminho).grupo(data_medicao.month, tipo_madeira)
+    if origem == 'padrão':
+        st.sidebar.info(f"Estimativa: {estimado:,.1f} t (tickets insuficientes para calibrar)")
+    else:
+        st.sidebar.info(f"Estimativa: {estimado:,.1f} t · calibrada: **{estimado * k:,.1f} t**  \n"
+                        f"k = {k:.3f} ± {erro_k:.3f} ({n_tickets} tickets, ajuste por {origem})")
+
 if st.sidebar.button("💾 REGISTRAR MEDIÇÃO", type="primary"):
     if not pilha_id:
         st.sidebar.error("⚠️ Digite o ID da Pilha.")
     elif vol_drone <= 0:
         st.sidebar.error("⚠️ O Volume deve ser maior que zero.")
     else:
-        fator_teorico = FATOR_ARRUMADO[tipo_madeira]
-        peso_teorico = (vol_drone * fator_teorico * densidade_final) / 1000
-
-        if peso_tickets > 0:
-            fator_conversao_real = peso_tickets / vol_drone
-            erro_ton = peso_teorico - peso_tickets
-            erro_pct = (erro_ton / peso_tickets) * 100
-        else:
-            fator_conversao_real = 0
-            erro_ton = 0
-            erro_pct = 0
+        versao, densidades, fatores = carregar_tabela(caminho).vigente(data_medicao)
+        fator_teorico = fatores[tipo_madeira]
+        densidade_manual = editar_densidade and densidade_final != densidades[data_medicao.month][tipo_madeira]
+        resultado = calcular(vol_drone, fator_teorico, densidade_final, peso_tickets)
 
         nova_medicao = {
             'Data': pd.to_datetime(data_medicao),
@@ -249,71 +150,105 @@ if st.sidebar.button("💾 REGISTRAR MEDIÇÃO", type="primary"):
             'Volume_Drone_Estereo': vol_drone,
             'Densidade_Aplicada': densidade_final,
             'Fator_Teorico': fator_teorico,
-            'Peso_Teorico_Ton': round(peso_teorico, 2),
             'Peso_Tickets_Ton': peso_tickets,
-            'Fator_Conversao_Real': round(fator_conversao_real, 4) if peso_tickets > 0 else 0,
-            'Erro_Ton': round(erro_ton, 2),
-            'Erro_Percentual': round(erro_pct, 2)
+            **{coluna: float(valores[0]) for coluna, valores in resultado.items()},
+            'Versao_Parametros': versao,
+            'Densidade_Manual': densidade_manual
         }
 
-        df = pd.concat([df, pd.DataFrame([nova_medicao])], ignore_index=True)
-
-        if save_data(df):
-            if 'df_selecao' in st.session_state:
-                del st.session_state['df_selecao']
+        if registrar_medicao(nova_medicao, caminho):
             st.session_state['msg_sucesso'] = f"Pilha {pilha_id} registrada com sucesso!"
             st.rerun()
 
+st.sidebar.markdown("---")
+with st.sidebar.expander("📦 Importação em Lote"):
+    arquivo_drone = st.file_uploader("Levantamento do Drone (CSV/Excel)", type=['csv', 'xlsx', 'xls'])
+    arquivo_tickets = st.file_uploader("Tickets da Balança (opcional)", type=['csv', 'xlsx', 'xls'])
+
+    if st.button("📥 IMPORTAR LOTE", disabled=arquivo_drone is None, use_container_width=True):
+        try:
+            gravadas, erros_importacao = importar_lote(arquivo_drone, arquivo_tickets, caminho)
+        except Exception as e:
+            st.error(f"Erro ao importar lote: {e}")
+        else:
+            st.session_state['erros_importacao'] = erros_importacao
+            st.session_state['msg_sucesso'] = f"{gravadas} medições importadas com sucesso!"
+            st.rerun()
+
+    erros_importacao = st.session_state.get('erros_importacao')
+    if erros_importacao is not None and not erros_importacao.empty:
+        st.warning(f"⚠️ {len(erros_importacao)} linhas rejeitadas na última importação.")
+        st.dataframe(erros_importacao, hide_index=True, use_container_width=True)
+        st.download_button("Baixar relatório de erros", erros_importacao.to_csv(index=False).encode('utf-8'),
+                           'erros_importacao.csv', 'text/csv', use_container_width=True)
+
 # --- ÁREA PRINCIPAL ---
 
-tab_dash, tab_manual = st.tabs(["📊 Dashboard & Relatórios", "📘 Manual Metodológico"])
+abas = ["📊 Dashboard & Relatórios", "📘 Manual Metodológico"]
+consolidado = len(patios) > 1
+abas_opcionais = (["🏭 Consolidado"] if consolidado else []) + (["⏱️ Desempenho"] if nivel_atual() else [])
+tab_dash, tab_manual, *tab_desempenho = st.tabs(abas + abas_opcionais)
+tab_consolidado = tab_desempenho.pop(0) if consolidado else None
 
 # ==============================================================================
 # ABA 1: DASHBOARD
 # ==============================================================================
 with tab_dash:
     if not df.empty:
-        df['Data'] = pd.to_datetime(df['Data'])
-        df = df.sort_values(by=['Pilha_ID', 'Data'])
-        df['Var_Anterior_Ton'] = df.groupby('Pilha_ID')['Peso_Teorico_Ton'].diff().fillna(0)
-        df['Var_Anterior_Pct'] = (df.groupby('Pilha_ID')['Peso_Teorico_Ton'].pct_change() * 100).fillna(0)
-
-        df_display = df.sort_values(by=['Data', 'Pilha_ID'], ascending=[False, True]).copy()
-
-        if 'Selecionar' not in df_display.columns:
-            df_display.insert(0, "Selecionar", False)
+        with etapa('indice'):
+            indice = indice_medicoes(df)
 
         st.subheader("📑 Relatório Gerencial")
 
-        if 'df_selecao' not in st.session_state:
-            st.session_state.df_selecao = df_display
+        # A sessão guarda só filtros e a seleção (mapa de bits por id); o
+        # histórico é o mesmo objeto, somente leitura, para todas as sessões
+        if 'selecao' not in st.session_state:
+            st.session_state.selecao = Selecao()
+            st.session_state.versao_selecao = 0
+        # Os ids são de cada banco: trocar de pátio limpa a seleção
+        if st.session_state.get('banco_selecao', caminho) != caminho:
+            st.session_state.selecao = Selecao()
+            st.session_state.versao_selecao += 1
+        st.session_state.banco_selecao = caminho
+
+        with st.expander("🔎 Filtros"):
+            f1, f2, f3, f4 = st.columns(4)
+            periodo = f1.date_input("Período", value=(), format="DD/MM/YYYY", key='filtro_periodo')
+            especies = f2.multiselect("Espécie", list(indice.especies), key='filtro_especies')
+            prefixo = f3.text_input("Pilha (início do ID)", key='filtro_pilha').strip()
+            ticket = f4.selectbox("Ticket", ["Todos", "Com ticket", "Sem ticket"], key='filtro_ticket')
+            if aberto_desde is not None:
+                st.caption(f"Meses antes de {aberto_desde:%m/%Y} estão arquivados e só entram na tabela quando o "
+                           f"período começa antes disso; indicadores e gráficos do pátio já os incluem.")
+
+        filtros = {
+            'data_inicio': periodo[0] if len(periodo) > 0 else None,
+            'data_fim': periodo[1] if len(periodo) > 1 else None,
+            'especies': especies or None,
+            'prefixo_pilha': prefixo,
+            'com_ticket': {"Com ticket": True, "Sem ticket": False}.get(ticket),
+        }
+        with etapa('filtro'):
+            ids_filtrados = indice.filtrar(**filtros)
+
+        def alterar_selecao(ids):
+            # Ações em massa recriam o editor para descartar as edições da página
+            st.session_state.selecao = Selecao(ids)
+            st.session_state.versao_selecao += 1
 
         c1, c2, c3, c4 = st.columns(4)
         if c1.button("✅ Selecionar Todos"):
-            st.session_state.df_selecao['Selecionar'] = True
+            alterar_selecao(ids_filtrados)
         if c2.button("🌲 Todos Pinus"):
-            st.session_state.df_selecao['Selecionar'] = st.session_state.df_selecao['Tipo_Madeira'] == 'Pinus'
+            alterar_selecao(indice.filtrar(**{**filtros, 'especies': ['Pinus']}))
         if c3.button("🌿 Todos Eucalipto"):
-            st.session_state.df_selecao['Selecionar'] = st.session_state.df_selecao['Tipo_Madeira'] == 'Eucalipto'
+            alterar_selecao(indice.filtrar(**{**filtros, 'especies': ['Eucalipto']}))
         if c4.button("❌ Limpar"):
-            st.session_state.df_selecao['Selecionar'] = False
-
-        selecionados = st.session_state.df_selecao[st.session_state.df_selecao['Selecionar'] == True]
-
-        if not selecionados.empty:
-            k1, k2, k3 = st.columns(3)
-            vol_total = selecionados['Volume_Drone_Estereo'].sum()
-            peso_total = selecionados['Peso_Teorico_Ton'].sum()
+            alterar_selecao(())
 
-            com_ticket = selecionados[selecionados['Peso_Tickets_Ton'] > 0]
-            erro_medio = com_ticket['Erro_Percentual'].abs().mean() if not com_ticket.empty else 0
-
-            k1.metric("Volume Selecionado", f"{vol_total:,.0f} m³")
-            k2.metric("Peso Estimado", f"{peso_total:,.0f} ton")
-            k3.metric("Acuracidade Média", f"{erro_medio:.2f}%", delta_color="inverse")
-
-            if USE_EXTRAS:
-                style_metric_cards(border_left_color="#1E90FF")
+        # Os indicadores dependem das marcações feitas na página, que só são
+        # conhecidas depois do editor
+        painel_indicadores = st.container()
 
         column_config = {
             "Selecionar": st.column_config.CheckboxColumn("Sel.", width="small"),
@@ -334,79 +269,171 @@ with tab_dash:
             'Fator_Conversao_Real'
         ]
 
-        try:
-            st_data = st.data_editor(
-                st.session_state.df_selecao[cols_view],
-                column_config=column_config,
-                hide_index=True,
-                use_container_width=True,
-                height=400,
-                disabled=['Data', 'Pilha_ID', 'Tipo_Madeira', 'Volume_Drone_Estereo', 'Peso_Teorico_Ton',
-                          'Peso_Tickets_Ton', 'Erro_Percentual', 'Var_Anterior_Pct', 'Densidade_Aplicada',
-                          'Fator_Conversao_Real']
-            )
-        except Exception:
-            st_data = st.data_editor(st.session_state.df_selecao[cols_view])
-
-        selecionados_final = st_data[st_data['Selecionar'] == True].copy()
+        # Só a página atual é enviada ao navegador
+        p1, p2, p3 = st.columns([1, 1, 2])
+        tamanho_pagina = p1.selectbox("Linhas por página", TAMANHOS_PAGINA, index=1, key='tamanho_pagina')
+        numero_pagina = p2.number_input("Página", min_value=1, max_value=total_paginas(ids_filtrados, tamanho_pagina),
+                                        value=1, step=1)
+        df_pagina = pagina(df, ids_filtrados, numero_pagina, tamanho_pagina)[cols_view[1:]]
+        ids_pagina = df_pagina.index.to_numpy()
+        df_pagina.insert(0, 'Selecionar', st.session_state.selecao.contem(ids_pagina))
+        chave_editor = f"editor_{st.session_state.versao_selecao}_{hash((str(filtros), numero_pagina, tamanho_pagina))}"
+
+        # Serialização da página para o navegador
+        with etapa('data_editor'):
+            try:
+                st_data = st.data_editor(
+                    df_pagina,
+                    column_config=column_config,
+                    hide_index=True,
+                    use_container_width=True,
+                    height=400,
+                    disabled=['Data', 'Pilha_ID', 'Tipo_Madeira', 'Volume_Drone_Estereo', 'Peso_Teorico_Ton',
+                              'Peso_Tickets_Ton', 'Erro_Percentual', 'Var_Anterior_Pct', 'Densidade_Aplicada',
+                              'Fator_Conversao_Real'],
+                    key=chave_editor
+                )
+            except Exception:
+                st_data = st.data_editor(df_pagina, key=chave_editor)
+
+        with etapa('selecao'):
+            marcados_pagina = st_data['Selecionar'].to_numpy(dtype=bool)
+            st.session_state.selecao.desmarcar(ids_pagina[~marcados_pagina])
+            st.session_state.selecao.marcar(ids_pagina[marcados_pagina])
+            ids_selecionados = indice.ids[st.session_state.selecao.contem(indice.ids)]
+            selecionados_final = df.loc[ids_selecionados, cols_view[1:]]
+            selecionados_final.insert(0, 'Selecionar', True)
+        p3.caption(f"{len(ids_filtrados):,} medições no filtro · {len(ids_selecionados):,} selecionadas")
 
         if not selecionados_final.empty:
-            selecionados_final['Label'] = selecionados_final['Data'].dt.strftime('%d/%m') + " - " + selecionados_final[
-                'Pilha_ID']
+            with painel_indicadores:
+                k1, k2, k3 = st.columns(3)
+                vol_total = selecionados_final['Volume_Drone_Estereo'].sum()
+                peso_total = selecionados_final['Peso_Teorico_Ton'].sum()
 
-            df_pinus = selecionados_final[selecionados_final['Tipo_Madeira'] == 'Pinus']
-            df_euca = selecionados_final[selecionados_final['Tipo_Madeira'] == 'Eucalipto']
+                com_ticket = selecionados_final[selecionados_final['Peso_Tickets_Ton'] > 0]
+                erro_medio = com_ticket['Erro_Percentual'].abs().mean() if not com_ticket.empty else 0
 
+                k1.metric("Volume Selecionado", f"{vol_total:,.0f} m³")
+                k2.metric("Peso Estimado", f"{peso_total:,.0f} ton")
+                k3.metric("Acuracidade Média", f"{erro_medio:.2f}%", delta_color="inverse")
+
+                if USE_EXTRAS:
+                    style_metric_cards(border_left_color="#1E90FF")
+
+        if not selecionados_final.empty:
             st.markdown("### 📊 Análise Visual")
 
-            if not df_pinus.empty:
-                st.markdown("#### 🌲 PINUS")
-                fig_p = go.Figure()
-                fig_p.add_trace(go.Bar(
-                    x=df_pinus['Label'], y=df_pinus['Peso_Teorico_Ton'],
-                    name='Drone (Est.)', marker_color='#228B22',
-                    text=df_pinus['Peso_Teorico_Ton'].apply(lambda x: f'{x:.0f}'), textposition='auto'
-                ))
-                fig_p.add_trace(go.Bar(
-                    x=df_pinus['Label'], y=df_pinus['Peso_Tickets_Ton'],
-                    name='Balança (Real)', marker_color='#90EE90',
-                    text=df_pinus['Peso_Tickets_Ton'].apply(lambda x: f'{x:.0f}' if x > 0 else ''), textposition='auto'
-                ))
-                fig_p.update_layout(barmode='group', height=250, margin=dict(t=10, b=10))
-                st.plotly_chart(fig_p, use_container_width=True)
-
-            if not df_euca.empty:
-                st.markdown("#### 🌿 EUCALIPTO")
-                fig_e = go.Figure()
-                fig_e.add_trace(go.Bar(
-                    x=df_euca['Label'], y=df_euca['Peso_Teorico_Ton'],
-                    name='Drone (Est.)', marker_color='#1E90FF',
-                    text=df_euca['Peso_Teorico_Ton'].apply(lambda x: f'{x:.0f}'), textposition='auto'
-                ))
-                fig_e.add_trace(go.Bar(
-                    x=df_euca['Label'], y=df_euca['Peso_Tickets_Ton'],
-                    name='Balança (Real)', marker_color='#87CEFA',
-                    text=df_euca['Peso_Tickets_Ton'].apply(lambda x: f'{x:.0f}' if x > 0 else ''), textposition='auto'
-                ))
-                fig_e.update_layout(barmode='group', height=250, margin=dict(t=10, b=10))
-                st.plotly_chart(fig_e, use_container_width=True)
+            # Acima do limite as barras são somadas por pilha ou semana; figuras
+            # iguais são reaproveitadas entre reexecuções
+            for especie, titulo in [('Pinus', "#### 🌲 PINUS"), ('Eucalipto', "#### 🌿 EUCALIPTO")]:
+                df_especie = selecionados_final[selecionados_final['Tipo_Madeira'] == especie]
+                if not df_especie.empty:
+                    st.markdown(titulo)
+                    with etapa('grafico_especie'):
+                        st.plotly_chart(figura_especie(df_especie, especie), use_container_width=True)
+
+        # Indicadores do pátio para o filtro atual e séries mensais, lidos dos
+        # agregados materializados (não dependem do tamanho do histórico)
+        st.markdown("### 📈 Pátio no Filtro")
+        with etapa('agregados'):
+            agregados = carregar_agregados(caminho)
+            resumo = agregados.indicadores(
+                especies=filtros['especies'],
+                mes_inicio=filtros['data_inicio'].strftime('%Y-%m') if filtros['data_inicio'] else None,
+                mes_fim=filtros['data_fim'].strftime('%Y-%m') if filtros['data_fim'] else None,
+                prefixo_pilha=prefixo, com_ticket=filtros['com_ticket'])
+        a1, a2, a3, a4 = st.columns(4)
+        a1.metric("Medições", f"{resumo['medicoes']:,}")
+        a2.metric("Volume Medido", f"{resumo['volume']:,.0f} m³")
+        a3.metric("Peso Estimado", f"{resumo['peso']:,.0f} ton")
+        a4.metric("Erro Médio (c/ ticket)", f"{resumo['erro_medio']:.2f}%")
+        if filtros['data_inicio']:
+            st.caption("Período considerado em meses completos.")
+
+        with etapa('graficos_patio'):
+            g1, g2 = st.columns(2)
+            fig_estoque = go.Figure()
+            for especie, serie in agregados.serie_estoque('M').items():
+                fig_estoque.add_trace(go.Scatter(x=serie.index, y=serie.to_numpy(), name=especie,
+                                                 mode='lines+markers'))
+            fig_estoque.update_layout(title="Estoque estimado (t, fim do mês)", height=280, margin=dict(t=40, b=10))
+            g1.plotly_chart(fig_estoque, use_container_width=True)
+
+            fig_erro = go.Figure()
+            for especie, serie in agregados.serie_erro_medio('M').items():
+                fig_erro.add_trace(go.Scatter(x=serie.index, y=serie.to_numpy(), name=especie, mode='lines+markers'))
+            fig_erro.update_layout(title="Erro médio absoluto mensal (%)", height=280, margin=dict(t=40, b=10))
+            g2.plotly_chart(fig_erro, use_container_width=True)
+
+        # Projeção por pilha a partir da última leitura: secagem sazonal da
+        # densidade e tendência do fator real ajustada aos tickets
+        with st.expander("🔮 Projeção do Estoque"):
+            meses_projecao = st.slider("Horizonte (meses)", 1, 12, 6, key='horizonte_projecao')
+            with etapa('projecao'):
+                series = series_pilhas(df)
+                datas_projecao = pd.date_range(pd.Timestamp.now().normalize(), periods=meses_projecao + 1, freq='ME')
+                estoque_projetado = projecao_estoque(series, datas_projecao)
+                por_pilha = prever_estoque(series, datas_projecao[-1])
+            fig_projecao = go.Figure()
+            for especie, serie in estoque_projetado.items():
+                fig_projecao.add_trace(go.Scatter(x=serie.index, y=serie.to_numpy(), name=especie,
+                                                  mode='lines+markers'))
+            fig_projecao.update_layout(title="Estoque projetado (t, fim do mês)", height=280, margin=dict(t=40, b=10))
+            st.plotly_chart(fig_projecao, use_container_width=True)
+
+            if filtros['especies']:
+                por_pilha = por_pilha[por_pilha['Tipo_Madeira'].isin(filtros['especies'])]
+            if prefixo:
+                por_pilha = por_pilha[por_pilha.index.str.startswith(prefixo)]
+            st.caption(f"{len(por_pilha):,} pilhas no filtro, projetadas para "
+                       f"{datas_projecao[-1].strftime('%d/%m/%Y')}")
+            st.dataframe(por_pilha, use_container_width=True, height=300, column_config={
+                'Ultima_Leitura': st.column_config.DateColumn("Última leitura", format="DD/MM/YYYY"),
+                'Volume_Drone_Estereo': st.column_config.NumberColumn("Vol(m³)", format="%.0f"),
+                'Peso_Atual_Ton': st.column_config.NumberColumn("Atual(t)", format="%.0f"),
+                'Densidade_Projetada': st.column_config.NumberColumn("Dens. proj.", format="%.0f"),
+                'Fator_Real_Projetado': st.column_config.NumberColumn("Fator real proj.", format="%.4f"),
+                'Tendencia_Fator_Dia': st.column_config.NumberColumn("Tendência/dia", format="%.6f"),
+                'Peso_Projetado_Ton': st.column_config.NumberColumn("Projetado(t)", format="%.0f"),
+            })
 
         st.markdown("---")
         st.subheader("📥 Exportar Relatório")
 
-        col_csv, col_pdf = st.columns(2)
-
         if not selecionados_final.empty:
-            with col_csv:
-                csv_data = selecionados_final.to_csv(index=False).encode('utf-8')
-                st.download_button("📄 Baixar CSV (Excel)", csv_data, 'relatorio_patio.csv', 'text/csv',
-                                   use_container_width=True)
-
-            with col_pdf:
-                pdf_bytes = criar_pdf(selecionados_final)
-                st.download_button("🖨️ Baixar PDF (Oficial)", pdf_bytes,
-                                   f'Relatorio_Arauco_{datetime.now().strftime("%Y%m%d")}.pdf', 'application/pdf',
-                                   type="primary", use_container_width=True)
+            exportacoes = [
+                ('csv', "📄 Baixar CSV (Excel)", 'relatorio_patio.csv', 'text/csv'),
+                ('pdf', "🖨️ Baixar PDF (Oficial)", f'Relatorio_Arauco_{datetime.now().strftime("%Y%m%d")}.pdf',
+                 'application/pdf'),
+            ]
+            with etapa('exportacao'):
+                tarefas = {formato: obter_tarefa(selecionados_final, formato) for formato, *_ in exportacoes}
+            em_andamento = any(t is not None and not t.concluida for t in tarefas.values())
+
+            # Enquanto algum relatório estiver sendo gerado, só este trecho é
+            # reexecutado periodicamente para mostrar o progresso
+            @st.fragment(run_every=1 if em_andamento else None)
+            def painel_exportacao():
+                for coluna, (formato, rotulo, nome_arquivo, mime) in zip(st.columns(2), exportacoes):
+                    with coluna:
+                        tarefa = obter_tarefa(selecionados_final, formato)
+                        if tarefa is None or tarefa.erro is not None:
+                            if tarefa is not None:
+                                st.error(f"Erro ao gerar relatório: {tarefa.erro}")
+                            if st.button(f"⚙️ Gerar {formato.upper()}", key=f'gerar_{formato}',
+                                         use_container_width=True):
+                                solicitar_relatorio(selecionados_final, formato)
+                                st.rerun()
+                        elif not tarefa.concluida:
+                            st.progress(tarefa.progresso, text=f"Gerando {formato.upper()}...")
+                        else:
+                            with open(tarefa.arquivo, 'rb') as arquivo:
+                                st.download_button(rotulo, arquivo, nome_arquivo, mime,
+                                                   type="primary" if formato == 'pdf' else "secondary",
+                                                   use_container_width=True)
+
+            painel_exportacao()
         else:
             st.info("Selecione itens na tabela acima para liberar o download.")
     else:
@@ -467,6 +494,9 @@ with tab_manual:
     # 3. TABELAS DE REFERÊNCIA
     st.subheader("3. Parâmetros de Engenharia (Ponta Grossa/PR)")
 
+    versao_vigente, DENSIDADE_MENSAL, FATOR_ARRUMADO = carregar_tabela(caminho).vigente(datetime.now())
+    st.caption(f"Versão {versao_vigente} dos parâmetros, vigente hoje.")
+
     st.markdown(r"#### 📅 Tabela de Densidade Sazonal ($\rho_{mes}$)")
     st.markdown(r"Valores em $kg/m^3$ considerando a variação de umidade relativa e chuvas na região.")
 
@@ -481,6 +511,14 @@ with tab_manual:
     col_f2.metric("Eucalipto (Arrumado)", f"{FATOR_ARRUMADO['Eucalipto']}",
                   help="Toras mais irregulares, maior volume de vazios.")
 
+    st.markdown(r"#### 🎯 Fatores de Correção Calibrados pelos Tickets ($k$)")
+    st.markdown(r"Ajuste por mínimos quadrados das medições com ticket, por espécie e mês: "
+                r"$M_{balanca} \approx k \cdot M_{ton}$. Grupos com poucos tickets usam o fator da espécie "
+                r"em todos os meses; sem tickets, $k = 1$.")
+    df_calibracao = carregar_calibracao(caminho).tabela().pivot(index='Mês', columns='Tipo_Madeira',
+                                                         values='Fator_Correcao')[list(FATOR_ARRUMADO)]
+    st.dataframe(df_calibracao.style.format('{:.3f}'), use_container_width=True)
+
     st.markdown("---")
 
     # 4. DETALHAMENTO: FATOR DE CONVERSÃO REAL (NOVO)
@@ -509,3 +547,81 @@ with tab_manual:
     5.  **COTEC (Comissão Técnica de Florestas).** *Tabelas de Sazonalidade de Umidade para a Região dos Campos Gerais*.
     6.  **WOLF, A. et al.** *Accuracy of Volume Measurement of Wood Piles Using UAV Photogrammetry*. Remote Sensing, 2018. (Base para a metodologia do Drone).
     """)
+
+# ==============================================================================
+# ABA 3: VISÃO CONSOLIDADA (SÓ COM MAIS DE UM PÁTIO)
+# ==============================================================================
+if tab_consolidado is not None:
+    with tab_consolidado:
+        st.header("🏭 Visão Consolidada dos Pátios")
+        st.caption(f"{len(patios)} pátios, lidos em paralelo dos agregados de cada um (inclui os meses arquivados).")
+        with etapa('consolidado'):
+            resumo_geral = resumo_patios(patios)
+            estoque_geral = estoque_consolidado(patios)
+
+        st.dataframe(resumo_geral, use_container_width=True, column_config={
+            'medicoes': st.column_config.NumberColumn("Medições", format="%d"),
+            'volume': st.column_config.NumberColumn("Volume (m³)", format="%.0f"),
+            'peso': st.column_config.NumberColumn("Peso estimado (t)", format="%.0f"),
+            'tickets': st.column_config.NumberColumn("Balança (t)", format="%.0f"),
+            'erro_medio': st.column_config.NumberColumn("Erro médio (%)", format="%.2f"),
+        })
+        if not estoque_geral.empty:
+            fig_patios = go.Figure()
+            for nome_patio, serie in estoque_geral.T.groupby(level='Pátio').sum().T.items():
+                fig_patios.add_trace(go.Scatter(x=serie.index, y=serie.to_numpy(), name=nome_patio,
+                                                mode='lines+markers'))
+            fig_patios.update_layout(title="Estoque estimado por pátio (t, fim do mês)", height=320,
+                                     margin=dict(t=40, b=10))
+            st.plotly_chart(fig_patios, use_container_width=True)
+
+# ==============================================================================
+# ABA 4: DESEMPENHO (SÓ COM A INSTRUMENTAÇÃO LIGADA)
+# ==============================================================================
+if tab_desempenho:
+    with tab_desempenho[0]:
+        st.header("⏱️ Desempenho por Execução")
+        st.caption(f"Tempos por etapa das últimas execuções deste servidor. "
+                   f"Métricas gravadas em `{ARQUIVO_METRICAS}`.")
+
+        execucoes = historico()
+        if not execucoes:
+            st.info("Nenhuma execução concluída ainda: interaja com o dashboard ou recarregue a página.")
+        else:
+            # A execução atual só termina depois desta aba; mostra a anterior
+            ultima = execucoes[0]
+            etapas = pd.DataFrame(ultima.etapas)
+            etapas['ms'] = etapas['segundos'] * 1000
+            st.subheader(f"Última execução concluída: {ultima.origem}, {ultima.total * 1000:,.0f} ms")
+
+            principais = pd.Series(ultima.por_etapa())
+            fig_etapas = go.Figure(go.Bar(x=principais.to_numpy(), y=principais.index, orientation='h',
+                                          text=[f"{v:,.1f} ms" for v in principais], textposition='auto'))
+            fig_etapas.update_layout(height=60 + 30 * len(principais), margin=dict(t=10, b=10),
+                                     yaxis=dict(autorange='reversed'), xaxis_title="ms")
+            st.plotly_chart(fig_etapas, use_container_width=True)
+
+            colunas_etapas = ['nome', 'profundidade', 'ms'] + (['pico_processo_mb'] if 'pico_processo_mb' in etapas
+                                                               else [])
+            st.dataframe(etapas[colunas_etapas], hide_index=True, use_container_width=True,
+                         column_config={'ms': st.column_config.NumberColumn("Tempo (ms)", format="%.1f"),
+                                        'pico_processo_mb': st.column_config.NumberColumn(
+                                            "Pico do processo (MB)", format="%.2f",
+                                            help="Alocação máxima do processo inteiro durante a etapa, acima "
+                                                 "da do início (inclui outras threads)")})
+
+            st.subheader("Execuções recentes")
+            recentes = pd.DataFrame([{'Início': e.inicio, 'Origem': e.origem, 'Total (ms)': e.total * 1000,
+                                      **e.por_etapa()} for e in execucoes])
+            st.dataframe(recentes, hide_index=True, use_container_width=True)
+
+            st.subheader("Acumulado por etapa")
+            acumulado = pd.DataFrame([(nome, n, soma / n * 1000, maior * 1000)
+                                      for nome, (n, soma, maior) in totais().items()],
+                                     columns=['Etapa', 'Execuções', 'Média (ms)', 'Máximo (ms)'])
+            st.dataframe(acumulado.sort_values('Média (ms)', ascending=False), hide_index=True,
+                         use_container_width=True)
+            st.download_button("Baixar métricas (Prometheus)", texto_prometheus(), 'metricas_estoque.prom',
+                               'text/plain')
+
+finalizar_execucao()
@@ -0,0 +1,229 @@
+import threading
+
+import numpy as np
+import pandas as pd
+
+from armazenamento import CHAVE_MENSAL, DB_FILE, SOMAS_DIARIAS, SOMAS_MENSAIS, conectar
+
+# ==============================================================================
+# CONSULTAS SOBRE OS AGREGADOS MATERIALIZADOS
+# ==============================================================================
+# As linhas dos agregados mensais viram células (espécie, com ticket, mês,
+# pilha) ordenadas por uma chave inteira: cada (espécie, ticket, mês) é um
+# trecho contíguo com as pilhas em ordem alfabética e as somas acumuladas
+# dentro do trecho. Qualquer combinação de espécies, intervalo de meses,
+# prefixo de pilha e ticket é respondida com uma busca binária por trecho,
+# sem depender do tamanho do histórico. As séries diárias e mensais saem da
+# tabela por dia.
+#
+# Memória: só há células para as pilhas medidas em cada mês, ~90 bytes por
+# linha de agregados_mensais (chave, somas e acumulados) mais os nomes das
+# espécies, meses e pilhas; um pátio cujas pilhas se renovam não paga por
+# meses x pilhas. Uma inserção copia as células (o objeto anterior pode estar
+# em uso por outra sessão) e só reacumula os trechos que mudaram.
+
+_cache = {}
+_trava = threading.Lock()
+
+
+def _acumular_trechos(chaves, valores, n_pilhas):
+    # Somas acumuladas de `valores`, reiniciadas a cada (espécie, ticket, mês)
+    if not len(chaves):
+        return valores.copy()
+    return pd.DataFrame(valores).groupby(chaves // n_pilhas, sort=False).cumsum().to_numpy()
+
+
+class Agregados:
+    def __init__(self, especies, meses, pilhas, chaves, valores, acumulado, diario):
+        self.especies, self.meses, self.pilhas = especies, meses, pilhas
+        # Células em ordem de chave ((e * 2 + t) * meses + m) * pilhas + p, com
+        # as somas de cada uma e as acumuladas até ela dentro do seu trecho
+        self.chaves = chaves
+        self.valores = valores
+        self.acumulado = acumulado
+        self.diario = diario
+
+    @classmethod
+    def montar(cls, mensal, diario):
+        especies = np.array(sorted(mensal['Tipo_Madeira'].unique()), dtype=object)
+        meses = np.array(sorted(mensal['Mes'].unique()), dtype=object)
+        pilhas = np.array(sorted(mensal['Pilha_ID'].unique()), dtype=object)
+        chaves = _codificar(*_celulas(especies, meses, pilhas, mensal), len(meses), len(pilhas))
+        ordem = np.argsort(chaves, kind='stable')
+        valores = mensal[SOMAS_MENSAIS].to_numpy(dtype=float)[ordem]
+        return cls(especies, meses, pilhas, chaves[ordem], valores,
+                   _acumular_trechos(chaves[ordem], valores, len(pilhas)), _indexar_diario(diario))
+
+    def _com_chaves(self, linhas):
+        # Espécies, meses e pilhas incluindo os novos, e as chaves das células
+        # atuais recodificadas (a ordem entre elas não muda)
+        (especies, mapa_e), (meses, mapa_m), (pilhas, mapa_p) = (
+            _incluir(self.especies, linhas['Tipo_Madeira']), _incluir(self.meses, linhas['Mes']),
+            _incluir(self.pilhas, linhas['Pilha_ID']))
+        if mapa_e is None and mapa_m is None and mapa_p is None:
+            return especies, meses, pilhas, self.chaves
+        e, t, m, p = _decodificar(self.chaves, len(self.meses), len(self.pilhas))
+        chaves = _codificar(e if mapa_e is None else mapa_e[e], t, m if mapa_m is None else mapa_m[m],
+                            p if mapa_p is None else mapa_p[p], len(meses), len(pilhas))
+        return especies, meses, pilhas, chaves
+
+    def atualizado(self, linhas, diario):
+        # Novo objeto com as linhas alteradas (valores absolutos) aplicadas. As
+        # células são copiadas porque as atuais podem estar em uso por outra
+        # sessão; só os trechos alterados são reacumulados.
+        especies, meses, pilhas, chaves = self._com_chaves(linhas)
+        if linhas.empty:
+            return Agregados(especies, meses, pilhas, chaves, self.valores, self.acumulado, _indexar_diario(diario))
+        novas = _codificar(*_celulas(especies, meses, pilhas, linhas), len(meses), len(pilhas))
+        ordem = np.argsort(novas, kind='stable')
+        novas, somas = novas[ordem], linhas[SOMAS_MENSAIS].to_numpy(dtype=float)[ordem]
+
+        posicao = np.searchsorted(chaves, novas)
+        existe = np.zeros(len(novas), dtype=bool)
+        dentro = posicao < len(chaves)
+        existe[dentro] = chaves[posicao[dentro]] == novas[dentro]
+        valores = self.valores.copy()
+        valores[posicao[existe]] = somas[existe]
+        if existe.all():
+            acumulado = self.acumulado.copy()
+        else:
+            chaves = np.insert(chaves, posicao[~existe], novas[~existe])
+            valores = np.insert(valores, posicao[~existe], somas[~existe], axis=0)
+            acumulado = np.insert(self.acumulado, posicao[~existe], 0.0, axis=0)
+
+        for grupo in np.unique(novas // len(pilhas)):
+            inicio, fim = np.searchsorted(chaves, [grupo * len(pilhas), (grupo + 1) * len(pilhas)])
+            np.cumsum(valores[inicio:fim], axis=0, out=acumulado[inicio:fim])
+        return Agregados(especies, meses, pilhas, chaves, valores, acumulado, _indexar_diario(diario))
+
+    def _intervalo(self, ordenados, inicio, fim):
+        return (np.searchsorted(ordenados, inicio, 'left') if inicio is not None else 0,
+                np.searchsorted(ordenados, fim, 'right') if fim is not None else len(ordenados))
+
+    def _ate(self, posicao, inicio):
+        # Soma das células do trecho antes de `posicao`
+        return np.where((posicao > inicio)[..., None], self.acumulado[posicao - 1], 0.0)
+
+    def somas(self, especies=None, mes_inicio=None, mes_fim=None, prefixo_pilha='', com_ticket=None):
+        # Somas (n, volume, peso, tickets, erro_abs_pct) por ticket: array [2, k]
+        m0, m1 = self._intervalo(self.meses, mes_inicio, mes_fim)
+        p0, p1 = self._intervalo(self.pilhas, prefixo_pilha or None,
+                                 prefixo_pilha + '\U0010ffff' if prefixo_pilha else None)
+        e = [i for i, especie in enumerate(self.especies) if especies is None or especie in especies]
+        resultado = np.zeros((2, len(SOMAS_MENSAIS)))
+        if not e or m0 >= m1 or p0 >= p1 or not len(self.chaves):
+            return resultado
+        # Início de cada trecho (espécie, ticket, mês) e posições de p0 e p1 nele
+        n_pilhas = len(self.pilhas)
+        trechos = _codificar(np.array(e)[:, None, None], np.arange(2)[:, None], np.arange(m0, m1), 0,
+                             len(self.meses), n_pilhas)
+        inicio, de, ate = np.searchsorted(self.chaves, np.stack([trechos, trechos + p0, trechos + p1]))
+        resultado[:] = (self._ate(ate, inicio) - self._ate(de, inicio)).sum(axis=(0, 2))
+        if com_ticket is not None:
+            resultado[int(not com_ticket)] = 0
+        return resultado
+
+    def indicadores(self, **filtros):
+        # Indicadores do dashboard para um filtro, direto do cubo
+        return indicadores(self.somas(**filtros))
+
+    def _por_especie(self, coluna):
+        return self.diario[coluna].unstack('Tipo_Madeira', fill_value=0)
+
+    def serie_estoque(self, frequencia='D'):
+        # Estoque estimado (t) por espécie ao fim de cada dia ou mês ('D'/'M')
+        estoque = self._por_especie('delta_estoque').cumsum()
+        if frequencia == 'M':
+            estoque = estoque.resample('ME').last().ffill()
+        return estoque
+
+    def serie_erro_medio(self, frequencia='D'):
+        # Erro percentual absoluto médio das medições com ticket, por espécie
+        erro, n = self._por_especie('erro_abs_pct'), self._por_especie('n_ticket')
+        if frequencia == 'M':
+            erro, n = erro.resample('ME').sum(), n.resample('ME').sum()
+        return (erro / n.where(n > 0)).astype(float)
+
+
+def indicadores(somas):
+    # Indicadores a partir das somas [2, k] por ticket (de um cubo ou de
+    # vários pátios somados)
+    total = somas.sum(axis=0)
+    n_ticket = somas[1, SOMAS_MENSAIS.index('n')]
+    return {
+        'medicoes': int(round(total[SOMAS_MENSAIS.index('n')])),
+        'volume': total[SOMAS_MENSAIS.index('volume')],
+        'peso': total[SOMAS_MENSAIS.index('peso')],
+        'tickets': total[SOMAS_MENSAIS.index('tickets')],
+        'erro_medio': somas[1, SOMAS_MENSAIS.index('erro_abs_pct')] / n_ticket if n_ticket else 0.0,
+    }
+
+
+def _incluir(ordenados, valores):
+    # `ordenados` acrescido dos valores que ainda não estão nele, e a nova
+    # posição de cada elemento antigo (None se nada entrou)
+    valores = np.unique(valores.to_numpy(dtype=object))
+    posicao = np.searchsorted(ordenados, valores)
+    falta = posicao == len(ordenados)
+    falta[~falta] = ordenados[posicao[~falta]] != valores[~falta]
+    if not falta.any():
+        return ordenados, None
+    antigos = np.arange(len(ordenados))
+    return (np.insert(ordenados, posicao[falta], valores[falta]),
+            antigos + np.searchsorted(posicao[falta], antigos, side='right'))
+
+
+def _celulas(especies, meses, pilhas, linhas):
+    # Índices (espécie, ticket, mês, pilha) de cada linha agregada
+    return (np.searchsorted(especies, linhas['Tipo_Madeira'].to_numpy(dtype=object)),
+            linhas['Com_Ticket'].to_numpy(dtype='int64'),
+            np.searchsorted(meses, linhas['Mes'].to_numpy(dtype=object)),
+            np.searchsorted(pilhas, linhas['Pilha_ID'].to_numpy(dtype=object)))
+
+
+def _codificar(e, t, m, p, n_meses, n_pilhas):
+    return ((np.asarray(e, dtype='int64') * 2 + t) * n_meses + m) * n_pilhas + p
+
+
+def _decodificar(chaves, n_meses, n_pilhas):
+    grupo, p = np.divmod(chaves, n_pilhas)
+    grupo, m = np.divmod(grupo, n_meses)
+    e, t = np.divmod(grupo, 2)
+    return e, t, m, p
+
+
+def _indexar_diario(diario):
+    diario = diario.assign(Data=pd.to_datetime(diario['Data'], format='ISO8601'))
+    return diario.set_index(['Data', 'Tipo_Madeira']).sort_index()
+
+
+def _ler(con, seq_minimo=None):
+    mensal = pd.read_sql_query(
+        f'SELECT {", ".join(CHAVE_MENSAL + SOMAS_MENSAIS)} FROM agregados_mensais'
+        + (' WHERE seq > ?' if seq_minimo is not None else ''), con,
+        params=(seq_minimo,) if seq_minimo is not None else None)
+    diario = pd.read_sql_query(f'SELECT Tipo_Madeira, Data, {", ".join(SOMAS_DIARIAS)} FROM agregados_diarios', con)
+    return mensal, diario
+
+
+def carregar_agregados(caminho=DB_FILE):
+    # Compartilhado entre as sessões, como o histórico. Depois de uma inserção
+    # só as linhas agregadas alteradas são lidas; reconstruções (lotes,
+    # recálculos) trocam a geração e o cubo é remontado.
+    with _trava:
+        with conectar(caminho) as con:
+            estado = dict(con.execute(
+                "SELECT chave, valor FROM meta WHERE chave IN ('agregados_geracao', 'agregados_seq')").fetchall())
+            entrada = _cache.get(caminho)
+            if entrada is not None and entrada['estado'] == estado:
+                return entrada['agregados']
+
+            if entrada is not None and entrada['estado']['agregados_geracao'] == estado['agregados_geracao']:
+                mensal, diario = _ler(con, entrada['estado']['agregados_seq'])
+                entrada['agregados'] = entrada['agregados'].atualizado(mensal, diario)
+                entrada['estado'] = estado
+                return entrada['agregados']
+
+            agregados = Agregados.montar(*_ler(con))
+            _cache[caminho] = {'estado': estado, 'agregados': agregados}
+            return agregados
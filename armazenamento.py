@@ -0,0 +1,827 @@
+import os
+import sqlite3
+import tempfile
+import threading
+from contextlib import closing, contextmanager
+
+import numpy as np
+import pandas as pd
+
+from calculos import densidade_padrao
+from instrumentacao import etapa
+from parametros import DENSIDADE_MENSAL, ESPECIES, FATOR_ARRUMADO
+
+# Formato colunar (Arrow/Feather) é opcional: sem pyarrow o histórico é lido
+# direto do SQLite
+try:
+    import pyarrow as pa
+    from pyarrow import feather
+
+    USE_ARROW = os.environ.get('ESTOQUE_COLUNAR', '1') != '0'
+except ImportError:
+    USE_ARROW = False
+
+# ==============================================================================
+# ARMAZENAMENTO DAS MEDIÇÕES (SQLITE, SOMENTE INSERÇÃO)
+# ==============================================================================
+# Cada medição é uma linha na tabela `medicoes`. Registrar uma pilha é um único
+# INSERT dentro de uma transação: o custo não depende do tamanho do histórico e
+# o arquivo nunca fica pela metade (o SQLite faz o commit de forma atômica).
+
+DB_FILE = 'estoque_arauco.db'
+JSON_LEGADO = 'estoque_arauco_final.json'
+
+# Quantas linhas podem se acumular no SQLite depois do último snapshot colunar
+# antes que ele seja regravado
+LIMIAR_SNAPSHOT = 5000
+
+# Cache do histórico já convertido em DataFrame, compartilhado por todas as
+# sessões do processo: caminho -> {'assinatura': ..., 'df': ..., 'pendentes': [...]}
+_cache = {}
+_trava_cache = threading.Lock()
+
+# Bancos cujas tabelas já foram criadas/migradas neste processo
+_inicializados = set()
+
+# Descritores abertos por _assinatura, um por banco, nunca fechados
+_descritores = {}
+_trava_descritores = threading.Lock()
+
+# Escritor único no processo: as sessões do Streamlit são threads e gravam uma
+# de cada vez; entre processos quem serializa é o BEGIN IMMEDIATE do SQLite
+_trava_escrita = threading.RLock()
+
+
+class ConflitoVersao(RuntimeError):
+    # O histórico mudou depois da leitura em que a gravação se baseou
+    pass
+
+
+class MesArquivado(ValueError):
+    # Gravação com data anterior ao corte do arquivo (ver particoes.py)
+    pass
+
+COLUNAS = [
+    'Data', 'Pilha_ID', 'Tipo_Madeira',
+    'Volume_Drone_Estereo', 'Densidade_Aplicada', 'Fator_Teorico',
+    'Peso_Teorico_Ton', 'Peso_Tickets_Ton',
+    'Fator_Conversao_Real', 'Erro_Ton', 'Erro_Percentual',
+    'Versao_Parametros', 'Densidade_Manual'
+]
+
+# Variação em relação à medição anterior da mesma pilha. Gravada junto com a
+# medição e mantida de forma incremental pelo armazenamento.
+COLUNAS_VARIACAO = ['Var_Anterior_Ton', 'Var_Anterior_Pct']
+COLUNAS_HISTORICO = COLUNAS + COLUNAS_VARIACAO
+
+TIPOS_SQL = {
+    'Data': 'TEXT NOT NULL',
+    'Pilha_ID': 'TEXT NOT NULL',
+    'Tipo_Madeira': 'TEXT NOT NULL',
+    'Volume_Drone_Estereo': 'REAL',
+    'Densidade_Aplicada': 'REAL',
+    'Fator_Teorico': 'REAL',
+    'Peso_Teorico_Ton': 'REAL',
+    'Peso_Tickets_Ton': 'REAL',
+    'Fator_Conversao_Real': 'REAL',
+    'Erro_Ton': 'REAL',
+    'Erro_Percentual': 'REAL',
+    'Versao_Parametros': 'INTEGER NOT NULL DEFAULT 1',
+    'Densidade_Manual': 'INTEGER NOT NULL DEFAULT 0',
+    'Var_Anterior_Ton': 'REAL NOT NULL DEFAULT 0',
+    'Var_Anterior_Pct': 'REAL NOT NULL DEFAULT 0',
+}
+
+# Tipos em memória: IDs e espécies como categorias, medidas em float64 e
+# indicadores derivados (só exibidos) em float32
+SCHEMA = {
+    'Data': 'datetime64[ns]',
+    'Pilha_ID': 'category',
+    'Tipo_Madeira': 'category',
+    'Volume_Drone_Estereo': 'float64',
+    'Densidade_Aplicada': 'float64',
+    'Fator_Teorico': 'float64',
+    'Peso_Teorico_Ton': 'float64',
+    'Peso_Tickets_Ton': 'float64',
+    'Fator_Conversao_Real': 'float32',
+    'Erro_Ton': 'float64',
+    'Erro_Percentual': 'float32',
+    'Versao_Parametros': 'int32',
+    'Densidade_Manual': 'bool',
+    'Var_Anterior_Ton': 'float64',
+    'Var_Anterior_Pct': 'float32',
+}
+
+
+def aplicar_schema(df):
+    tipos = {c: t for c, t in SCHEMA.items() if c in df.columns}
+    if 'Data' in tipos and not pd.api.types.is_datetime64_any_dtype(df['Data']):
+        df['Data'] = pd.to_datetime(df['Data'], format='ISO8601')
+    df = df.astype(tipos)
+    df.index = df.index.astype('int64')
+    df.index.name = 'id'
+    return df
+
+
+def get_empty_df(colunas=None):
+    return aplicar_schema(pd.DataFrame(columns=colunas or COLUNAS_HISTORICO))
+
+
+def conectar(caminho=DB_FILE):
+    con = sqlite3.connect(caminho, timeout=30)
+    stat = os.stat(caminho)
+    chave = (os.path.abspath(caminho), stat.st_dev, stat.st_ino)
+    # Arquivo vazio: banco apagado e recriado, possivelmente com o mesmo inode
+    if chave not in _inicializados or stat.st_size == 0:
+        _criar_tabelas(con)
+        _inicializados.add(chave)
+    return closing(con)
+
+
+def _criar_tabelas(con):
+    # Tudo numa transação de escrita: dois processos abrindo um banco antigo ao
+    # mesmo tempo migram uma vez só (o segundo já encontra as colunas)
+    with _trava_escrita:
+        con.execute('BEGIN IMMEDIATE')
+        try:
+            _migrar(con)
+            con.commit()
+        except BaseException:
+            con.rollback()
+            raise
+
+
+def _migrar(con):
+    colunas_sql = ', '.join(f'{c} {TIPOS_SQL[c]}' for c in COLUNAS_HISTORICO)
+    con.execute(f'CREATE TABLE IF NOT EXISTS medicoes (id INTEGER PRIMARY KEY AUTOINCREMENT, {colunas_sql})')
+    # Índice "última medição por pilha": localiza a leitura anterior de uma
+    # pilha sem percorrer o histórico
+    con.execute('CREATE INDEX IF NOT EXISTS idx_medicoes_pilha_data ON medicoes (Pilha_ID, Data, id)')
+    # Geração: incrementada por qualquer operação que altere linhas já gravadas,
+    # o que invalida o snapshot colunar
+    con.execute('CREATE TABLE IF NOT EXISTS meta (chave TEXT PRIMARY KEY, valor INTEGER NOT NULL)')
+    con.execute("INSERT OR IGNORE INTO meta (chave, valor) VALUES ('geracao', 0)")
+    con.execute("INSERT OR IGNORE INTO meta (chave, valor) VALUES ('agregados_geracao', 0)")
+    con.execute("INSERT OR IGNORE INTO meta (chave, valor) VALUES ('agregados_seq', 0)")
+    # Meses anteriores ao corte (AAAAMMDD, 0 = nenhum) saíram para as partições
+    # arquivadas e não aceitam mais gravações
+    con.execute("INSERT OR IGNORE INTO meta (chave, valor) VALUES ('arquivado_ate', 0)")
+    con.execute('CREATE TABLE IF NOT EXISTS particoes (arquivo TEXT PRIMARY KEY, inicio TEXT NOT NULL, '
+                'fim TEXT NOT NULL, linhas INTEGER NOT NULL, criada_em TEXT NOT NULL)')
+    # Última leitura arquivada de cada pilha: a primeira leitura depois do
+    # corte continua calculando a variação e o estoque a partir dela
+    con.execute('CREATE TABLE IF NOT EXISTS ultimas_arquivadas (Pilha_ID TEXT PRIMARY KEY, '
+                'Tipo_Madeira TEXT NOT NULL, Data TEXT NOT NULL, Peso_Teorico_Ton REAL)')
+
+    # Parâmetros de engenharia versionados; a versão 1 são os valores padrão
+    # de parametros.py, vigentes desde sempre
+    con.execute('CREATE TABLE IF NOT EXISTS parametros_versoes (versao INTEGER PRIMARY KEY, '
+                'vigencia TEXT NOT NULL, descricao TEXT NOT NULL, criada_em TEXT NOT NULL)')
+    con.execute('CREATE TABLE IF NOT EXISTS parametros_valores (versao INTEGER NOT NULL, mes INTEGER NOT NULL, '
+                'especie TEXT NOT NULL, densidade REAL NOT NULL, fator REAL NOT NULL, '
+                'PRIMARY KEY (versao, mes, especie))')
+    con.execute("INSERT OR IGNORE INTO parametros_versoes VALUES (1, '1900-01-01', 'Valores padrão', "
+                "datetime('now'))")
+    con.executemany('INSERT OR IGNORE INTO parametros_valores VALUES (1, ?, ?, ?, ?)',
+                    [(mes, e, DENSIDADE_MENSAL[mes][e], FATOR_ARRUMADO[e]) for mes in range(1, 13) for e in ESPECIES])
+    novos_agregados = con.execute(
+        "SELECT COUNT(*) FROM sqlite_master WHERE name IN ('agregados_mensais', 'calibracao')").fetchone()[0] < 2
+    _criar_tabelas_agregados(con)
+
+    # Bancos criados antes de colunas novas: adiciona e preenche uma vez
+    existentes = {linha[1] for linha in con.execute('PRAGMA table_info(medicoes)')}
+    faltantes = [c for c in COLUNAS_HISTORICO if c not in existentes]
+    if faltantes:
+        for c in faltantes:
+            con.execute(f'ALTER TABLE medicoes ADD COLUMN {c} {TIPOS_SQL[c]}')
+        if 'Densidade_Manual' in faltantes:
+            _marcar_densidade_manual(con)
+        if set(COLUNAS_VARIACAO) & set(faltantes):
+            recalcular_variacoes(con)
+        _incrementar_geracao(con)
+    if novos_agregados or faltantes:
+        reconstruir_agregados(con)
+
+
+@contextmanager
+def transacao_escrita(caminho=DB_FILE):
+    # Conexão com a transação de escrita já aberta: commit ao sair do bloco,
+    # rollback se houver exceção
+    with _trava_escrita, conectar(caminho) as con:
+        con.execute('BEGIN IMMEDIATE')
+        try:
+            yield con
+            con.commit()
+        except BaseException:
+            con.rollback()
+            raise
+
+
+@contextmanager
+def escritor_exclusivo():
+    # Segura as gravações das outras threads do processo durante um bloco de
+    # leitura + cálculo + gravação (as de outros processos seguem possíveis)
+    with _trava_escrita:
+        yield
+
+
+def versao_atual(con):
+    # (geração, último id): muda a cada linha inserida ou alterada
+    return _geracao(con), con.execute('SELECT COALESCE(MAX(id), 0) FROM medicoes').fetchone()[0]
+
+
+def versao_dados(df):
+    # Versão do banco que o DataFrame lido por load_data reflete
+    return df.attrs.get('versao')
+
+
+def _marcar_densidade_manual(con):
+    # Linhas antigas não registram se a densidade foi digitada: considera manual
+    # toda densidade diferente da tabela padrão do mês/espécie
+    df = pd.read_sql_query('SELECT id, Data, Tipo_Madeira, Densidade_Aplicada FROM medicoes', con)
+    if df.empty:
+        return
+    meses = pd.to_datetime(df['Data'], format='ISO8601').dt.month.to_numpy()
+    padrao = densidade_padrao(meses, df['Tipo_Madeira'].to_numpy())
+    manual = ~np.isclose(df['Densidade_Aplicada'].to_numpy(dtype=float), padrao)
+    con.executemany('UPDATE medicoes SET Densidade_Manual = 1 WHERE id = ?',
+                    [(i,) for i in df['id'].to_numpy()[manual].tolist()])
+
+
+def _geracao(con):
+    return con.execute("SELECT valor FROM meta WHERE chave = 'geracao'").fetchone()[0]
+
+
+def _incrementar_geracao(con):
+    con.execute("UPDATE meta SET valor = valor + 1 WHERE chave = 'geracao'")
+
+
+def corte_arquivo(con):
+    # Data ISO do corte do arquivo, ou '' se nada foi arquivado
+    valor = con.execute("SELECT valor FROM meta WHERE chave = 'arquivado_ate'").fetchone()[0]
+    return f'{valor // 10000:04d}-{valor // 100 % 100:02d}-{valor % 100:02d}' if valor else ''
+
+
+def periodo_aberto(caminho=DB_FILE):
+    # Primeiro dia que ainda aceita gravações (None: todos)
+    with conectar(caminho) as con:
+        corte = corte_arquivo(con)
+    return pd.Timestamp(corte) if corte else None
+
+
+def _verificar_aberto(con, datas):
+    corte = corte_arquivo(con)
+    if corte and min(datas) < corte:
+        raise MesArquivado(f'Meses anteriores a {pd.Timestamp(corte):%m/%Y} estão arquivados e não aceitam '
+                           'gravações.')
+
+
+def ancoras_arquivadas(con, pilhas=None):
+    # Última leitura arquivada das pilhas (todas, ou as da tabela temporária
+    # _pilhas quando `pilhas` é dado), com ids negativos para não colidir com
+    # as medições
+    consulta = 'SELECT Pilha_ID, Tipo_Madeira, Data, Peso_Teorico_Ton FROM ultimas_arquivadas'
+    if pilhas is not None:
+        consulta += ' WHERE Pilha_ID IN (SELECT Pilha_ID FROM _pilhas)'
+    ancoras = pd.read_sql_query(consulta, con)
+    ancoras.index = pd.Index(-1 - np.arange(len(ancoras)), name='id')
+    return ancoras
+
+
+def _variacao(peso, peso_anterior):
+    if peso_anterior is None:
+        return 0.0, 0.0
+    var_ton = peso - peso_anterior
+    var_pct = var_ton / peso_anterior * 100 if peso_anterior > 0 else 0.0
+    return var_ton, var_pct
+
+
+def calcular_variacoes(df):
+    # Variação de cada medição em relação à leitura anterior da mesma pilha.
+    # `df` indexado por id, com Pilha_ID, Data e Peso_Teorico_Ton; devolve os
+    # arrays (var_ton, var_pct) na ordem das linhas do `df`.
+    with etapa('variacoes'):
+        ordenado = df[['Pilha_ID', 'Data', 'Peso_Teorico_Ton']].reset_index(drop=True).assign(
+            id=df.index.to_numpy(), _posicao=np.arange(len(df)))
+        ordenado = ordenado.sort_values(['Pilha_ID', 'Data', 'id'])
+        peso = ordenado['Peso_Teorico_Ton'].to_numpy(dtype=float)
+        anterior = (ordenado.groupby('Pilha_ID', sort=False, observed=True)['Peso_Teorico_Ton'].shift()
+                    .to_numpy(dtype=float))
+        var_ton = np.nan_to_num(peso - anterior)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            var_pct = np.where(anterior > 0, var_ton / anterior * 100, 0.0)
+
+        posicao = ordenado['_posicao'].to_numpy()
+        saida_ton, saida_pct = np.empty(len(df)), np.empty(len(df))
+        saida_ton[posicao], saida_pct[posicao] = var_ton, var_pct
+        return saida_ton, saida_pct
+
+
+def variacoes_mudaram(df, var_ton, var_pct):
+    return ~(np.isclose(var_ton, df['Var_Anterior_Ton'].to_numpy(dtype=float))
+             & np.isclose(var_pct, df['Var_Anterior_Pct'].to_numpy(dtype=float)))
+
+
+def recalcular_variacoes(con, pilhas=None, primeiro_id_novo=None):
+    # Recalcula as variações de todas as medições (ou só das pilhas indicadas)
+    # em uma passada vetorizada e grava apenas as que mudaram. Deve rodar
+    # dentro de uma transação aberta. Com `primeiro_id_novo` (inserção em
+    # lote), também soma as linhas novas aos agregados.
+    consulta = ('SELECT id, Pilha_ID, Tipo_Madeira, Data, Volume_Drone_Estereo, Peso_Teorico_Ton, Peso_Tickets_Ton, '
+                'Erro_Percentual, Var_Anterior_Ton, Var_Anterior_Pct FROM medicoes')
+    if pilhas is not None:
+        con.execute('CREATE TEMP TABLE IF NOT EXISTS _pilhas (Pilha_ID TEXT PRIMARY KEY)')
+        con.execute('DELETE FROM _pilhas')
+        con.executemany('INSERT OR IGNORE INTO _pilhas VALUES (?)', [(str(p),) for p in pilhas])
+        consulta += ' WHERE Pilha_ID IN (SELECT Pilha_ID FROM _pilhas)'
+
+    df = pd.read_sql_query(consulta, con)
+    if df.empty:
+        return 0
+
+    # As âncoras entram só como leitura anterior; nunca são gravadas
+    df = df.set_index('id')
+    ancoras = ancoras_arquivadas(con, pilhas)
+    if not ancoras.empty:
+        df = pd.concat([ancoras, df])
+    var_ton, var_pct = calcular_variacoes(df)
+    mudou = variacoes_mudaram(df, var_ton, var_pct) & (df.index.to_numpy() > 0)
+    ids = df.index.to_numpy()[mudou]
+    con.executemany(
+        'UPDATE medicoes SET Var_Anterior_Ton = ?, Var_Anterior_Pct = ? WHERE id = ?',
+        zip(var_ton[mudou].tolist(), var_pct[mudou].tolist(), ids.tolist()))
+    if primeiro_id_novo is not None:
+        _somar_lote(con, df, var_ton, primeiro_id_novo)
+
+    # Linhas recém-inseridas ainda não estão no snapshot; só invalida se mudou
+    # alguma linha que já existia
+    if len(ids) and (primeiro_id_novo is None or (ids < primeiro_id_novo).any()):
+        _incrementar_geracao(con)
+    return len(ids)
+
+
+# ==============================================================================
+# AGREGADOS MATERIALIZADOS (ROLLUPS)
+# ==============================================================================
+# Somas e contagens por (espécie, mês, pilha, com ticket) e por (espécie, dia),
+# mantidas na mesma transação de cada gravação. Os indicadores e as séries de
+# estoque e erro médio saem daqui sem percorrer o histórico (ver agregados.py).
+# O estoque diário é a soma acumulada de `delta_estoque`: a primeira medição de
+# cada pilha entra com o peso inteiro, as seguintes com a variação.
+# A tabela `calibracao` guarda, por (espécie, mês do ano), as somas dos
+# mínimos quadrados peso teórico x peso de balança das medições com ticket
+# (ver calibracao.py).
+# Medições arquivadas continuam nos agregados: as linhas de meses anteriores ao
+# corte nunca são refeitas, e a parte delas na calibração fica guardada em
+# `calibracao_arquivada`.
+
+CHAVE_MENSAL = ['Tipo_Madeira', 'Mes', 'Pilha_ID', 'Com_Ticket']
+SOMAS_MENSAIS = ['n', 'volume', 'peso', 'tickets', 'erro_abs_pct']
+CHAVE_DIARIA = ['Tipo_Madeira', 'Data']
+SOMAS_DIARIAS = ['n', 'peso', 'n_ticket', 'erro_abs_pct', 'delta_estoque']
+CHAVE_CALIBRACAO = ['Tipo_Madeira', 'Mes']
+SOMAS_CALIBRACAO = ['n', 'soma_pt', 'soma_pp', 'soma_tt']
+# Colunas das medições que entram nos agregados
+COLUNAS_AGREGADAS = ['Volume_Drone_Estereo', 'Peso_Teorico_Ton', 'Peso_Tickets_Ton', 'Erro_Percentual',
+                     'Var_Anterior_Ton']
+
+
+def _criar_tabelas_agregados(con):
+    con.execute('CREATE TABLE IF NOT EXISTS agregados_mensais (Tipo_Madeira TEXT NOT NULL, Mes TEXT NOT NULL, '
+                'Pilha_ID TEXT NOT NULL, Com_Ticket INTEGER NOT NULL, n INTEGER NOT NULL, volume REAL NOT NULL, '
+                'peso REAL NOT NULL, tickets REAL NOT NULL, erro_abs_pct REAL NOT NULL, seq INTEGER NOT NULL, '
+                'PRIMARY KEY (Tipo_Madeira, Mes, Pilha_ID, Com_Ticket))')
+    # `seq` marca a gravação que alterou a linha: quem lê busca só o que mudou
+    con.execute('CREATE INDEX IF NOT EXISTS idx_agregados_mensais_seq ON agregados_mensais (seq)')
+    con.execute('CREATE TABLE IF NOT EXISTS agregados_diarios (Tipo_Madeira TEXT NOT NULL, Data TEXT NOT NULL, '
+                'n INTEGER NOT NULL, peso REAL NOT NULL, n_ticket INTEGER NOT NULL, erro_abs_pct REAL NOT NULL, '
+                'delta_estoque REAL NOT NULL, PRIMARY KEY (Tipo_Madeira, Data))')
+    # Mes: 1 a 12. soma_pt = Σ teórico·balança, soma_pp = Σ teórico², soma_tt = Σ balança²
+    con.execute('CREATE TABLE IF NOT EXISTS calibracao (Tipo_Madeira TEXT NOT NULL, Mes INTEGER NOT NULL, '
+                'n INTEGER NOT NULL, soma_pt REAL NOT NULL, soma_pp REAL NOT NULL, soma_tt REAL NOT NULL, '
+                'PRIMARY KEY (Tipo_Madeira, Mes))')
+    con.execute('CREATE TABLE IF NOT EXISTS calibracao_arquivada (Tipo_Madeira TEXT NOT NULL, Mes INTEGER NOT NULL, '
+                'n INTEGER NOT NULL, soma_pt REAL NOT NULL, soma_pp REAL NOT NULL, soma_tt REAL NOT NULL, '
+                'PRIMARY KEY (Tipo_Madeira, Mes))')
+
+
+def _sql_somar(tabela, chave, somas, extras=()):
+    colunas = chave + somas + list(extras)
+    atualizacoes = [f'{c} = {c} + excluded.{c}' for c in somas] + [f'{c} = excluded.{c}' for c in extras]
+    return (f'INSERT INTO {tabela} ({", ".join(colunas)}) VALUES ({", ".join("?" * len(colunas))}) '
+            f'ON CONFLICT ({", ".join(chave)}) DO UPDATE SET {", ".join(atualizacoes)}')
+
+
+def _contribuicoes(df, delta_estoque):
+    # Contribuição de linhas de medição (Data em ISO) para as três tabelas
+    ticket = df['Peso_Tickets_Ton'].fillna(0).to_numpy(dtype=float) > 0
+    base = pd.DataFrame({
+        'Tipo_Madeira': df['Tipo_Madeira'].astype(str).to_numpy(),
+        'Data': df['Data'].astype(str).to_numpy(),
+        'Pilha_ID': df['Pilha_ID'].astype(str).to_numpy(),
+        'Com_Ticket': ticket.astype(int),
+        'n': 1,
+        'volume': df['Volume_Drone_Estereo'].fillna(0).to_numpy(dtype=float),
+        'peso': df['Peso_Teorico_Ton'].fillna(0).to_numpy(dtype=float),
+        'tickets': df['Peso_Tickets_Ton'].fillna(0).to_numpy(dtype=float),
+        'erro_abs_pct': np.where(ticket, np.abs(df['Erro_Percentual'].fillna(0).to_numpy(dtype=float)), 0.0),
+        'delta_estoque': delta_estoque,
+    })
+    base['Mes'] = base['Data'].str[:7]
+    base['n_ticket'] = base['Com_Ticket']
+    mensal = base.groupby(CHAVE_MENSAL, as_index=False)[SOMAS_MENSAIS].sum()
+    diario = base.groupby(CHAVE_DIARIA, as_index=False)[SOMAS_DIARIAS].sum()
+
+    com_ticket = base[ticket].assign(Mes=lambda b: b['Data'].str[5:7].astype(int))
+    calibracao = (com_ticket.assign(soma_pt=com_ticket['peso'] * com_ticket['tickets'],
+                                    soma_pp=com_ticket['peso'] ** 2, soma_tt=com_ticket['tickets'] ** 2)
+                  .groupby(CHAVE_CALIBRACAO, as_index=False)[SOMAS_CALIBRACAO].sum())
+    return mensal, diario, calibracao
+
+
+def _somar_agregados(con, mensal, diario, calibracao):
+    seq = con.execute("UPDATE meta SET valor = valor + 1 WHERE chave = 'agregados_seq' RETURNING valor").fetchall()[0][0]
+    con.executemany(_sql_somar('agregados_mensais', CHAVE_MENSAL, SOMAS_MENSAIS, ['seq']),
+                    mensal.assign(seq=seq).itertuples(index=False, name=None))
+    con.executemany(_sql_somar('agregados_diarios', CHAVE_DIARIA, SOMAS_DIARIAS),
+                    diario.itertuples(index=False, name=None))
+    con.executemany(_sql_somar('calibracao', CHAVE_CALIBRACAO, SOMAS_CALIBRACAO),
+                    calibracao.itertuples(index=False, name=None))
+
+
+def _somar_lote(con, df, var_ton, primeiro_id_novo):
+    # Linhas novas entram inteiras; das já gravadas só muda a contribuição ao
+    # estoque, quando passam a ter uma leitura anterior diferente
+    ordenado = df.assign(_var=var_ton, _id=df.index.to_numpy()).sort_values(['Pilha_ID', 'Data', '_id'])
+    nova = ordenado['_id'].to_numpy() >= primeiro_id_novo
+    peso = ordenado['Peso_Teorico_Ton'].to_numpy(dtype=float)
+    delta = np.where(ordenado['Pilha_ID'].duplicated().to_numpy(), ordenado['_var'].to_numpy(dtype=float), peso)
+
+    tinha_anterior = ordenado['Pilha_ID'].where(~nova).duplicated().to_numpy() & ~nova
+    delta_antigo = np.where(tinha_anterior, ordenado['Var_Anterior_Ton'].to_numpy(dtype=float), peso)
+    ajuste = np.where(nova, 0.0, delta - delta_antigo)
+
+    mensal, diario, calibracao = _contribuicoes(ordenado[nova], delta[nova])
+    alteradas = ~nova & ~np.isclose(ajuste, 0.0)
+    if alteradas.any():
+        ajustes = pd.DataFrame({'Tipo_Madeira': ordenado['Tipo_Madeira'].to_numpy()[alteradas],
+                                'Data': ordenado['Data'].to_numpy()[alteradas],
+                                'delta_estoque': ajuste[alteradas]})
+        diario = (pd.concat([diario, ajustes]).fillna(0).astype({'n': int, 'n_ticket': int})
+                  .groupby(CHAVE_DIARIA, as_index=False)[SOMAS_DIARIAS].sum())
+    _somar_agregados(con, mensal, diario, calibracao)
+
+
+def reconstruir_agregados(con):
+    # Refaz os agregados a partir do histórico inteiro. Usado na migração e
+    # depois de recálculos que alteram linhas já gravadas. Os meses arquivados
+    # são mantidos como estão.
+    df = pd.read_sql_query('SELECT id, Pilha_ID, Tipo_Madeira, Data, Volume_Drone_Estereo, Peso_Teorico_Ton, '
+                           'Peso_Tickets_Ton, Erro_Percentual, Var_Anterior_Ton FROM medicoes', con)
+    corte = corte_arquivo(con)
+    con.execute('DELETE FROM agregados_mensais WHERE Mes >= ?', (corte[:7],))
+    con.execute('DELETE FROM agregados_diarios WHERE Data >= ?', (corte,))
+    con.execute('DELETE FROM calibracao')
+    con.execute('INSERT INTO calibracao SELECT * FROM calibracao_arquivada')
+    if not df.empty:
+        df = pd.concat([ancoras_arquivadas(con).reset_index(), df]).sort_values(['Pilha_ID', 'Data', 'id'])
+        delta = np.where(df['Pilha_ID'].duplicated().to_numpy(), df['Var_Anterior_Ton'].to_numpy(dtype=float),
+                         df['Peso_Teorico_Ton'].to_numpy(dtype=float))
+        medicao = df['id'].to_numpy() > 0
+        _somar_agregados(con, *_contribuicoes(df[medicao], delta[medicao]))
+    con.execute("UPDATE meta SET valor = valor + 1 WHERE chave = 'agregados_geracao'")
+
+
+def _para_linhas(df):
+    # Datas gravadas em ISO (AAAA-MM-DD) para manter a ordenação textual correta
+    df = df[COLUNAS].copy()
+    df['Data'] = pd.to_datetime(df['Data']).dt.strftime('%Y-%m-%d')
+    df['Pilha_ID'] = df['Pilha_ID'].astype(str)
+    df['Tipo_Madeira'] = df['Tipo_Madeira'].astype(str)
+    numericas = COLUNAS[3:-2]
+    df[numericas] = df[numericas].astype(float)
+    df['Versao_Parametros'] = df['Versao_Parametros'].astype(int)
+    df['Densidade_Manual'] = df['Densidade_Manual'].astype(bool).astype(int)
+    return list(df.itertuples(index=False, name=None))
+
+
+def _sql_insert(colunas=COLUNAS):
+    return f"INSERT INTO medicoes ({', '.join(colunas)}) VALUES ({', '.join('?' * len(colunas))})"
+
+
+def migrar_json_legado(caminho=DB_FILE, json_legado=JSON_LEGADO):
+    # Importa o arquivo JSON antigo uma única vez. Depois do commit o arquivo é
+    # renomeado, de modo que uma nova inicialização não duplica as linhas.
+    if not os.path.exists(json_legado):
+        return 0
+
+    try:
+        df_legado = pd.read_json(json_legado, orient='records')
+    except ValueError:
+        df_legado = get_empty_df()
+
+    with transacao_escrita(caminho) as con:
+        ja_migrado = con.execute('SELECT COUNT(*) FROM medicoes').fetchone()[0] > 0
+        if ja_migrado or df_legado.empty or 'Data' not in df_legado.columns:
+            n = 0
+        else:
+            df_legado = df_legado.reindex(columns=COLUNAS).fillna({'Versao_Parametros': 1, 'Densidade_Manual': 0})
+            con.executemany(_sql_insert(), _para_linhas(df_legado))
+            _marcar_densidade_manual(con)
+            recalcular_variacoes(con)
+            reconstruir_agregados(con)
+            n = len(df_legado)
+
+    os.replace(json_legado, json_legado + '.migrado')
+    return n
+
+
+def inicializar(caminho=DB_FILE, json_legado=None):
+    # Conectar cria ou migra as tabelas. O JSON legado procurado por padrão é o
+    # da pasta do banco.
+    with conectar(caminho):
+        pass
+    migrar_json_legado(caminho, json_legado or os.path.join(os.path.dirname(caminho), JSON_LEGADO))
+
+
+def _descritor(caminho, stat):
+    # Descritor mantido aberto para ler o cabeçalho: fechar qualquer descritor
+    # do arquivo libera as travas POSIX que o SQLite mantém nele no processo
+    # inteiro, e outra conexão gravando ao mesmo tempo perderia a exclusividade
+    chave = os.path.abspath(caminho)
+    descritor = _descritores.get(chave)
+    if descritor is None or os.fstat(descritor).st_ino != stat.st_ino:
+        # O arquivo antigo foi substituído, ninguém mais trava por ele
+        if descritor is not None:
+            os.close(descritor)
+        descritor = _descritores[chave] = os.open(caminho, os.O_RDONLY)
+    return descritor
+
+
+def _assinatura(caminho):
+    # mtime + tamanho + "file change counter" do cabeçalho do SQLite (offset 24),
+    # que é incrementado a cada transação de escrita confirmada
+    stat = os.stat(caminho)
+    with _trava_descritores:
+        contador = int.from_bytes(os.pread(_descritor(caminho, stat), 4, 24), 'big')
+    return stat.st_mtime_ns, stat.st_size, contador
+
+
+def _ler_banco(caminho, colunas, id_minimo=0):
+    with conectar(caminho) as con:
+        df = pd.read_sql_query(
+            f"SELECT id, {', '.join(colunas)} FROM medicoes WHERE id > ? ORDER BY id",
+            con, params=(id_minimo,), index_col='id')
+    return aplicar_schema(df)
+
+
+def caminho_snapshot(caminho):
+    return os.path.splitext(caminho)[0] + '.feather'
+
+
+def _ler_snapshot(caminho, colunas):
+    # Devolve (df, último id) ou None se o snapshot não existe ou está obsoleto
+    arquivo = caminho_snapshot(caminho)
+    if not os.path.exists(arquivo):
+        return None
+
+    with pa.memory_map(arquivo) as fonte:
+        schema = pa.ipc.open_file(fonte).schema
+    meta = schema.metadata or {}
+    with conectar(caminho) as con:
+        geracao = _geracao(con)
+    if int(meta.get(b'geracao', -1)) != geracao or not set(colunas) <= set(schema.names):
+        return None
+
+    tabela = feather.read_table(arquivo, columns=['id'] + colunas, memory_map=True)
+    df = tabela.to_pandas().set_index('id')
+    return aplicar_schema(df), int(meta[b'ultimo_id']), geracao
+
+
+def _gravar_snapshot(caminho, df, geracao):
+    # `geracao` é a do banco no momento em que `df` foi lido: rotular com a
+    # geração atual poderia publicar dados antigos como se fossem novos
+    tabela = pa.Table.from_pandas(df.reset_index(), preserve_index=False)
+    ultimo_id = int(df.index.max()) if not df.empty else 0
+    tabela = tabela.replace_schema_metadata({'geracao': str(geracao), 'ultimo_id': str(ultimo_id)})
+
+    # Grava em arquivo temporário exclusivo e troca de uma vez: o snapshot
+    # nunca fica pela metade, mesmo com dois processos gravando
+    arquivo = caminho_snapshot(caminho)
+    descritor, temporario = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(arquivo)), suffix='.tmp')
+    os.close(descritor)
+    try:
+        feather.write_feather(tabela, temporario, compression='uncompressed')
+        os.replace(temporario, arquivo)
+    except BaseException:
+        os.remove(temporario)
+        raise
+
+
+def _concatenar(base, novas):
+    if novas.empty:
+        return base
+    if base.empty:
+        return novas
+    return aplicar_schema(pd.concat([base, novas]))
+
+
+def _ler_historico(caminho, colunas):
+    # Lê o snapshot colunar (mapeado em memória) e completa com as linhas
+    # inseridas no SQLite depois dele. Devolve também se o snapshot deve ser
+    # regravado e a geração lida antes dos dados.
+    if USE_ARROW:
+        with etapa('ler_snapshot'):
+            snapshot = _ler_snapshot(caminho, colunas)
+        if snapshot is not None:
+            df, ultimo_id, geracao = snapshot
+            with etapa('ler_sqlite'):
+                novas = _ler_banco(caminho, colunas, ultimo_id)
+            return _concatenar(df, novas), len(novas) > LIMIAR_SNAPSHOT, geracao
+    with etapa('ler_sqlite'):
+        with conectar(caminho) as con:
+            geracao = _geracao(con)
+        return _ler_banco(caminho, colunas), USE_ARROW, geracao
+
+
+def _com_versao(df, geracao):
+    df.attrs['versao'] = (geracao, int(df.index.max()) if len(df) else 0)
+    return df
+
+
+def _linhas_para_df(pendentes):
+    ids = [i for i, _ in pendentes]
+    df = pd.DataFrame([linha for _, linha in pendentes], columns=COLUNAS_HISTORICO, index=ids)
+    return aplicar_schema(df)
+
+
+def _consolidar(entrada):
+    # Aplica ao DataFrame do cache as inserções e ajustes de variação feitos
+    # desde a última leitura
+    if entrada['pendentes'] or entrada['atualizacoes']:
+        df = _concatenar(entrada['df'], _linhas_para_df(entrada['pendentes']))
+        for id_linha, var_ton, var_pct in entrada['atualizacoes']:
+            df.loc[id_linha, COLUNAS_VARIACAO] = [var_ton, var_pct]
+        entrada['df'] = _com_versao(df, entrada['geracao'])
+        entrada['pendentes'] = []
+        entrada['atualizacoes'] = []
+
+
+def load_data(caminho=DB_FILE, colunas=None):
+    # O DataFrame devolvido é compartilhado entre as sessões: não deve ser
+    # alterado no lugar. O arquivo só é relido quando a assinatura muda.
+    # Com `colunas`, só as colunas pedidas são lidas (se o cache ainda não
+    # estiver carregado).
+    if not os.path.exists(caminho):
+        return get_empty_df(colunas)
+
+    with _trava_cache:
+        assinatura = _assinatura(caminho)
+        entrada = _cache.get(caminho)
+        if entrada is None or entrada['assinatura'] != assinatura:
+            if colunas is not None:
+                df, _, geracao = _ler_historico(caminho, list(colunas))
+                return _com_versao(df, geracao)
+            df, regravar, geracao = _ler_historico(caminho, COLUNAS_HISTORICO)
+            if regravar:
+                with etapa('gravar_snapshot'):
+                    _gravar_snapshot(caminho, df, geracao)
+            entrada = {'assinatura': assinatura, 'df': _com_versao(df, geracao), 'geracao': geracao,
+                       'pendentes': [], 'atualizacoes': []}
+            _cache[caminho] = entrada
+        else:
+            with etapa('consolidar_cache'):
+                _consolidar(entrada)
+
+        if colunas is not None:
+            return entrada['df'][list(colunas)]
+        return entrada['df']
+
+
+def _inserir_com_variacao(con, linha):
+    # Insere uma medição calculando a variação a partir da leitura anterior da
+    # mesma pilha. Se a medição for retroativa, a leitura seguinte passa a ter
+    # esta como anterior e é a única outra linha recalculada.
+    registro = dict(zip(COLUNAS, linha))
+    data, pilha, peso = registro['Data'], registro['Pilha_ID'], registro['Peso_Teorico_Ton']
+
+    _verificar_aberto(con, [data])
+    anterior = con.execute(
+        'SELECT Peso_Teorico_Ton FROM medicoes WHERE Pilha_ID = ? AND Data <= ? '
+        'ORDER BY Data DESC, id DESC LIMIT 1', (pilha, data)).fetchone()
+    if anterior is None:
+        anterior = con.execute('SELECT Peso_Teorico_Ton FROM ultimas_arquivadas WHERE Pilha_ID = ?',
+                               (pilha,)).fetchone()
+    peso_anterior = anterior[0] if anterior else None
+    var_ton, var_pct = _variacao(peso, peso_anterior)
+    id_novo = con.execute(
+        _sql_insert(COLUNAS_HISTORICO), linha + (var_ton, var_pct)).lastrowid
+
+    # O estoque passa a contar esta leitura no lugar da anterior da pilha
+    mensal, diario, calibracao = _contribuicoes(pd.DataFrame([registro]), [peso - (peso_anterior or 0.0)])
+
+    atualizacoes = []
+    seguinte = con.execute(
+        'SELECT id, Peso_Teorico_Ton, Tipo_Madeira, Data FROM medicoes WHERE Pilha_ID = ? AND Data > ? '
+        'ORDER BY Data, id LIMIT 1', (pilha, data)).fetchone()
+    if seguinte:
+        seg_ton, seg_pct = _variacao(seguinte[1], peso)
+        con.execute('UPDATE medicoes SET Var_Anterior_Ton = ?, Var_Anterior_Pct = ? WHERE id = ?',
+                    (seg_ton, seg_pct, seguinte[0]))
+        _incrementar_geracao(con)
+        atualizacoes.append((seguinte[0], seg_ton, seg_pct))
+        # A leitura seguinte passa a descontar esta, e não mais a anterior
+        ajuste = pd.DataFrame([[seguinte[2], seguinte[3], 0, 0.0, 0, 0.0, (peso_anterior or 0.0) - peso]],
+                              columns=CHAVE_DIARIA + SOMAS_DIARIAS)
+        diario = pd.concat([diario, ajuste]).groupby(CHAVE_DIARIA, as_index=False)[SOMAS_DIARIAS].sum()
+    _somar_agregados(con, mensal, diario, calibracao)
+
+    return id_novo, linha + (var_ton, var_pct), atualizacoes
+
+
+def inserir_medicao(medicao, caminho=DB_FILE):
+    linha = _para_linhas(pd.DataFrame([medicao]))[0]
+
+    with _trava_escrita:
+        with transacao_escrita(caminho) as con:
+            assinatura_antes = _assinatura(caminho)
+            id_novo, linha, atualizacoes = _inserir_com_variacao(con, linha)
+            geracao = _geracao(con)
+
+        # Atualiza o cache no lugar se ninguém mais escreveu no arquivo desde a
+        # última leitura; caso contrário a próxima leitura recarrega tudo.
+        with _trava_cache:
+            entrada = _cache.get(caminho)
+            assinatura_depois = _assinatura(caminho)
+            if (entrada is not None and entrada['assinatura'] == assinatura_antes
+                    and assinatura_depois[2] == assinatura_antes[2] + 1):
+                entrada['pendentes'].append((id_novo, linha))
+                entrada['atualizacoes'].extend(atualizacoes)
+                entrada['assinatura'] = assinatura_depois
+                entrada['geracao'] = geracao
+
+
+def inserir_lote(df, caminho=DB_FILE):
+    # Grava um lote inteiro em uma única transação e recalcula as variações
+    # apenas das pilhas envolvidas
+    if df.empty:
+        return 0
+    linhas = _para_linhas(df)
+
+    with transacao_escrita(caminho) as con:
+        _verificar_aberto(con, [linha[0] for linha in linhas])
+        primeiro_id_novo = con.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM medicoes').fetchone()[0]
+        con.executemany(_sql_insert(), linhas)
+        recalcular_variacoes(con, df['Pilha_ID'].astype(str).unique(), primeiro_id_novo)
+    return len(linhas)
+
+
+def atualizar_medicoes(df, colunas, caminho=DB_FILE, versao=None):
+    # Regrava `colunas` das medições do `df` (indexado por id) em uma única
+    # transação. Se o peso teórico mudar sem que as variações venham junto,
+    # elas são recalculadas no banco para as pilhas envolvidas. Com `versao`
+    # (de versao_dados), falha com ConflitoVersao se o banco mudou depois da
+    # leitura em que os valores foram calculados.
+    if df.empty:
+        return 0
+    colunas = list(colunas)
+    atribuicoes = ', '.join(f'{c} = ?' for c in colunas)
+    valores = zip(*(df[c].to_numpy().tolist() for c in colunas), df.index.tolist())
+    recalcular = 'Peso_Teorico_Ton' in colunas and not set(COLUNAS_VARIACAO) <= set(colunas)
+
+    with _trava_escrita:
+        with transacao_escrita(caminho) as con:
+            if versao is not None and versao_atual(con) != tuple(versao):
+                raise ConflitoVersao('O histórico foi alterado por outra gravação; releia os dados e tente de novo.')
+            assinatura_antes = _assinatura(caminho)
+            con.executemany(f'UPDATE medicoes SET {atribuicoes} WHERE id = ?', valores)
+            if recalcular:
+                recalcular_variacoes(con, df['Pilha_ID'].astype(str).unique())
+            if set(colunas) & set(COLUNAS_AGREGADAS):
+                reconstruir_agregados(con)
+            _incrementar_geracao(con)
+            geracao = _geracao(con)
+
+        # Com o cache em dia, aplica a atualização nele e regrava o snapshot,
+        # evitando reler o histórico inteiro do SQLite na próxima consulta
+        with _trava_cache:
+            entrada = _cache.get(caminho)
+            assinatura_depois = _assinatura(caminho)
+            if (not recalcular and entrada is not None and entrada['assinatura'] == assinatura_antes
+                    and assinatura_depois[2] == assinatura_antes[2] + 1):
+                _consolidar(entrada)
+                # O DataFrame em cache é lido por outras sessões: as colunas
+                # alteradas são copiadas antes da escrita e trocadas inteiras
+                atual = entrada['df'].copy(deep=False)
+                for c in colunas:
+                    coluna = atual[c].copy()
+                    coluna.loc[df.index] = df[c].astype(coluna.dtype).to_numpy()
+                    atual[c] = coluna
+                entrada['df'] = _com_versao(aplicar_schema(atual), geracao)
+                entrada['assinatura'] = assinatura_depois
+                entrada['geracao'] = geracao
+                if USE_ARROW:
+                    _gravar_snapshot(caminho, entrada['df'], geracao)
+            else:
+                _cache.pop(caminho, None)
+    return len(df)
@@ -0,0 +1,49 @@
+# Benchmark do motor de cálculo vetorizado (calculos.py).
+#
+# Uso: python benchmarks/bench_calculos.py [linhas ...]   (padrão: 100000 1000000 10000000)
+
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+from calculos import calcular, densidade_padrao, fator_padrao  # noqa: E402
+from parametros import ESPECIES  # noqa: E402
+
+
+def gerar_entradas(n, semente=42):
+    rng = np.random.default_rng(semente)
+    # Espécies como categoria, do mesmo jeito que vêm do histórico carregado
+    especies = pd.Categorical.from_codes(rng.integers(0, len(ESPECIES), n), categories=ESPECIES)
+    meses = rng.integers(1, 13, n)
+    volume = rng.uniform(200, 3000, n)
+    tickets = np.where(rng.random(n) < 0.6, rng.uniform(100, 1500, n), 0.0)
+    return especies, meses, volume, tickets
+
+
+def cronometrar(funcao, repeticoes=3):
+    melhor = float('inf')
+    for _ in range(repeticoes):
+        inicio = time.perf_counter()
+        funcao()
+        melhor = min(melhor, time.perf_counter() - inicio)
+    return melhor
+
+
+def main(tamanhos):
+    print(f"{'linhas':>10} {'parâmetros (s)':>15} {'cálculo (s)':>12} {'Mlinhas/s':>10}")
+    for n in tamanhos:
+        especies, meses, volume, tickets = gerar_entradas(n)
+        t_parametros = cronometrar(lambda: (fator_padrao(especies), densidade_padrao(meses, especies)))
+        fator, densidade = fator_padrao(especies), densidade_padrao(meses, especies)
+        t_calculo = cronometrar(lambda: calcular(volume, fator, densidade, tickets))
+        print(f"{n:>10} {t_parametros:>15.3f} {t_calculo:>12.3f} {n / t_calculo / 1e6:>10.1f}")
+
+
+if __name__ == '__main__':
+    main([int(a) for a in sys.argv[1:]] or [100000, 1000000, 10000000])
@@ -0,0 +1,63 @@
+# Benchmark da geração do relatório PDF para seleções grandes.
+#
+# Uso: python benchmarks/bench_pdf.py [linhas ...]   (padrão: 1000 10000 20000)
+
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+os.chdir(RAIZ)
+
+from relatorios import criar_pdf  # noqa: E402
+
+
+def gerar_linhas(n, semente=42):
+    rng = np.random.default_rng(semente)
+    volume = rng.uniform(200, 3000, n)
+    densidade = rng.choice([520.0, 740.0], n)
+    peso = volume * 0.62 * densidade / 1000
+    tickets = np.where(rng.random(n) < 0.6, peso * rng.normal(1, 0.08, n), 0)
+    erro_pct = np.where(tickets > 0, (peso - tickets) / np.where(tickets > 0, tickets, 1) * 100, 0)
+    return pd.DataFrame({
+        'Data': pd.Timestamp('2024-01-01') + pd.to_timedelta(rng.integers(0, 365, n), 'D'),
+        'Pilha_ID': pd.Categorical([f'P{i:04d}' for i in rng.integers(0, 800, n)]),
+        'Tipo_Madeira': pd.Categorical(np.where(densidade < 600, 'Pinus', 'Eucalipto')),
+        'Volume_Drone_Estereo': volume,
+        'Densidade_Aplicada': densidade,
+        'Peso_Teorico_Ton': peso.round(2),
+        'Peso_Tickets_Ton': tickets.round(2),
+        'Erro_Percentual': erro_pct.round(2),
+        'Var_Anterior_Pct': rng.normal(0, 5, n),
+    })
+
+
+def medir(df):
+    # Tempo e pico de memória em passadas separadas: o tracemalloc deixa o
+    # código bem mais lento
+    with open(os.devnull, 'wb') as destino:
+        inicio = time.perf_counter()
+        criar_pdf(df, destino)
+        duracao = time.perf_counter() - inicio
+
+        tracemalloc.start()
+        criar_pdf(df, destino)
+        pico = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return duracao, pico
+
+
+def main(tamanhos):
+    print(f"{'linhas':>8} {'tempo (s)':>10} {'linhas/s':>10} {'pico (MB)':>10}")
+    for n in tamanhos:
+        duracao, pico = medir(gerar_linhas(n))
+        print(f"{n:>8} {duracao:>10.2f} {n / duracao:>10.0f} {pico / 1e6:>10.1f}")
+
+
+if __name__ == '__main__':
+    main([int(a) for a in sys.argv[1:]] or [1000, 10000, 20000])
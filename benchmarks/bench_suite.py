@@ -0,0 +1,289 @@
+# Suíte de benchmarks das etapas principais do app sobre históricos sintéticos
+# (gerador_patio.py): gravação, carga do histórico, variações, derivação do
+# dashboard, indicadores, exportação em PDF e CSV e a geração pela linha de
+# comando (gerar_relatorios.py). Mede o tempo (melhor de algumas repetições)
+# e o pico de memória de cada etapa. Os resultados vão para um JSON que pode
+# ser comparado com o de outra versão do código.
+#
+# Uso: python benchmarks/bench_suite.py [--linhas 1000 10000 ...] [--etapas carga pdf ...]
+#                                        [--saida resultados.json] [--comparar anterior.json]
+
+import argparse
+import glob
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+import agregados  # noqa: E402
+import armazenamento  # noqa: E402
+from armazenamento import calcular_variacoes, caminho_snapshot, inserir_lote, inserir_medicao, load_data  # noqa: E402
+from consultas import IndiceMedicoes, Selecao, pagina  # noqa: E402
+from gerador_patio import gerar_historico  # noqa: E402
+from graficos import _montar_figura  # noqa: E402
+from relatorios import criar_csv, criar_pdf  # noqa: E402
+
+TAMANHOS_PADRAO = [1000, 10000, 100000, 1000000]
+INSERCOES_AVULSAS = 20
+TOLERANCIA_PADRAO = 0.2
+
+
+def _limpar_cache():
+    armazenamento._cache.clear()
+
+
+def _remover(arquivo):
+    if os.path.exists(arquivo):
+        os.remove(arquivo)
+
+
+class Cenario:
+    # Banco temporário com o histórico gerado; cada etapa devolve uma função
+    # sem argumentos (a parte medida) e, opcionalmente, um preparo anterior
+    def __init__(self, pasta, historico):
+        self.pasta, self.historico = pasta, historico
+        self.banco = os.path.join(pasta, 'estoque.db')
+        self.avulsas = gerar_historico(INSERCOES_AVULSAS, pilhas=5, semente=7).to_dict('records')
+        self.df = None
+
+    def _banco_novo(self):
+        _limpar_cache()
+        for arquivo in (self.banco, caminho_snapshot(self.banco)):
+            _remover(arquivo)
+
+    def gravacao_lote(self):
+        return self._banco_novo, lambda: inserir_lote(self.historico, self.banco)
+
+    def gravacao_avulsa(self):
+        # Latência total de INSERCOES_AVULSAS inserções, com o cache carregado
+        def preparo():
+            self.gravacao_lote()[1]()
+            load_data(self.banco)
+        return preparo, lambda: [inserir_medicao(m, self.banco) for m in self.avulsas]
+
+    def carga_sqlite(self):
+        def preparo():
+            _limpar_cache()
+            _remover(caminho_snapshot(self.banco))
+        return preparo, lambda: load_data(self.banco)
+
+    def carga_snapshot(self):
+        def preparo():
+            _limpar_cache()
+            load_data(self.banco)
+            _limpar_cache()
+        return preparo, lambda: load_data(self.banco)
+
+    def variacoes(self):
+        return None, lambda: calcular_variacoes(self.df[['Pilha_ID', 'Data', 'Peso_Teorico_Ton']])
+
+    def dashboard(self):
+        # O que uma execução do dashboard deriva do histórico: índice, filtro,
+        # página, seleção de tudo e gráficos por espécie (sem os caches)
+        def derivar():
+            indice = IndiceMedicoes(self.df)
+            ids = indice.filtrar()
+            pagina(self.df, ids, 1, 100)
+            selecao = Selecao(ids)
+            selecionados = self.df.loc[indice.ids[selecao.contem(indice.ids)]]
+            for especie in ('Pinus', 'Eucalipto'):
+                _montar_figura(selecionados[selecionados['Tipo_Madeira'] == especie], especie)
+            return selecionados
+        return None, derivar
+
+    def kpi_selecao(self):
+        # Indicadores do topo do dashboard, sobre a seleção inteira
+        def indicadores():
+            com_ticket = self.df[self.df['Peso_Tickets_Ton'] > 0]
+            return (self.df['Volume_Drone_Estereo'].sum(), self.df['Peso_Teorico_Ton'].sum(),
+                    com_ticket['Erro_Percentual'].abs().mean())
+        return None, indicadores
+
+    def kpi_agregados(self):
+        # Cubo dos agregados montado do zero e uma consulta com filtro
+        def preparo():
+            agregados._cache.clear()
+        return preparo, lambda: agregados.carregar_agregados(self.banco).indicadores(
+            especies=['Pinus'], prefixo_pilha='PTO-0')
+
+    def pdf(self):
+        def gerar():
+            with open(os.devnull, 'wb') as destino:
+                criar_pdf(self.df, destino)
+        return None, gerar
+
+    def csv(self):
+        def gerar():
+            with open(os.devnull, 'w', encoding='utf-8', newline='') as destino:
+                criar_csv(self.df, destino)
+        return None, gerar
+
+    def relatorios_cli(self):
+        # gerar_relatorios.py com dois processos, um CSV por espécie e mês (o
+        # pico de memória medido é só o deste processo). Falha se a execução
+        # deixar pastas de relatórios na pasta temporária.
+        def gerar():
+            antes = set(glob.glob(os.path.join(tempfile.gettempdir(), 'relatorios_arauco_*')))
+            subprocess.run([sys.executable, os.path.join(RAIZ, 'gerar_relatorios.py'), '--banco', self.banco,
+                            '--saida', os.path.join(self.pasta, 'relatorios'), '--formato', 'csv',
+                            '--dividir', 'especie', 'mes', '--processos', '2'],
+                           check=True, stdout=subprocess.DEVNULL)
+            sobras = set(glob.glob(os.path.join(tempfile.gettempdir(), 'relatorios_arauco_*'))) - antes
+            if sobras:
+                raise RuntimeError(f'gerar_relatorios.py deixou pastas temporárias: {sorted(sobras)}')
+        return None, gerar
+
+
+ETAPAS = ['gravacao_lote', 'gravacao_avulsa', 'carga_sqlite', 'carga_snapshot', 'variacoes', 'dashboard',
+          'kpi_selecao', 'kpi_agregados', 'pdf', 'csv', 'relatorios_cli']
+
+
+def _status_kb(campo):
+    with open('/proc/self/status') as status:
+        for linha in status:
+            if linha.startswith(campo):
+                return int(linha.split()[1])
+
+
+def _zerar_pico():
+    # Zera o pico de memória residente do processo (VmHWM), no Linux
+    try:
+        with open('/proc/self/clear_refs', 'w') as arquivo:
+            arquivo.write('5')
+        return True
+    except OSError:
+        return False
+
+
+MEDE_RSS = _zerar_pico()
+
+
+def medir(preparo, funcao, repeticoes, memoria):
+    # No Linux o pico é o da memória residente acima da do início da etapa,
+    # medido na mesma passada do tempo. Nos outros sistemas, uma passada
+    # separada com tracemalloc (bem mais lenta, e só vê o que passa pelo
+    # alocador do Python e do numpy).
+    melhor, pico = float('inf'), None
+    for _ in range(repeticoes):
+        if preparo is not None:
+            preparo()
+        if memoria and MEDE_RSS:
+            _zerar_pico()
+            base = _status_kb('VmRSS')
+        inicio = time.perf_counter()
+        funcao()
+        melhor = min(melhor, time.perf_counter() - inicio)
+        if memoria and MEDE_RSS:
+            pico = max(pico or 0, (_status_kb('VmHWM') - base) * 1024)
+
+    if memoria and not MEDE_RSS:
+        if preparo is not None:
+            preparo()
+        tracemalloc.start()
+        funcao()
+        pico = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return melhor, pico
+
+
+def rodar(tamanhos, etapas, memoria=True, semente=42):
+    resultados = []
+    for n in tamanhos:
+        # Menos repetições nos tamanhos grandes, onde o ruído pesa pouco
+        repeticoes = 3 if n <= 100000 else 1
+        with tempfile.TemporaryDirectory() as pasta:
+            cenario = Cenario(pasta, gerar_historico(n, semente=semente))
+            # As etapas de leitura e derivação usam o banco já gravado
+            cenario.gravacao_lote()[0]()
+            inserir_lote(cenario.historico, cenario.banco)
+            cenario.df = load_data(cenario.banco)
+
+            for etapa in etapas:
+                preparo, funcao = getattr(cenario, etapa)()
+                segundos, pico = medir(preparo, funcao, repeticoes, memoria)
+                resultados.append({'linhas': n, 'etapa': etapa, 'segundos': round(segundos, 6),
+                                   'pico_mb': round(pico / 1e6, 2) if pico is not None else None})
+                print(f"{n:>9} {etapa:<16} {segundos:>10.3f} s"
+                      + (f" {pico / 1e6:>10.1f} MB" if pico is not None else ''), flush=True)
+            _limpar_cache()
+    return resultados
+
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=RAIZ, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def ambiente():
+    return {
+        'data': datetime.now().isoformat(timespec='seconds'),
+        'commit': _commit(),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'maquina': platform.platform(),
+        'processador': platform.processor() or platform.machine(),
+        'cpus': os.cpu_count(),
+        'memoria': 'rss' if MEDE_RSS else 'tracemalloc',
+    }
+
+
+def comparar(atuais, anteriores, tolerancia=TOLERANCIA_PADRAO):
+    # Razão tempo atual / anterior por (linhas, etapa); devolve as regressões
+    base = {(r['linhas'], r['etapa']): r for r in anteriores}
+    regressoes = []
+    print(f"\n{'linhas':>9} {'etapa':<16} {'antes (s)':>10} {'agora (s)':>10} {'razão':>7}")
+    for r in atuais:
+        anterior = base.get((r['linhas'], r['etapa']))
+        if anterior is None or not anterior['segundos']:
+            continue
+        razao = r['segundos'] / anterior['segundos']
+        marca = '  REGRESSÃO' if razao > 1 + tolerancia else ''
+        print(f"{r['linhas']:>9} {r['etapa']:<16} {anterior['segundos']:>10.3f} {r['segundos']:>10.3f} "
+              f"{razao:>7.2f}{marca}")
+        if marca:
+            regressoes.append(r)
+    return regressoes
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks das etapas principais do app')
+    parser.add_argument('--linhas', type=int, nargs='+', default=TAMANHOS_PADRAO)
+    parser.add_argument('--etapas', nargs='+', choices=ETAPAS, default=ETAPAS)
+    parser.add_argument('--sem-memoria', action='store_true', help='não mede o pico de memória')
+    parser.add_argument('--saida', help='arquivo JSON com os resultados')
+    parser.add_argument('--comparar', help='JSON de uma execução anterior')
+    parser.add_argument('--tolerancia', type=float, default=TOLERANCIA_PADRAO,
+                        help='aumento de tempo tolerado na comparação (0.2 = 20%%)')
+    args = parser.parse_args(argv)
+
+    print(f"{'linhas':>9} {'etapa':<16} {'tempo':>12}" + ('' if args.sem_memoria else f" {'pico':>13}"))
+    resultados = rodar(args.linhas, args.etapas, memoria=not args.sem_memoria)
+    if args.saida:
+        with open(args.saida, 'w', encoding='utf-8') as arquivo:
+            json.dump({'ambiente': ambiente(), 'resultados': resultados}, arquivo, ensure_ascii=False, indent=2)
+
+    if args.comparar:
+        with open(args.comparar, encoding='utf-8') as arquivo:
+            anteriores = json.load(arquivo)['resultados']
+        if comparar(resultados, anteriores, args.tolerancia):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
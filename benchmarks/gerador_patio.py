@@ -0,0 +1,101 @@
+# Gerador de históricos sintéticos do pátio para benchmarks e testes de carga.
+#
+# Cada pilha tem uma espécie fixa e é medida várias vezes ao longo dos anos,
+# com volume em passeio aleatório (entradas e expedições). A densidade
+# aplicada é a da tabela DENSIDADE_MENSAL; a real varia em torno dela, dentro
+# da faixa anual da espécie, e define o peso de balança das medições com ticket.
+#
+# Uso: python benchmarks/gerador_patio.py linhas banco.db [--pilhas N] [--anos N] [--tickets 0.6]
+
+import argparse
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+from armazenamento import COLUNAS  # noqa: E402
+from calculos import calcular, densidade_padrao, fator_padrao  # noqa: E402
+from parametros import DENSIDADE_MENSAL, ESPECIES  # noqa: E402
+
+MISTURA_PADRAO = {'Pinus': 0.6, 'Eucalipto': 0.4}
+
+
+def faixa_densidade(especie):
+    valores = [meses[especie] for meses in DENSIDADE_MENSAL.values()]
+    return min(valores), max(valores)
+
+
+def gerar_historico(linhas, pilhas=None, anos=3, mistura=None, cobertura_tickets=0.6,
+                    inicio='2022-01-01', semente=42):
+    # DataFrame com as colunas gravadas (COLUNAS), em ordem cronológica
+    rng = np.random.default_rng(semente)
+    pilhas = pilhas or max(20, linhas // 250)
+    mistura = mistura or MISTURA_PADRAO
+    especies_mistura = list(mistura)
+    pesos = np.array([mistura[e] for e in especies_mistura], dtype=float)
+
+    # Espécie fixa por pilha; medições distribuídas entre as pilhas
+    especie_pilha = rng.choice(especies_mistura, pilhas, p=pesos / pesos.sum())
+    pilha = rng.integers(0, pilhas, linhas)
+    dias = rng.integers(0, int(365.25 * anos), linhas)
+    ordem = np.lexsort((dias, pilha))
+    pilha, dias = pilha[ordem], dias[ordem]
+
+    # Volume por pilha em passeio aleatório, recomeçando a cada pilha
+    passos = rng.normal(0, 150, linhas)
+    primeira = np.r_[True, pilha[1:] != pilha[:-1]]
+    passos[primeira] = rng.uniform(500, 2500, primeira.sum())
+    acumulado = np.cumsum(passos)
+    inicios = np.flatnonzero(primeira)
+    base = np.repeat(acumulado[inicios] - passos[inicios], np.diff(np.r_[inicios, linhas]))
+    volume = np.clip(acumulado - base, 100, 4000)
+
+    datas = pd.Timestamp(inicio) + pd.to_timedelta(dias, unit='D')
+    especies = pd.Categorical(especie_pilha[pilha], categories=ESPECIES)
+    meses = datas.month.to_numpy()
+    densidade = densidade_padrao(meses, especies)
+    fator = fator_padrao(especies)
+
+    # Densidade real em torno da tabela, limitada à faixa anual da espécie
+    minimo = np.array([faixa_densidade(e)[0] for e in ESPECIES])[especies.codes]
+    maximo = np.array([faixa_densidade(e)[1] for e in ESPECIES])[especies.codes]
+    densidade_real = np.clip(densidade * rng.normal(1, 0.05, linhas), minimo * 0.95, maximo * 1.05)
+    com_ticket = rng.random(linhas) < cobertura_tickets
+    tickets = np.where(com_ticket, np.round(volume * fator * densidade_real / 1000, 1), 0.0)
+
+    df = pd.DataFrame({
+        'Data': datas,
+        'Pilha_ID': np.char.mod('PTO-%05d', pilha).astype(object),
+        'Tipo_Madeira': especies.astype(str),
+        'Volume_Drone_Estereo': np.round(volume, 1),
+        'Densidade_Aplicada': densidade,
+        'Fator_Teorico': fator,
+        'Peso_Tickets_Ton': tickets,
+        'Versao_Parametros': 1,
+        'Densidade_Manual': False,
+    })
+    df = df.assign(**calcular(df['Volume_Drone_Estereo'].to_numpy(), fator, densidade, tickets))
+    return df.sort_values('Data', kind='stable', ignore_index=True)[COLUNAS]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Gera um banco com histórico sintético do pátio')
+    parser.add_argument('linhas', type=int)
+    parser.add_argument('banco')
+    parser.add_argument('--pilhas', type=int)
+    parser.add_argument('--anos', type=int, default=3)
+    parser.add_argument('--tickets', type=float, default=0.6, help='fração das medições com ticket')
+    parser.add_argument('--semente', type=int, default=42)
+    args = parser.parse_args(argv)
+
+    from armazenamento import inserir_lote
+    df = gerar_historico(args.linhas, args.pilhas, args.anos, cobertura_tickets=args.tickets, semente=args.semente)
+    print(f'{inserir_lote(df, args.banco):,} medições gravadas em {args.banco}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+# Teste de carga das gravações concorrentes (armazenamento.py): várias threads
+# (sessões do Streamlit) e processos gravando no mesmo banco. Confere que
+# nenhuma linha se perde, que variações e agregados incrementais batem com um
+# recálculo completo, que o cache em memória bate com uma leitura do disco e
+# que uma atualização baseada em leitura velha é recusada.
+#
+# Uso: python benchmarks/stress_escrita.py [threads] [medições por thread] [processos]   (padrão: 8 50 2)
+
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+import armazenamento  # noqa: E402
+from armazenamento import (ConflitoVersao, atualizar_medicoes, conectar, inicializar, inserir_lote,  # noqa: E402
+                           inserir_medicao, load_data, recalcular_variacoes, reconstruir_agregados, versao_dados)
+from calculos import calcular_df  # noqa: E402
+
+TAMANHO_LOTE = 20
+
+
+def gerar_medicoes(n, prefixo, semente):
+    # Poucas pilhas por gravador e datas fora de ordem, para exercitar as
+    # inserções retroativas
+    rng = np.random.default_rng(semente)
+    df = pd.DataFrame({
+        'Data': pd.Timestamp('2024-01-01') + pd.to_timedelta(rng.integers(0, 365, n), unit='D'),
+        'Pilha_ID': [f'{prefixo}-P{i}' for i in rng.integers(0, 5, n)],
+        'Tipo_Madeira': rng.choice(['Pinus', 'Eucalipto'], n),
+        'Volume_Drone_Estereo': rng.uniform(200, 3000, n).round(1),
+        'Densidade_Aplicada': 0.5,
+        'Fator_Teorico': 0.65,
+        'Peso_Tickets_Ton': np.where(rng.random(n) < 0.5, rng.uniform(100, 900, n).round(1), 0.0),
+        'Versao_Parametros': 1,
+        'Densidade_Manual': False,
+    })
+    df = calcular_df(df)
+    # Cada medição leva um marcador único no volume para conferir perdas
+    return df.assign(Volume_Drone_Estereo=df['Volume_Drone_Estereo'] + np.arange(n) * 1e-4)
+
+
+def gravador(caminho, prefixo, n, semente):
+    # Parte das medições em lotes, intercalados com as inserções avulsas
+    medicoes = gerar_medicoes(n, prefixo, semente)
+    corte = n // 2 // TAMANHO_LOTE * TAMANHO_LOTE
+    lotes = [medicoes.iloc[i:i + TAMANHO_LOTE] for i in range(0, corte, TAMANHO_LOTE)]
+    for i, medicao in enumerate(medicoes.iloc[corte:].to_dict('records')):
+        inserir_medicao(medicao, caminho)
+        # Leituras entre as gravações, como faz o dashboard
+        load_data(caminho)
+        if lotes and i % 5 == 4:
+            inserir_lote(lotes.pop(), caminho)
+    for lote in lotes:
+        inserir_lote(lote, caminho)
+    return n
+
+
+def _gravador_processo(argumentos):
+    return gravador(*argumentos)
+
+
+def conferir(caminho, esperado):
+    with conectar(caminho) as con:
+        total = con.execute('SELECT COUNT(*) FROM medicoes').fetchone()[0]
+        assert total == esperado, f'{total} linhas gravadas, {esperado} esperadas'
+
+        # Variações mantidas incrementalmente = recálculo completo
+        con.execute('BEGIN IMMEDIATE')
+        alteradas = recalcular_variacoes(con)
+        con.rollback()
+        assert not alteradas, f'{alteradas} variações divergentes'
+
+        # Agregados incrementais = reconstrução completa
+        tabelas = ('agregados_mensais', 'agregados_diarios', 'calibracao')
+        consultas = {t: f'SELECT * FROM {t} ORDER BY 1, 2, 3' for t in tabelas}
+        antes = {t: pd.read_sql_query(q, con).drop(columns='seq', errors='ignore') for t, q in consultas.items()}
+        con.execute('BEGIN IMMEDIATE')
+        reconstruir_agregados(con)
+        depois = {t: pd.read_sql_query(q, con).drop(columns='seq', errors='ignore') for t, q in consultas.items()}
+        con.rollback()
+        for tabela in consultas:
+            pd.testing.assert_frame_equal(antes[tabela], depois[tabela], check_exact=False, atol=1e-6,
+                                          obj=tabela)
+
+    # Cache atualizado no lugar = leitura do disco
+    em_cache = load_data(caminho)
+    armazenamento._cache.clear()
+    relido = load_data(caminho)
+    pd.testing.assert_frame_equal(em_cache.sort_index(), relido.sort_index(), check_categorical=False)
+    assert versao_dados(em_cache) == versao_dados(relido)
+
+
+def conferir_conflito(caminho):
+    df = load_data(caminho)
+    alteracao = df.head(3)[['Pilha_ID', 'Densidade_Aplicada']]
+    versao = versao_dados(df)
+
+    inserir_medicao(gerar_medicoes(1, 'CONFLITO', 0).iloc[0].to_dict(), caminho)
+    try:
+        atualizar_medicoes(alteracao, ['Densidade_Aplicada'], caminho, versao=versao)
+    except ConflitoVersao:
+        pass
+    else:
+        raise AssertionError('atualização sobre leitura velha foi aceita')
+
+    # Relida a versão atual, a mesma atualização passa
+    atualizar_medicoes(alteracao, ['Densidade_Aplicada'], caminho, versao=versao_dados(load_data(caminho)))
+
+
+def main(threads, por_thread, processos):
+    with tempfile.TemporaryDirectory() as pasta:
+        caminho = os.path.join(pasta, 'estoque.db')
+        inicializar(caminho, os.path.join(pasta, 'inexistente.json'))
+
+        inicio = time.perf_counter()
+        trabalhos = [threading.Thread(target=gravador, args=(caminho, f'T{i}', por_thread, i))
+                     for i in range(threads)]
+        with ProcessPoolExecutor(processos) as executor:
+            futuros = executor.map(_gravador_processo, [(caminho, f'X{i}', por_thread, 1000 + i)
+                                                        for i in range(processos)])
+            for t in trabalhos:
+                t.start()
+            for t in trabalhos:
+                t.join()
+            list(futuros)
+        duracao = time.perf_counter() - inicio
+
+        esperado = (threads + processos) * por_thread
+        conferir(caminho, esperado)
+        conferir_conflito(caminho)
+        print(f'{threads} threads + {processos} processos x {por_thread} medições: '
+              f'{esperado} linhas em {duracao:.2f}s ({esperado / duracao:.0f}/s), nenhuma perdida')
+
+
+if __name__ == '__main__':
+    argumentos = [int(a) for a in sys.argv[1:]]
+    main(*(argumentos + [8, 50, 2][len(argumentos):]))
@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+
+from parametros import DENSIDADE_MENSAL, ESPECIES, FATOR_ARRUMADO
+
+# ==============================================================================
+# MOTOR DE CÁLCULO (VETORIZADO, SEM INTERFACE)
+# ==============================================================================
+# Mesmas fórmulas do manual metodológico, aplicadas a arrays inteiros:
+#   M_ton  = V_drone * F_e * rho_mes / 1000
+#   F_conv = M_balanca / V_drone
+#   E_%    = (M_drone - M_balanca) / M_balanca * 100
+# Escalares também são aceitos (viram arrays de uma posição).
+
+
+def codigos_especie(especies):
+    # Índice de cada espécie em ESPECIES (-1 se desconhecida). Colunas
+    # categóricas (como as do histórico) só têm as categorias remapeadas.
+    if isinstance(especies, pd.Series):
+        especies = especies.array
+    if isinstance(especies, pd.Categorical):
+        return especies.set_categories(ESPECIES).codes
+    return pd.Categorical(np.asarray(especies, dtype=object).ravel(), categories=ESPECIES).codes
+
+
+def tabela_densidade():
+    # Matriz [mês - 1, espécie] para consulta vetorizada de DENSIDADE_MENSAL
+    return np.array([[DENSIDADE_MENSAL[mes][e] for e in ESPECIES] for mes in range(1, 13)], dtype=float)
+
+
+def densidade_padrao(meses, especies):
+    # Espécie desconhecida fica com NaN (o código -1 indexaria a última coluna)
+    codigo = codigos_especie(especies)
+    conhecida = codigo >= 0
+    densidade = tabela_densidade()[np.asarray(meses, dtype=int) - 1, np.where(conhecida, codigo, 0)]
+    return np.where(conhecida, densidade, np.nan)
+
+
+def fator_padrao(especies):
+    codigo = codigos_especie(especies)
+    conhecida = codigo >= 0
+    fator = np.array([FATOR_ARRUMADO[e] for e in ESPECIES])[np.where(conhecida, codigo, 0)]
+    return np.where(conhecida, fator, np.nan)
+
+
+def peso_teorico(volume, fator_teorico, densidade):
+    return np.asarray(volume, dtype=float) * fator_teorico * densidade / 1000
+
+
+def calcular(volume, fator_teorico, densidade, peso_tickets):
+    # Devolve um dict coluna -> array, já arredondado como é gravado
+    volume = np.atleast_1d(np.asarray(volume, dtype=float))
+    tickets = np.atleast_1d(np.asarray(peso_tickets, dtype=float))
+    peso = peso_teorico(volume, fator_teorico, densidade)
+
+    com_ticket = tickets > 0
+    divisor = np.where(com_ticket, tickets, 1.0)
+    erro_ton = np.where(com_ticket, peso - tickets, 0.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fator_real = np.where(com_ticket, tickets / volume, 0.0)
+
+    return {
+        'Peso_Teorico_Ton': np.round(peso, 2),
+        'Fator_Conversao_Real': np.round(fator_real, 4),
+        'Erro_Ton': np.round(erro_ton, 2),
+        'Erro_Percentual': np.round(erro_ton / divisor * 100, 2),
+    }
+
+
+def calcular_df(df):
+    # Recalcula as colunas derivadas a partir de volume, fator, densidade e
+    # peso de balança de cada linha
+    resultado = calcular(df['Volume_Drone_Estereo'].to_numpy(), df['Fator_Teorico'].to_numpy(),
+                         df['Densidade_Aplicada'].to_numpy(), df['Peso_Tickets_Ton'].to_numpy())
+    return df.assign(**resultado)
@@ -0,0 +1,100 @@
+import threading
+
+import numpy as np
+import pandas as pd
+
+from armazenamento import CHAVE_CALIBRACAO, DB_FILE, SOMAS_CALIBRACAO, conectar
+from calculos import codigos_especie
+from parametros import ESPECIES
+
+# ==============================================================================
+# CALIBRAÇÃO PELO HISTÓRICO DE TICKETS
+# ==============================================================================
+# Para cada espécie e mês do ano, ajuste por mínimos quadrados (reta pela
+# origem) do peso de balança contra o peso teórico das medições com ticket:
+#   M_balanca ≈ k * M_drone   =>   k = Σ(M_drone * M_balanca) / Σ(M_drone²)
+# As somas de cada grupo ficam na tabela `calibracao`, atualizadas na mesma
+# transação de cada gravação (armazenamento.py): um ticket novo só acrescenta
+# a sua parcela e o ajuste é refeito com 12 x espécies somas, sem reler o
+# histórico. Grupos com menos de MIN_TICKETS usam o fator da espécie em todos
+# os meses; sem tickets suficientes nem assim, k = 1 (sem correção).
+
+MIN_TICKETS = 5
+ORIGENS = np.array(['padrão', 'espécie', 'mês'], dtype=object)
+
+_cache = {}
+_trava = threading.Lock()
+
+
+def _ajustar(somas):
+    # somas[..., (n, pt, pp, tt)] -> (k, erro padrão de k, n) de cada grupo
+    n, pt, pp, tt = np.moveaxis(somas, -1, 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        k = np.where(pp > 0, pt / pp, np.nan)
+        residuo = np.maximum(tt - k * pt, 0.0)
+        erro = np.where(n > 1, np.sqrt(residuo / (n - 1) / pp), np.nan)
+    return k, erro, n
+
+
+class Calibracao:
+    def __init__(self, somas):
+        # somas[mês - 1, espécie, (n, soma_pt, soma_pp, soma_tt)], espécies na ordem de ESPECIES
+        self.somas = somas
+        k_mes, erro_mes, n_mes = _ajustar(somas)
+        k_especie, erro_especie, n_especie = _ajustar(somas.sum(axis=0))
+
+        usa_mes = n_mes >= MIN_TICKETS
+        usa_especie = ~usa_mes & (n_especie >= MIN_TICKETS)
+        # [mês - 1, espécie]: fator de correção, erro padrão, tickets e nível usado
+        self.fator = np.where(usa_mes, k_mes, np.where(usa_especie, k_especie, 1.0))
+        self.erro_padrao = np.where(usa_mes, erro_mes, np.where(usa_especie, erro_especie, np.nan))
+        self.tickets = np.where(usa_mes, n_mes, np.where(usa_especie, n_especie, n_mes)).astype(int)
+        self.origem = usa_mes * 2 + usa_especie
+
+    @classmethod
+    def montar(cls, linhas):
+        # A partir das linhas da tabela `calibracao` (espécies fora de ESPECIES
+        # são ignoradas)
+        somas = np.zeros((12, len(ESPECIES), len(SOMAS_CALIBRACAO)))
+        e = codigos_especie(linhas['Tipo_Madeira'].to_numpy())
+        conhecidas = e >= 0
+        np.add.at(somas, (linhas['Mes'].to_numpy(dtype=int)[conhecidas] - 1, e[conhecidas]),
+                  linhas[SOMAS_CALIBRACAO].to_numpy(dtype=float)[conhecidas])
+        return cls(somas)
+
+    def grupo(self, mes, especie):
+        # (k, erro padrão, tickets, origem) usados para um mês e espécie
+        e = codigos_especie([especie])[0]
+        if e < 0:
+            return 1.0, np.nan, 0, ORIGENS[0]
+        return (float(self.fator[mes - 1, e]), float(self.erro_padrao[mes - 1, e]), int(self.tickets[mes - 1, e]),
+                ORIGENS[self.origem[mes - 1, e]])
+
+    def tabela(self):
+        # Uma linha por (mês, espécie), para exibição
+        meses, e = np.divmod(np.arange(12 * len(ESPECIES)), len(ESPECIES))
+        return pd.DataFrame({
+            'Mês': meses + 1,
+            'Tipo_Madeira': np.array(ESPECIES, dtype=object)[e],
+            'Fator_Correcao': self.fator.ravel(),
+            'Erro_Padrao': self.erro_padrao.ravel(),
+            'Tickets': self.tickets.ravel(),
+            'Origem': ORIGENS[self.origem.ravel()],
+        })
+
+
+def carregar_calibracao(caminho=DB_FILE):
+    # Compartilhada entre as sessões; refeita só quando os agregados mudam
+    # (mesmo estado usado por carregar_agregados)
+    with _trava:
+        with conectar(caminho) as con:
+            estado = con.execute("SELECT valor FROM meta WHERE chave IN ('agregados_geracao', 'agregados_seq') "
+                                 "ORDER BY chave").fetchall()
+            entrada = _cache.get(caminho)
+            if entrada is not None and entrada['estado'] == estado:
+                return entrada['calibracao']
+
+            linhas = pd.read_sql_query(f'SELECT {", ".join(CHAVE_CALIBRACAO + SOMAS_CALIBRACAO)} FROM calibracao', con)
+            calibracao = Calibracao.montar(linhas)
+            _cache[caminho] = {'estado': estado, 'calibracao': calibracao}
+            return calibracao
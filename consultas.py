@@ -0,0 +1,152 @@
+import threading
+import weakref
+
+import numpy as np
+import pandas as pd
+
+# ==============================================================================
+# ÍNDICES EM MEMÓRIA PARA FILTRO E PAGINAÇÃO DO HISTÓRICO
+# ==============================================================================
+# O histórico carregado é compartilhado entre as sessões, então os índices são
+# montados uma vez por versão do DataFrame e reaproveitados por todas elas.
+# As linhas ficam na ordem de exibição do dashboard (Data decrescente, Pilha_ID
+# crescente): um intervalo de datas vira uma fatia contígua, e espécie, prefixo
+# de pilha e ticket são resolvidos pelos códigos das categorias.
+
+TAMANHOS_PAGINA = [50, 100, 250, 500]
+
+_trava = threading.Lock()
+# Por DataFrame (id do objeto); a entrada sai quando o DataFrame é coletado
+_em_cache = {}
+
+
+class IndiceMedicoes:
+    def __init__(self, df):
+        pilhas = df['Pilha_ID'].astype('category').cat
+        especies = df['Tipo_Madeira'].astype('category').cat
+        datas = df['Data'].to_numpy(dtype='datetime64[ns]').view('int64')
+        codigos_pilha = pilhas.codes.to_numpy()
+
+        # Pilhas em ordem alfabética, usadas na ordenação e na busca por prefixo
+        self.pilhas = pilhas.categories.astype(str).to_numpy()
+        self.pilhas_ordem = np.argsort(self.pilhas)
+        self.pilhas_ordenadas = self.pilhas[self.pilhas_ordem]
+        posto_pilha = np.empty(len(self.pilhas), dtype='int64')
+        posto_pilha[self.pilhas_ordem] = np.arange(len(self.pilhas))
+
+        # Ordem de exibição; empates mantêm a ordem de inserção (id)
+        ordem = np.lexsort((df.index.to_numpy(), posto_pilha[codigos_pilha], -datas))
+
+        self.ids = df.index.to_numpy()[ordem]
+        self.datas_negativas = -datas[ordem]
+        self.codigos_pilha = codigos_pilha[ordem]
+        self.codigos_especie = especies.codes.to_numpy()[ordem]
+        self.especies = especies.categories.astype(str).to_numpy()
+        self.com_ticket = df['Peso_Tickets_Ton'].to_numpy(dtype=float)[ordem] > 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _fatia_datas(self, data_inicio, data_fim):
+        # As datas estão em ordem decrescente; negadas ficam crescentes
+        inicio, fim = 0, len(self.ids)
+        if data_fim is not None:
+            inicio = np.searchsorted(self.datas_negativas, -_nanossegundos(data_fim, fim_do_dia=True), 'left')
+        if data_inicio is not None:
+            fim = np.searchsorted(self.datas_negativas, -_nanossegundos(data_inicio), 'right')
+        return inicio, max(inicio, fim)
+
+    def _codigos_prefixo(self, prefixo):
+        inicio = np.searchsorted(self.pilhas_ordenadas, prefixo, 'left')
+        fim = np.searchsorted(self.pilhas_ordenadas, prefixo + '\U0010ffff', 'right')
+        alvo = np.zeros(len(self.pilhas), dtype=bool)
+        alvo[self.pilhas_ordem[inicio:fim]] = True
+        return alvo
+
+    def filtrar(self, data_inicio=None, data_fim=None, especies=None, prefixo_pilha='', com_ticket=None):
+        # Devolve os ids que passam nos filtros, na ordem de exibição
+        inicio, fim = self._fatia_datas(data_inicio, data_fim)
+        mascara = np.ones(fim - inicio, dtype=bool)
+
+        if especies is not None:
+            alvo = np.isin(self.especies, list(especies))
+            codigos = self.codigos_especie[inicio:fim]
+            mascara &= (codigos >= 0) & alvo[codigos]
+        if prefixo_pilha:
+            alvo = self._codigos_prefixo(prefixo_pilha)
+            codigos = self.codigos_pilha[inicio:fim]
+            mascara &= (codigos >= 0) & alvo[codigos]
+        if com_ticket is not None:
+            mascara &= self.com_ticket[inicio:fim] == com_ticket
+
+        return self.ids[inicio:fim][mascara]
+
+
+def _nanossegundos(data, fim_do_dia=False):
+    instante = pd.Timestamp(data)
+    if fim_do_dia:
+        instante = instante.normalize() + pd.Timedelta(days=1) - pd.Timedelta(1, 'ns')
+    return instante.value
+
+
+def indice_medicoes(df):
+    # Um índice por histórico em memória (um por pátio, e o completado com
+    # meses arquivados): cada um é o mesmo objeto para todas as sessões até a
+    # próxima gravação
+    with _trava:
+        indice = _em_cache.get(id(df))
+        if indice is None:
+            indice = _em_cache[id(df)] = IndiceMedicoes(df)
+            weakref.finalize(df, _em_cache.pop, id(df), None)
+        return indice
+
+
+def pagina(df, ids, numero, tamanho):
+    # Linhas da página `numero` (a partir de 1) dentre os ids filtrados
+    inicio = (numero - 1) * tamanho
+    return df.loc[ids[inicio:inicio + tamanho]]
+
+
+def total_paginas(ids, tamanho):
+    return max(1, -(-len(ids) // tamanho))
+
+
+# ==============================================================================
+# SELEÇÃO DE CADA SESSÃO
+# ==============================================================================
+# O histórico é um só, somente leitura, para todas as sessões; cada uma guarda
+# apenas os filtros e a seleção, como mapa de bits indexado pelo id (1 bit por
+# medição, ~125 kB por milhão), que sobrevive à troca de página, de filtro e
+# à recarga do histórico.
+
+class Selecao:
+    def __init__(self, ids=()):
+        self.bits = np.zeros(0, dtype=np.uint8)
+        self.marcar(ids)
+
+    def marcar(self, ids, valor=True):
+        ids = np.asarray(ids, dtype='int64')
+        if len(ids) == 0:
+            return
+        byte, bit = ids >> 3, (1 << (ids & 7)).astype(np.uint8)
+        if valor:
+            if byte.max() >= len(self.bits):
+                self.bits = np.concatenate([self.bits, np.zeros(byte.max() + 1 - len(self.bits), dtype=np.uint8)])
+            np.bitwise_or.at(self.bits, byte, bit)
+        else:
+            dentro = byte < len(self.bits)
+            np.bitwise_and.at(self.bits, byte[dentro], ~bit[dentro])
+
+    def desmarcar(self, ids):
+        self.marcar(ids, False)
+
+    def contem(self, ids):
+        ids = np.asarray(ids, dtype='int64')
+        byte = ids >> 3
+        dentro = byte < len(self.bits)
+        resultado = np.zeros(len(ids), dtype=bool)
+        resultado[dentro] = (self.bits[byte[dentro]] >> (ids[dentro] & 7)) & 1 == 1
+        return resultado
+
+    def __len__(self):
+        return int(np.bitwise_count(self.bits).sum())
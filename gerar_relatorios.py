@@ -0,0 +1,178 @@
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+from armazenamento import DB_FILE, conectar, load_data, periodo_aberto
+from consultas import IndiceMedicoes
+from parametros import ESPECIES
+from particoes import carregar_periodo, meses_arquivados
+from relatorios import criar_csv, criar_pdf
+
+# ==============================================================================
+# RELATÓRIOS SEM INTERFACE (LINHA DE COMANDO)
+# ==============================================================================
+# Gera os mesmos PDF/CSV do dashboard direto do banco, para rotinas noturnas:
+# filtros por período, espécie, prefixo de pilha e ticket, e um relatório por
+# espécie e/ou mês com --dividir. Vários relatórios são gerados em paralelo
+# num pool de processos; cada processo lê o histórico uma vez (snapshot
+# mapeado em memória) e atende várias tarefas; períodos que começam em meses
+# arquivados leem só as partições do período. Não importa Streamlit nem
+# Plotly.
+#
+# Uso: python gerar_relatorios.py --saida relatorios --inicio 2024-01-01 --fim 2024-12-31 \
+#          --formato pdf csv --dividir especie mes
+
+# Colunas exportadas, na ordem da tabela do dashboard
+COLUNAS_RELATORIO = [
+    'Data', 'Pilha_ID', 'Tipo_Madeira',
+    'Volume_Drone_Estereo', 'Densidade_Aplicada',
+    'Peso_Teorico_Ton', 'Peso_Tickets_Ton',
+    'Erro_Percentual', 'Var_Anterior_Pct',
+    'Fator_Conversao_Real'
+]
+
+_GERADORES = {'pdf': criar_pdf, 'csv': criar_csv}
+
+# Histórico e índice já carregados neste processo, por banco
+_historicos = {}
+
+
+def _historico(caminho):
+    df = load_data(caminho)
+    carregado = _historicos.get(caminho)
+    if carregado is None or carregado[0] is not df:
+        carregado = _historicos[caminho] = (df, IndiceMedicoes(df))
+    return carregado
+
+
+def selecionar(caminho, data_inicio=None, data_fim=None, especies=None, prefixo_pilha='', com_ticket=None):
+    # Linhas do relatório na ordem de exibição do dashboard
+    aberto_desde = periodo_aberto(caminho)
+    if aberto_desde is not None and (data_inicio is None or pd.Timestamp(data_inicio) < aberto_desde):
+        df = carregar_periodo(data_inicio, data_fim, caminho, COLUNAS_RELATORIO)
+        indice = IndiceMedicoes(df)
+    else:
+        df, indice = _historico(caminho)
+    ids = indice.filtrar(data_inicio, data_fim, especies, prefixo_pilha, com_ticket)
+    return df.loc[ids, COLUNAS_RELATORIO]
+
+
+def gerar(tarefa):
+    # Executada nos processos do pool: (arquivo, linhas, segundos)
+    inicio = time.perf_counter()
+    df = selecionar(tarefa['banco'], **tarefa['filtros'])
+    if not df.empty:
+        # Grava em arquivo temporário e só então publica o nome final
+        temporario = tarefa['arquivo'] + '.tmp'
+        with open(temporario, 'wb') as destino:
+            _GERADORES[tarefa['formato']](df, destino)
+        os.replace(temporario, tarefa['arquivo'])
+    return tarefa['arquivo'], len(df), time.perf_counter() - inicio
+
+
+def meses_com_medicoes(caminho, data_inicio=None, data_fim=None):
+    # Meses (AAAA-MM) com medições no período, direto do SQLite (banco e partições)
+    inicio = data_inicio.strftime('%Y-%m-%d') if data_inicio is not None else ''
+    fim = (data_fim + pd.Timedelta(days=1)).strftime('%Y-%m-%d') if data_fim is not None else '9999'
+    with conectar(caminho) as con:
+        linhas = con.execute(
+            'SELECT DISTINCT substr(Data, 1, 7) FROM medicoes WHERE Data >= ? AND Data < ? ORDER BY 1',
+            (inicio, fim)).fetchall()
+    return sorted({mes for mes, in linhas} | set(meses_arquivados(caminho, inicio, fim)))
+
+
+def _nome(filtros, formato):
+    partes = ['relatorio']
+    if filtros['especies']:
+        partes.append('-'.join(filtros['especies']))
+    if filtros['data_inicio'] is not None or filtros['data_fim'] is not None:
+        partes.append('_'.join(d.strftime('%Y%m%d') if d is not None else 'inicio'
+                               for d in (filtros['data_inicio'], filtros['data_fim'])))
+    if filtros['prefixo_pilha']:
+        partes.append(filtros['prefixo_pilha'])
+    if filtros['com_ticket'] is not None:
+        partes.append('com_ticket' if filtros['com_ticket'] else 'sem_ticket')
+    return '_'.join(partes).replace(os.sep, '-') + f'.{formato}'
+
+
+def montar_tarefas(banco, saida, formatos, data_inicio=None, data_fim=None, especies=None, prefixo_pilha='',
+                   com_ticket=None, dividir=()):
+    # Um relatório por combinação de espécie/mês pedida em `dividir`
+    grupos_especie = [[e] for e in (especies or ESPECIES)] if 'especie' in dividir else [especies]
+    periodos = [(data_inicio, data_fim)]
+    if 'mes' in dividir:
+        periodos = []
+        for mes in meses_com_medicoes(banco, data_inicio, data_fim):
+            primeiro = pd.Timestamp(f'{mes}-01')
+            periodos.append((max(primeiro, data_inicio) if data_inicio is not None else primeiro,
+                             min(primeiro + pd.offsets.MonthEnd(0), data_fim) if data_fim is not None
+                             else primeiro + pd.offsets.MonthEnd(0)))
+
+    tarefas = []
+    for especies_grupo in grupos_especie:
+        for inicio, fim in periodos:
+            filtros = {'data_inicio': inicio, 'data_fim': fim, 'especies': especies_grupo,
+                       'prefixo_pilha': prefixo_pilha, 'com_ticket': com_ticket}
+            for formato in formatos:
+                tarefas.append({'banco': banco, 'filtros': filtros, 'formato': formato,
+                                'arquivo': os.path.join(saida, _nome(filtros, formato))})
+    return tarefas
+
+
+def executar(tarefas, processos=None):
+    # Gera as tarefas (no próprio processo se houver uma só) e devolve
+    # [(arquivo, linhas, segundos ou exceção)]
+    if len(tarefas) <= 1 or processos == 1:
+        return [gerar(t) for t in tarefas]
+    resultados = []
+    with ProcessPoolExecutor(max_workers=min(processos or os.cpu_count(), len(tarefas))) as executor:
+        futuros = {executor.submit(gerar, t): t for t in tarefas}
+        for futuro in as_completed(futuros):
+            erro = futuro.exception()
+            resultados.append(futuro.result() if erro is None else (futuros[futuro]['arquivo'], 0, erro))
+    return resultados
+
+
+def _data(texto):
+    return pd.Timestamp(texto)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Gera relatórios PDF/CSV do pátio sem a interface')
+    parser.add_argument('--banco', default=DB_FILE)
+    parser.add_argument('--saida', default='.', help='pasta dos relatórios')
+    parser.add_argument('--formato', nargs='+', choices=list(_GERADORES), default=['pdf'])
+    parser.add_argument('--inicio', type=_data, help='AAAA-MM-DD')
+    parser.add_argument('--fim', type=_data, help='AAAA-MM-DD')
+    parser.add_argument('--especie', action='append', choices=ESPECIES, help='pode repetir')
+    parser.add_argument('--pilha', default='', help='início do ID da pilha')
+    parser.add_argument('--ticket', choices=['com', 'sem'])
+    parser.add_argument('--dividir', nargs='+', choices=['especie', 'mes'], default=[],
+                        help='um relatório por espécie e/ou por mês')
+    parser.add_argument('--processos', type=int, help='padrão: um por CPU')
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.banco):
+        parser.error(f'banco {args.banco} não encontrado')
+    os.makedirs(args.saida, exist_ok=True)
+    tarefas = montar_tarefas(args.banco, args.saida, args.formato, args.inicio, args.fim, args.especie,
+                             args.pilha, {'com': True, 'sem': False}.get(args.ticket), args.dividir)
+
+    falhas = 0
+    for arquivo, linhas, resultado in sorted(executar(tarefas, args.processos), key=lambda r: r[0]):
+        if isinstance(resultado, BaseException):
+            falhas += 1
+            print(f'ERRO  {arquivo}: {resultado}', file=sys.stderr)
+        elif linhas == 0:
+            print(f'vazio {arquivo}: nenhuma medição no filtro')
+        else:
+            print(f'ok    {arquivo}: {linhas:,} medições em {resultado:.1f}s')
+    return 1 if falhas else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,97 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+
+from instrumentacao import etapa
+from relatorios import chave_selecao
+
+# ==============================================================================
+# GRÁFICOS DO DASHBOARD (DRONE x BALANÇA POR ESPÉCIE)
+# ==============================================================================
+# Até LIMITE_BARRAS medições o gráfico tem uma barra por medição. Acima disso
+# as medições são somadas por pilha e, se ainda houver pilhas demais, por
+# semana: a figura enviada ao navegador tem tamanho limitado qualquer que seja
+# a seleção. As figuras ficam em cache pelo hash das linhas selecionadas.
+
+LIMITE_BARRAS = 200
+MAX_FIGURAS = 32
+
+CORES = {
+    'Pinus': ('#228B22', '#90EE90'),
+    'Eucalipto': ('#1E90FF', '#87CEFA'),
+}
+
+_figuras = OrderedDict()
+_trava = threading.Lock()
+
+
+def _texto_toneladas(valores, omitir_zero=False):
+    texto = np.char.mod('%.0f', np.asarray(valores, dtype=float))
+    return np.where(np.asarray(valores) > 0, texto, '') if omitir_zero else texto
+
+
+def _rotulos_medicao(df):
+    # "dd/mm - Pilha" sem formatar linha a linha: as datas distintas são
+    # formatadas uma vez e o texto é montado com operações vetorizadas
+    codigos, datas = pd.factorize(df['Data'])
+    rotulos_data = np.asarray(pd.DatetimeIndex(datas).strftime('%d/%m'), dtype=object)[codigos]
+    return rotulos_data + ' - ' + df['Pilha_ID'].astype(str).to_numpy(dtype=object)
+
+
+def agrupar_para_grafico(df):
+    # (rótulos, estimado, real, agrupamento) com no máximo LIMITE_BARRAS barras
+    if len(df) <= LIMITE_BARRAS:
+        return (_rotulos_medicao(df), df['Peso_Teorico_Ton'].to_numpy(),
+                df['Peso_Tickets_Ton'].to_numpy(), 'medição')
+
+    pesos = df[['Peso_Teorico_Ton', 'Peso_Tickets_Ton']]
+    por_pilha = pesos.groupby(df['Pilha_ID'].astype(str).to_numpy()).sum()
+    if len(por_pilha) <= LIMITE_BARRAS:
+        return (por_pilha.index.to_numpy(dtype=object), por_pilha['Peso_Teorico_Ton'].to_numpy(),
+                por_pilha['Peso_Tickets_Ton'].to_numpy(), 'pilha')
+
+    por_semana = pesos.groupby(df['Data'].dt.to_period('W').dt.start_time.to_numpy()).sum()
+    rotulos = np.asarray(pd.DatetimeIndex(por_semana.index).strftime('%d/%m/%y'), dtype=object)
+    return rotulos, por_semana['Peso_Teorico_Ton'].to_numpy(), por_semana['Peso_Tickets_Ton'].to_numpy(), 'semana'
+
+
+def _montar_figura(df, especie):
+    rotulos, estimado, real, agrupamento = agrupar_para_grafico(df)
+    cor_drone, cor_balanca = CORES.get(especie, ('#555555', '#AAAAAA'))
+    fig = go.Figure()
+    fig.add_trace(go.Bar(
+        x=rotulos, y=estimado,
+        name='Drone (Est.)', marker_color=cor_drone,
+        text=_texto_toneladas(estimado), textposition='auto'
+    ))
+    fig.add_trace(go.Bar(
+        x=rotulos, y=real,
+        name='Balança (Real)', marker_color=cor_balanca,
+        text=_texto_toneladas(real, omitir_zero=True), textposition='auto'
+    ))
+    fig.update_layout(barmode='group', height=250, margin=dict(t=10, b=10))
+    if agrupamento != 'medição':
+        fig.update_layout(height=280, margin=dict(t=30, b=10),
+                          title=dict(text=f"{len(df):,} medições somadas por {agrupamento}", font=dict(size=12)))
+    return fig
+
+
+def figura_especie(df, especie):
+    # Figura compartilhada entre sessões e reexecuções: não deve ser alterada
+    chave = chave_selecao(df[['Data', 'Pilha_ID', 'Peso_Teorico_Ton', 'Peso_Tickets_Ton']], especie)
+    with _trava:
+        fig = _figuras.get(chave)
+        if fig is not None:
+            _figuras.move_to_end(chave)
+            return fig
+
+    with etapa('montar_figura'):
+        fig = _montar_figura(df, especie)
+    with _trava:
+        _figuras[chave] = fig
+        while len(_figuras) > MAX_FIGURAS:
+            _figuras.popitem(last=False)
+    return fig
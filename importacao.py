@@ -0,0 +1,242 @@
+import os
+import unicodedata
+
+import numpy as np
+import pandas as pd
+
+from armazenamento import COLUNAS, DB_FILE, inserir_lote, periodo_aberto
+from calculos import calcular
+from parametros import ESPECIES
+from versoes_parametros import carregar_tabela
+
+# ==============================================================================
+# IMPORTAÇÃO EM LOTE (LEVANTAMENTOS DE DRONE E TICKETS DE BALANÇA)
+# ==============================================================================
+# Os arquivos são lidos em blocos; cada bloco é validado e calculado com
+# operações vetorizadas (mesmas regras do botão "REGISTRAR MEDIÇÃO") e todas as
+# linhas válidas são gravadas em um único lote no final.
+
+TAMANHO_BLOCO = 5000
+
+# Nomes de coluna aceitos nos arquivos (comparados sem acentos, em minúsculas)
+SINONIMOS = {
+    'data': 'Data', 'data_medicao': 'Data', 'data_voo': 'Data', 'data_ticket': 'Data',
+    'pilha': 'Pilha_ID', 'pilha_id': 'Pilha_ID', 'id_pilha': 'Pilha_ID',
+    'tipo': 'Tipo_Madeira', 'tipo_madeira': 'Tipo_Madeira', 'especie': 'Tipo_Madeira', 'madeira': 'Tipo_Madeira',
+    'volume': 'Volume_Drone_Estereo', 'volume_m3': 'Volume_Drone_Estereo', 'volume_drone': 'Volume_Drone_Estereo',
+    'volume_drone_estereo': 'Volume_Drone_Estereo',
+    'densidade': 'Densidade_Aplicada', 'densidade_aplicada': 'Densidade_Aplicada',
+    'peso': 'Peso_Tickets_Ton', 'peso_ton': 'Peso_Tickets_Ton', 'peso_balanca': 'Peso_Tickets_Ton',
+    'peso_liquido': 'Peso_Tickets_Ton', 'peso_tickets_ton': 'Peso_Tickets_Ton',
+}
+
+COLUNAS_ERRO = ['Arquivo', 'Linha', 'Pilha_ID', 'Motivo']
+
+
+def _normalizar_nome(nome):
+    nome = unicodedata.normalize('NFKD', str(nome)).encode('ascii', 'ignore').decode('ascii')
+    return nome.strip().lower().replace(' ', '_').replace('(', '').replace(')', '')
+
+
+def _normalizar_colunas(bloco):
+    return bloco.rename(columns=lambda c: SINONIMOS.get(_normalizar_nome(c), c))
+
+
+def _separador_csv(arquivo):
+    # Planilhas brasileiras costumam exportar CSV com ';'
+    if isinstance(arquivo, (str, os.PathLike)):
+        with open(arquivo, 'rb') as f:
+            cabecalho = f.readline()
+    else:
+        posicao = arquivo.tell()
+        cabecalho = arquivo.readline()
+        arquivo.seek(posicao)
+    if isinstance(cabecalho, str):
+        cabecalho = cabecalho.encode()
+    return ';' if cabecalho.count(b';') > cabecalho.count(b',') else ','
+
+
+def ler_em_blocos(arquivo, tamanho_bloco=TAMANHO_BLOCO):
+    # Aceita caminho ou arquivo aberto (ex.: upload do Streamlit). CSV é lido
+    # em blocos; Excel não tem leitura parcial no pandas e é fatiado em memória.
+    nome = arquivo if isinstance(arquivo, (str, os.PathLike)) else getattr(arquivo, 'name', '')
+    if str(nome).lower().endswith(('.xlsx', '.xls')):
+        df = pd.read_excel(arquivo)
+        for inicio in range(0, len(df), tamanho_bloco):
+            yield _normalizar_colunas(df.iloc[inicio:inicio + tamanho_bloco])
+    else:
+        sep = _separador_csv(arquivo)
+        decimal = ',' if sep == ';' else '.'
+        for bloco in pd.read_csv(arquivo, sep=sep, decimal=decimal, chunksize=tamanho_bloco):
+            yield _normalizar_colunas(bloco)
+
+
+def _coluna(bloco, nome, padrao=np.nan):
+    if nome in bloco.columns:
+        return bloco[nome]
+    return pd.Series(padrao, index=bloco.index)
+
+
+def _numero(serie):
+    return pd.to_numeric(serie, errors='coerce').to_numpy(dtype=float)
+
+
+def _datas(serie):
+    # ISO (AAAA-MM-DD) primeiro; o restante como data brasileira (DD/MM/AAAA)
+    datas = pd.to_datetime(serie, errors='coerce', format='ISO8601')
+    faltam = datas.isna() & serie.notna()
+    if faltam.any():
+        datas[faltam] = pd.to_datetime(serie[faltam], errors='coerce', dayfirst=True, format='mixed')
+    return datas
+
+
+def _linhas_arquivo(bloco):
+    # Número da linha no arquivo (cabeçalho é a linha 1)
+    return bloco.index.to_numpy() + 2
+
+
+def _texto(serie):
+    return serie.fillna('').astype(str).str.strip()
+
+
+def validar_e_calcular(bloco, tabela, aberto_desde=None):
+    # Devolve (medições válidas nas COLUNAS do armazenamento, relatório de erros).
+    # `tabela` é a TabelaParametros usada para densidade e fator padrão;
+    # datas anteriores a `aberto_desde` caem em meses arquivados.
+    data = _datas(_coluna(bloco, 'Data'))
+    pilha = _texto(_coluna(bloco, 'Pilha_ID', ''))
+    tipo = _texto(_coluna(bloco, 'Tipo_Madeira', '')).str.capitalize()
+    volume = _numero(_coluna(bloco, 'Volume_Drone_Estereo'))
+    tickets = np.nan_to_num(_numero(_coluna(bloco, 'Peso_Tickets_Ton')), nan=0.0)
+    densidade_arquivo = _numero(_coluna(bloco, 'Densidade_Aplicada'))
+    codigo_especie = pd.Categorical(tipo, categories=ESPECIES).codes
+
+    arquivada = (data < aberto_desde).to_numpy() if aberto_desde is not None else np.zeros(len(data), dtype=bool)
+    motivos = np.select(
+        [pilha.to_numpy() == '', ~(volume > 0), data.isna().to_numpy(), codigo_especie < 0, tickets < 0, arquivada],
+        ['ID da Pilha vazio', 'Volume deve ser maior que zero', 'Data inválida',
+         f'Tipo de Madeira deve ser {" ou ".join(ESPECIES)}', 'Peso de balança negativo', 'Mês arquivado'],
+        default='')
+    valida = motivos == ''
+
+    erros = pd.DataFrame({
+        'Arquivo': 'drone',
+        'Linha': _linhas_arquivo(bloco)[~valida],
+        'Pilha_ID': pilha.to_numpy()[~valida],
+        'Motivo': motivos[~valida],
+    }, columns=COLUNAS_ERRO)
+
+    especie = np.array(ESPECIES)[codigo_especie[valida]]
+    volume = volume[valida]
+    tickets = tickets[valida]
+
+    versao, densidade_tabela, fator_teorico = tabela.aplicar(data[valida], especie)
+    densidade_manual = densidade_arquivo[valida] > 0
+    densidade = np.where(densidade_manual, densidade_arquivo[valida], densidade_tabela)
+
+    validas = pd.DataFrame({
+        'Data': data[valida].dt.normalize().to_numpy(),
+        'Pilha_ID': pilha.to_numpy()[valida],
+        'Tipo_Madeira': especie,
+        'Volume_Drone_Estereo': volume,
+        'Densidade_Aplicada': densidade,
+        'Fator_Teorico': fator_teorico,
+        'Peso_Tickets_Ton': tickets,
+        **calcular(volume, fator_teorico, densidade, tickets),
+        'Versao_Parametros': versao,
+        'Densidade_Manual': densidade_manual,
+    }, columns=COLUNAS)
+    return validas, erros
+
+
+def ler_tickets(arquivo, tamanho_bloco=TAMANHO_BLOCO):
+    # Soma os tickets de balança por (Data, Pilha_ID). Devolve (totais, erros).
+    totais, erros = [], []
+    for bloco in ler_em_blocos(arquivo, tamanho_bloco):
+        data = _datas(_coluna(bloco, 'Data')).dt.normalize()
+        pilha = _texto(_coluna(bloco, 'Pilha_ID', ''))
+        peso = _numero(_coluna(bloco, 'Peso_Tickets_Ton'))
+
+        motivos = np.select(
+            [pilha.to_numpy() == '', data.isna().to_numpy(), ~(peso > 0)],
+            ['ID da Pilha vazio', 'Data inválida', 'Peso deve ser maior que zero'],
+            default='')
+        valida = motivos == ''
+        erros.append(pd.DataFrame({
+            'Arquivo': 'balança',
+            'Linha': _linhas_arquivo(bloco)[~valida],
+            'Pilha_ID': pilha.to_numpy()[~valida],
+            'Motivo': motivos[~valida],
+        }, columns=COLUNAS_ERRO))
+        totais.append(pd.DataFrame({
+            'Data': data.to_numpy()[valida], 'Pilha_ID': pilha.to_numpy()[valida], 'Peso': peso[valida],
+        }).groupby(['Data', 'Pilha_ID'], as_index=False)['Peso'].sum())
+
+    if not totais:
+        return pd.DataFrame(columns=['Data', 'Pilha_ID', 'Peso']), pd.DataFrame(columns=COLUNAS_ERRO)
+    totais = pd.concat(totais, ignore_index=True).groupby(['Data', 'Pilha_ID'], as_index=False)['Peso'].sum()
+    return totais, pd.concat(erros, ignore_index=True)
+
+
+def importar_lote(arquivo_drone, arquivo_tickets=None, caminho=DB_FILE, tamanho_bloco=TAMANHO_BLOCO):
+    # Importa um levantamento de drone (e opcionalmente os tickets de balança
+    # correspondentes). Devolve (linhas gravadas, relatório de erros por linha).
+    blocos_validos, erros, chaves_drone = [], [], []
+    # (Data, Pilha_ID, Linha) da medição que recebeu cada ticket
+    atribuidos = pd.DataFrame({'Data': pd.Series(dtype='datetime64[ns]'), 'Pilha_ID': pd.Series(dtype=str),
+                               'Linha': pd.Series(dtype='int64')})
+    tabela = carregar_tabela(caminho)
+    aberto_desde = periodo_aberto(caminho)
+    tickets = None
+    if arquivo_tickets is not None:
+        tickets, erros_tickets = ler_tickets(arquivo_tickets, tamanho_bloco)
+        erros.append(erros_tickets)
+
+    for bloco in ler_em_blocos(arquivo_drone, tamanho_bloco):
+        if tickets is not None:
+            # Tickets entram como peso de balança da medição do mesmo dia/pilha.
+            # O total vai para a primeira medição com essa chave no arquivo; as
+            # outras são rejeitadas, senão cada uma contaria o peso inteiro.
+            chave = pd.DataFrame({
+                'Data': _datas(_coluna(bloco, 'Data')).dt.normalize(),
+                'Pilha_ID': _texto(_coluna(bloco, 'Pilha_ID', '')),
+            }, index=bloco.index)
+            chaves_drone.append(chave)
+            peso = chave.merge(tickets, on=['Data', 'Pilha_ID'], how='left')['Peso'].to_numpy()
+
+            alvo = chave[~np.isnan(peso)].assign(Linha=_linhas_arquivo(bloco)[~np.isnan(peso)])
+            anterior = alvo.merge(atribuidos, on=['Data', 'Pilha_ID'], how='left', suffixes=('', '_ticket'))
+            linha_anterior = anterior['Linha_ticket'].to_numpy(dtype=float)
+            primeira = np.where(np.isnan(linha_anterior),
+                                alvo.groupby(['Data', 'Pilha_ID'])['Linha'].transform('first'), linha_anterior)
+            repetida = primeira != alvo['Linha'].to_numpy()
+            atribuidos = pd.concat([atribuidos, alvo[~repetida]], ignore_index=True)
+            erros.append(pd.DataFrame({
+                'Arquivo': 'drone',
+                'Linha': alvo['Linha'].to_numpy()[repetida],
+                'Pilha_ID': alvo['Pilha_ID'].to_numpy()[repetida],
+                'Motivo': [f'Ticket do dia já atribuído à medição da linha {int(n)}' for n in primeira[repetida]],
+            }, columns=COLUNAS_ERRO))
+
+            bloco = bloco.assign(Peso_Tickets_Ton=np.where(np.isnan(peso), _coluna(bloco, 'Peso_Tickets_Ton'), peso))
+            bloco = bloco.drop(index=alvo.index[repetida])
+        validas, erros_bloco = validar_e_calcular(bloco, tabela, aberto_desde)
+        blocos_validos.append(validas)
+        erros.append(erros_bloco)
+
+    if tickets is not None and not tickets.empty:
+        # Tickets sem levantamento de drone no mesmo dia/pilha não são gravados
+        vistos = pd.concat(chaves_drone, ignore_index=True).drop_duplicates() if chaves_drone else None
+        orfaos = tickets if vistos is None else tickets.merge(vistos, how='left', indicator=True).query(
+            "_merge == 'left_only'")
+        erros.append(pd.DataFrame({
+            'Arquivo': 'balança',
+            'Linha': pd.NA,
+            'Pilha_ID': orfaos['Pilha_ID'].to_numpy(),
+            'Motivo': 'Ticket sem medição de drone em ' + orfaos['Data'].dt.strftime('%d/%m/%Y').to_numpy(),
+        }, columns=COLUNAS_ERRO))
+
+    validas = pd.concat(blocos_validos, ignore_index=True) if blocos_validos else pd.DataFrame(columns=COLUNAS)
+    gravadas = inserir_lote(validas, caminho)
+    erros = pd.concat(erros, ignore_index=True) if erros else pd.DataFrame(columns=COLUNAS_ERRO)
+    return gravadas, erros
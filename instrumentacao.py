@@ -0,0 +1,217 @@
+import json
+import os
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+
+# ==============================================================================
+# INSTRUMENTAÇÃO DOS TRECHOS QUENTES
+# ==============================================================================
+# Desligada por padrão. Liga com a variável de ambiente ESTOQUE_PERF (ou o
+# parâmetro ?perf= da URL, por sessão): "1" mede só o tempo de cada etapa,
+# "memoria" mede também o pico de alocação (tracemalloc, bem mais caro).
+# O pico do tracemalloc é do processo inteiro e zerá-lo vale para todas as
+# threads: com memória, as etapas de primeiro nível de sessões diferentes
+# rodam uma de cada vez, para que uma não zere nem infle o pico da outra.
+# Alocações de threads não medidas ainda entram, então o valor é registrado
+# como pico do processo durante a etapa (pico_processo_mb).
+# Cada reexecução do dashboard (ou relatório em segundo plano) vira uma
+# execução com as etapas medidas, guardada num histórico em memória e gravada
+# em ESTOQUE_PERF_ARQUIVO: JSON lines, ou formato texto do Prometheus se o
+# nome terminar em .prom (totais acumulados, para o textfile collector).
+
+NIVEIS = ('1', 'memoria')
+NIVEL_AMBIENTE = os.environ.get('ESTOQUE_PERF', '').strip().lower()
+ARQUIVO_METRICAS = os.environ.get('ESTOQUE_PERF_ARQUIVO', 'metricas_desempenho.jsonl')
+MAX_EXECUCOES = 200
+
+_local = threading.local()
+_trava = threading.Lock()
+_trava_arquivo = threading.Lock()
+_trava_memoria = threading.Lock()
+_historico = deque(maxlen=MAX_EXECUCOES)
+# etapa -> [execuções, segundos somados, maior tempo]
+_totais = {}
+
+
+class Execucao:
+    def __init__(self, origem, nivel):
+        self.origem = origem
+        self.nivel = nivel
+        self.memoria = nivel == 'memoria'
+        self.inicio = datetime.now()
+        self.relogio = time.perf_counter()
+        self.total = None
+        self.etapas = []
+        # Medições abertas: [nome, início, alocado no início, maior pico visto]
+        self._pilha = []
+
+    def por_etapa(self):
+        # Tempo (ms) das etapas de primeiro nível, somando as repetidas
+        tempos = {}
+        for registro in self.etapas:
+            if registro['profundidade'] == 0:
+                tempos[registro['nome']] = tempos.get(registro['nome'], 0.0) + registro['segundos'] * 1000
+        return tempos
+
+    def registro(self):
+        return {
+            'inicio': self.inicio.isoformat(timespec='milliseconds'),
+            'origem': self.origem,
+            'total_s': round(self.total, 6),
+            'etapas': self.etapas,
+        }
+
+
+def nivel(parametro=None):
+    # Nível pedido pela URL (se houver) ou pelo ambiente; None = desligada
+    valor = (parametro or NIVEL_AMBIENTE or '').strip().lower()
+    return valor if valor in NIVEIS else None
+
+
+def nivel_atual():
+    # Nível da execução da thread atual, para repassar a trabalhos em segundo
+    # plano que ela dispara
+    execucao = getattr(_local, 'execucao', None)
+    return execucao.nivel if execucao is not None else None
+
+
+def iniciar_execucao(origem='dashboard', parametro=None):
+    # Começa a medir a execução da thread atual, se a instrumentação estiver
+    # ligada; devolve a execução ou None
+    pedido = nivel(parametro)
+    if pedido is None:
+        _local.execucao = None
+        return None
+    # Uma vez ligado, o tracemalloc segue ligado no processo até ele acabar
+    if pedido == 'memoria' and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    _local.execucao = Execucao(origem, pedido)
+    return _local.execucao
+
+
+def finalizar_execucao():
+    execucao = getattr(_local, 'execucao', None)
+    if execucao is None:
+        return None
+    _local.execucao = None
+    execucao.total = time.perf_counter() - execucao.relogio
+    with _trava:
+        _historico.append(execucao)
+        for etapa in execucao.etapas:
+            total = _totais.setdefault(etapa['nome'], [0, 0.0, 0.0])
+            total[0] += 1
+            total[1] += etapa['segundos']
+            total[2] = max(total[2], etapa['segundos'])
+    if ARQUIVO_METRICAS:
+        with _trava_arquivo:
+            _exportar(execucao)
+    return execucao
+
+
+@contextmanager
+def execucao(origem, parametro=None):
+    # Execução inteira num bloco, para trabalhos fora do dashboard
+    iniciar_execucao(origem, parametro)
+    try:
+        yield
+    finally:
+        finalizar_execucao()
+
+
+@contextmanager
+def etapa(nome):
+    # Mede o bloco como uma etapa da execução atual. Sem execução (desligada),
+    # custa só a consulta ao thread-local.
+    execucao = getattr(_local, 'execucao', None)
+    if execucao is None:
+        yield
+        return
+
+    pilha = execucao._pilha
+    memoria = execucao.memoria and tracemalloc.is_tracing()
+    externa = memoria and not pilha
+    if externa:
+        _trava_memoria.acquire()
+    alocado = 0
+    if memoria:
+        alocado, pico = tracemalloc.get_traced_memory()
+        # O pico é zerado a cada etapa; o da etapa de fora fica guardado
+        if pilha:
+            pilha[-1][3] = max(pilha[-1][3], pico)
+        tracemalloc.reset_peak()
+    pilha.append([nome, time.perf_counter(), alocado, 0])
+    try:
+        yield
+    finally:
+        _, inicio, alocado, pico_visto = pilha.pop()
+        registro = {'nome': nome, 'segundos': round(time.perf_counter() - inicio, 6), 'profundidade': len(pilha)}
+        if memoria:
+            pico = max(pico_visto, tracemalloc.get_traced_memory()[1])
+            registro['pico_processo_mb'] = round((pico - alocado) / 1e6, 3)
+            if pilha:
+                pilha[-1][3] = max(pilha[-1][3], pico)
+        if externa:
+            _trava_memoria.release()
+        execucao.etapas.append(registro)
+
+
+def historico():
+    # Execuções mais recentes primeiro
+    with _trava:
+        return list(reversed(_historico))
+
+
+def totais():
+    with _trava:
+        return {nome: tuple(valores) for nome, valores in _totais.items()}
+
+
+# ==============================================================================
+# EXPORTAÇÃO
+# ==============================================================================
+
+def _exportar(execucao, arquivo=None):
+    arquivo = arquivo or ARQUIVO_METRICAS
+    if arquivo.endswith('.prom'):
+        _gravar_atomico(arquivo, texto_prometheus())
+    else:
+        with open(arquivo, 'a', encoding='utf-8') as destino:
+            destino.write(json.dumps(execucao.registro(), ensure_ascii=False) + '\n')
+
+
+def _rotulo(valor):
+    return str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def texto_prometheus():
+    # Totais acumulados por etapa desde o início do processo
+    familias = [
+        ('estoque_etapa_execucoes_total', 'counter', 'Vezes que a etapa foi medida.', lambda n, soma, maior: str(n)),
+        ('estoque_etapa_segundos_total', 'counter', 'Tempo somado da etapa, em segundos.',
+         lambda n, soma, maior: f'{soma:.6f}'),
+        ('estoque_etapa_segundos_max', 'gauge', 'Maior tempo da etapa, em segundos.',
+         lambda n, soma, maior: f'{maior:.6f}'),
+    ]
+    acumulado = sorted(totais().items())
+    linhas = []
+    for metrica, tipo, ajuda, valor in familias:
+        linhas += [f'# HELP {metrica} {ajuda}', f'# TYPE {metrica} {tipo}']
+        linhas += [f'{metrica}{{etapa="{_rotulo(nome)}"}} {valor(*valores)}' for nome, valores in acumulado]
+    return '\n'.join(linhas) + '\n'
+
+
+def _gravar_atomico(arquivo, texto):
+    # O coletor pode ler o arquivo a qualquer momento: nunca pela metade
+    descritor, temporario = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(arquivo)), suffix='.tmp')
+    try:
+        with os.fdopen(descritor, 'w', encoding='utf-8') as destino:
+            destino.write(texto)
+        os.replace(temporario, arquivo)
+    except BaseException:
+        os.remove(temporario)
+        raise
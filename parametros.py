@@ -0,0 +1,25 @@
+# ==============================================================================
+# PARÂMETROS DE ENGENHARIA
+# ==============================================================================
+
+DENSIDADE_MENSAL = {
+    1: {'Pinus': 580, 'Eucalipto': 820},
+    2: {'Pinus': 580, 'Eucalipto': 820},
+    3: {'Pinus': 560, 'Eucalipto': 790},
+    4: {'Pinus': 540, 'Eucalipto': 760},
+    5: {'Pinus': 520, 'Eucalipto': 740},
+    6: {'Pinus': 500, 'Eucalipto': 720},
+    7: {'Pinus': 500, 'Eucalipto': 710},
+    8: {'Pinus': 490, 'Eucalipto': 700},
+    9: {'Pinus': 510, 'Eucalipto': 730},
+    10: {'Pinus': 530, 'Eucalipto': 760},
+    11: {'Pinus': 550, 'Eucalipto': 780},
+    12: {'Pinus': 570, 'Eucalipto': 800},
+}
+
+FATOR_ARRUMADO = {
+    'Pinus': 0.65,
+    'Eucalipto': 0.60
+}
+
+ESPECIES = list(FATOR_ARRUMADO)
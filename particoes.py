@@ -0,0 +1,227 @@
+import os
+import sqlite3
+import tempfile
+import threading
+from contextlib import closing
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+
+from armazenamento import (COLUNAS_HISTORICO, DB_FILE, TIPOS_SQL, aplicar_schema, conectar, corte_arquivo,
+                           escritor_exclusivo, get_empty_df, load_data, transacao_escrita)
+
+# ==============================================================================
+# PARTIÇÕES ARQUIVADAS (MESES FECHADOS)
+# ==============================================================================
+# Meses fechados saem do banco principal, que o dashboard lê inteiro, para um
+# arquivo SQLite por mês: compacto (sem índices nem agregados) e somente
+# leitura, na pasta <banco>.arquivo. O banco guarda a lista das partições com
+# o intervalo de datas de cada uma, e uma consulta por período abre só as que
+# o cruzam. Agregados, calibração e a última leitura de cada pilha continuam
+# no banco principal: indicadores, séries de estoque e variações seguem
+# completos sem abrir o arquivo. Anos inteiros já arquivados podem ser
+# compactados em uma partição por ano.
+
+_trava = threading.Lock()
+_ultimo = (None, None, None)
+
+
+def pasta_arquivo(caminho=DB_FILE):
+    return os.path.splitext(caminho)[0] + '.arquivo'
+
+
+def _iso(data):
+    return pd.Timestamp(data).strftime('%Y-%m-%d')
+
+
+def _inicio_mes(data):
+    return pd.Timestamp(data).to_period('M').start_time
+
+
+def listar_particoes(caminho=DB_FILE):
+    # Uma linha por partição: arquivo, inicio e fim (ISO, fim exclusivo), linhas
+    with conectar(caminho) as con:
+        return pd.read_sql_query('SELECT * FROM particoes ORDER BY inicio', con)
+
+
+def _gravar_particao(arquivo, df):
+    # Grava em arquivo temporário e troca de uma vez, como o snapshot
+    descritor, temporario = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(arquivo)), suffix='.tmp')
+    os.close(descritor)
+    try:
+        with closing(sqlite3.connect(temporario)) as con:
+            colunas_sql = ', '.join(f'{c} {TIPOS_SQL[c]}' for c in COLUNAS_HISTORICO)
+            con.execute(f'CREATE TABLE medicoes (id INTEGER PRIMARY KEY, {colunas_sql})')
+            con.executemany(f'INSERT INTO medicoes VALUES ({", ".join("?" * (len(COLUNAS_HISTORICO) + 1))})',
+                            df[['id'] + COLUNAS_HISTORICO].itertuples(index=False, name=None))
+            con.commit()
+        os.replace(temporario, arquivo)
+    except BaseException:
+        os.remove(temporario)
+        raise
+
+
+def _abrir_particao(arquivo):
+    # Somente leitura: a partição nunca é alterada depois de publicada
+    return closing(sqlite3.connect(Path(arquivo).absolute().as_uri() + '?mode=ro', uri=True))
+
+
+def _ler_particao(arquivo, colunas, inicio='', fim='9999'):
+    with _abrir_particao(arquivo) as con:
+        return aplicar_schema(pd.read_sql_query(
+            f"SELECT id, {', '.join(colunas)} FROM medicoes WHERE Data >= ? AND Data < ?",
+            con, params=(inicio, fim), index_col='id'))
+
+
+def _ler_particoes(caminho, colunas, inicio='', fim='9999'):
+    # Partições que cruzam [inicio, fim). Uma compactação concluída entre a
+    # listagem e a leitura troca os arquivos: lista de novo uma vez.
+    for tentativa in range(2):
+        particoes = listar_particoes(caminho)
+        relevantes = particoes[(particoes['inicio'] < fim) & (particoes['fim'] > inicio)]
+        arquivos = [os.path.join(pasta_arquivo(caminho), nome) for nome in relevantes['arquivo']]
+        if tentativa == 0 and not all(os.path.exists(a) for a in arquivos):
+            continue
+        return tuple(relevantes['arquivo']), [_ler_particao(a, colunas, inicio, fim) for a in arquivos]
+
+
+def _juntar(partes, colunas):
+    partes = [p for p in partes if not p.empty]
+    if not partes:
+        return get_empty_df(colunas)
+    df = pd.concat(partes)
+    # Durante uma compactação a mesma linha pode vir de duas partições
+    return aplicar_schema(df[~df.index.duplicated()].sort_index())
+
+
+def carregar_periodo(data_inicio=None, data_fim=None, caminho=DB_FILE, colunas=None):
+    # Medições de data_inicio a data_fim (dias inclusive), dos meses
+    # arquivados e do banco principal, abrindo só o que cruza o período
+    colunas = list(colunas or COLUNAS_HISTORICO)
+    inicio = _iso(data_inicio) if data_inicio is not None else ''
+    fim = _iso(pd.Timestamp(data_fim) + pd.Timedelta(days=1)) if data_fim is not None else '9999'
+    _, partes = _ler_particoes(caminho, colunas, inicio, fim)
+
+    with conectar(caminho) as con:
+        corte = corte_arquivo(con)
+    if fim > corte:
+        quente = load_data(caminho)
+        mascara = pd.Series(True, index=quente.index)
+        if data_inicio is not None:
+            mascara &= quente['Data'] >= pd.Timestamp(inicio)
+        if data_fim is not None:
+            mascara &= quente['Data'] < pd.Timestamp(fim)
+        partes.append(quente.loc[mascara, colunas])
+    return _juntar(partes, colunas)
+
+
+def historico_desde(data_inicio, caminho=DB_FILE):
+    # Histórico do banco principal completado com os meses arquivados a partir
+    # do mês de `data_inicio` (None: todos). Devolve o mesmo objeto enquanto
+    # nada muda: os índices em cache (consultas.py, series_pilhas.py)
+    # dependem disso.
+    global _ultimo
+    quente = load_data(caminho)
+    inicio = _iso(_inicio_mes(data_inicio)) if data_inicio is not None else ''
+    particoes = listar_particoes(caminho)
+    if not (particoes['fim'] > inicio).any():
+        return quente
+
+    with _trava:
+        chave, base, df = _ultimo
+        arquivos = tuple(particoes.loc[particoes['fim'] > inicio, 'arquivo'])
+        if chave == (caminho, arquivos) and base is quente:
+            return df
+        _, partes = _ler_particoes(caminho, COLUNAS_HISTORICO, inicio)
+        df = _juntar(partes + [quente], COLUNAS_HISTORICO)
+        df.attrs['versao'] = quente.attrs.get('versao')
+        _ultimo = ((caminho, arquivos), quente, df)
+        return df
+
+
+def _compactar_banco(caminho):
+    # Devolve ao sistema o espaço das linhas que saíram do banco principal
+    with escritor_exclusivo(), conectar(caminho) as con:
+        con.execute('VACUUM')
+
+
+def arquivar(ate, caminho=DB_FILE):
+    # Fecha os meses anteriores ao mês de `ate`: cada um vira uma partição e
+    # sai do banco principal. Devolve os arquivos criados.
+    corte = _inicio_mes(ate)
+    pasta = pasta_arquivo(caminho)
+    os.makedirs(pasta, exist_ok=True)
+
+    with transacao_escrita(caminho) as con:
+        if corte_arquivo(con) >= _iso(corte):
+            return []
+        df = pd.read_sql_query(f"SELECT id, {', '.join(COLUNAS_HISTORICO)} FROM medicoes WHERE Data < ? ORDER BY id",
+                               con, params=(_iso(corte),))
+        criadas = []
+        for mes, grupo in df.groupby(df['Data'].str[:7]):
+            nome = f'{mes}.db'
+            _gravar_particao(os.path.join(pasta, nome), grupo)
+            fim = _iso(pd.Timestamp(f'{mes}-01') + pd.offsets.MonthBegin())
+            criadas.append((nome, f'{mes}-01', fim, len(grupo), datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+
+        # Âncoras das pilhas e parte arquivada da calibração (ver armazenamento.py)
+        con.execute('INSERT OR REPLACE INTO ultimas_arquivadas SELECT Pilha_ID, Tipo_Madeira, Data, Peso_Teorico_Ton '
+                    'FROM (SELECT *, ROW_NUMBER() OVER (PARTITION BY Pilha_ID ORDER BY Data DESC, id DESC) AS ordem '
+                    'FROM medicoes WHERE Data < ?) WHERE ordem = 1', (_iso(corte),))
+        con.execute('INSERT INTO calibracao_arquivada SELECT Tipo_Madeira, CAST(substr(Data, 6, 2) AS INTEGER), '
+                    'COUNT(*), SUM(Peso_Teorico_Ton * Peso_Tickets_Ton), SUM(Peso_Teorico_Ton * Peso_Teorico_Ton), '
+                    'SUM(Peso_Tickets_Ton * Peso_Tickets_Ton) FROM medicoes WHERE Data < ? AND Peso_Tickets_Ton > 0 '
+                    'GROUP BY 1, 2 ON CONFLICT (Tipo_Madeira, Mes) DO UPDATE SET n = n + excluded.n, '
+                    'soma_pt = soma_pt + excluded.soma_pt, soma_pp = soma_pp + excluded.soma_pp, '
+                    'soma_tt = soma_tt + excluded.soma_tt', (_iso(corte),))
+        con.execute('DELETE FROM medicoes WHERE Data < ?', (_iso(corte),))
+        con.executemany('INSERT INTO particoes VALUES (?, ?, ?, ?, ?)', criadas)
+        con.execute("UPDATE meta SET valor = ? WHERE chave = 'arquivado_ate'", (int(corte.strftime('%Y%m%d')),))
+        # Linhas saíram do banco: o snapshot e o histórico em cache são relidos
+        con.execute("UPDATE meta SET valor = valor + 1 WHERE chave = 'geracao'")
+
+    if criadas:
+        _compactar_banco(caminho)
+    return [nome for nome, *_ in criadas]
+
+
+def compactar(ate_ano, caminho=DB_FILE):
+    # Junta as partições de cada ano inteiramente arquivado, até `ate_ano`, em
+    # uma só (AAAA.db). Devolve os arquivos criados.
+    with conectar(caminho) as con:
+        corte = corte_arquivo(con)
+    particoes = listar_particoes(caminho)
+    anos = particoes['inicio'].str[:4].astype(int)
+    pasta = pasta_arquivo(caminho)
+    criadas = []
+    for ano, grupo in particoes[(anos <= int(ate_ano)) & (anos + 1 <= int(corte[:4] or 0))].groupby(anos):
+        nome = f'{ano}.db'
+        if list(grupo['arquivo']) == [nome]:
+            continue
+        partes = [_ler_particao(os.path.join(pasta, a), COLUNAS_HISTORICO) for a in grupo['arquivo']]
+        df = pd.concat(partes).sort_index()
+        df['Data'] = df['Data'].dt.strftime('%Y-%m-%d')
+        _gravar_particao(os.path.join(pasta, nome), df.reset_index())
+
+        with transacao_escrita(caminho) as con:
+            con.executemany('DELETE FROM particoes WHERE arquivo = ?', [(a,) for a in grupo['arquivo']])
+            con.execute('INSERT INTO particoes VALUES (?, ?, ?, ?, ?)',
+                        (nome, grupo['inicio'].min(), grupo['fim'].max(), len(df),
+                         datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+        for arquivo in grupo['arquivo']:
+            if arquivo != nome:
+                os.remove(os.path.join(pasta, arquivo))
+        criadas.append(nome)
+    return criadas
+
+
+def meses_arquivados(caminho=DB_FILE, inicio='', fim='9999'):
+    # Meses (AAAA-MM) com medições arquivadas em [inicio, fim)
+    meses = set()
+    particoes = listar_particoes(caminho)
+    for nome in particoes.loc[(particoes['inicio'] < fim) & (particoes['fim'] > inicio), 'arquivo']:
+        with _abrir_particao(os.path.join(pasta_arquivo(caminho), nome)) as con:
+            meses.update(m for m, in con.execute('SELECT DISTINCT substr(Data, 1, 7) FROM medicoes '
+                                                 'WHERE Data >= ? AND Data < ?', (inicio, fim)))
+    return sorted(meses)
@@ -0,0 +1,140 @@
+import argparse
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from agregados import carregar_agregados, indicadores
+from armazenamento import DB_FILE, conectar, corte_arquivo, inicializar
+from particoes import arquivar, compactar, listar_particoes
+
+# ==============================================================================
+# PÁTIOS (UM BANCO POR PÁTIO)
+# ==============================================================================
+# Cada pátio é uma pasta em PASTA_PATIOS com o seu banco e as suas partições
+# arquivadas (particoes.py): gravações e leituras de um pátio nunca abrem os
+# arquivos dos outros. A visão consolidada lê os agregados de cada pátio em
+# paralelo (threads: o trabalho é de E/S no SQLite e de numpy, e os cubos
+# ficam no cache do processo) e soma. Sem nenhum pátio criado o dashboard
+# continua usando DB_FILE na pasta atual.
+#
+# Uso: python patios.py criar Ponta_Grossa
+#      python patios.py arquivar Ponta_Grossa --ate 2024-01
+#      python patios.py compactar Ponta_Grossa --ate-ano 2023
+#      python patios.py consolidar --inicio 2024-01 --fim 2024-06
+
+PASTA_PATIOS = os.environ.get('ESTOQUE_PATIOS', 'patios')
+NOME_VALIDO = re.compile(r'^\w[\w.-]*$')
+MAX_THREADS = 8
+
+
+def caminho_patio(patio, pasta=PASTA_PATIOS):
+    return os.path.join(pasta, patio, DB_FILE)
+
+
+def listar_patios(pasta=PASTA_PATIOS):
+    if not os.path.isdir(pasta):
+        return []
+    return sorted(p for p in os.listdir(pasta) if os.path.exists(caminho_patio(p, pasta)))
+
+
+def criar_patio(patio, pasta=PASTA_PATIOS):
+    # Cria a pasta e o banco; um JSON legado deixado na pasta é importado
+    if not NOME_VALIDO.match(patio):
+        raise ValueError(f'Nome de pátio inválido: {patio!r} (use letras, números, ".", "-" e "_").')
+    os.makedirs(os.path.join(pasta, patio), exist_ok=True)
+    inicializar(caminho_patio(patio, pasta))
+    return caminho_patio(patio, pasta)
+
+
+def _em_paralelo(funcao, patios, pasta):
+    # {pátio: funcao(caminho)}, na ordem de `patios`
+    caminhos = [caminho_patio(p, pasta) for p in patios]
+    if len(caminhos) <= 1:
+        return dict(zip(patios, map(funcao, caminhos)))
+    with ThreadPoolExecutor(max_workers=min(MAX_THREADS, len(caminhos))) as executor:
+        return dict(zip(patios, executor.map(funcao, caminhos)))
+
+
+def resumo_patios(patios=None, pasta=PASTA_PATIOS, **filtros):
+    # Indicadores de cada pátio e do total, com os filtros de Agregados.somas.
+    # Os agregados incluem os meses arquivados.
+    patios = listar_patios(pasta) if patios is None else list(patios)
+    somas = _em_paralelo(lambda caminho: carregar_agregados(caminho).somas(**filtros), patios, pasta)
+    linhas = {patio: indicadores(s) for patio, s in somas.items()}
+    if somas:
+        linhas['Total'] = indicadores(np.sum(list(somas.values()), axis=0))
+    resumo = pd.DataFrame.from_dict(linhas, orient='index', columns=['medicoes', 'volume', 'peso', 'tickets',
+                                                                      'erro_medio'])
+    resumo.index.name = 'Pátio'
+    return resumo
+
+
+def estoque_consolidado(patios=None, pasta=PASTA_PATIOS, frequencia='M'):
+    # Estoque estimado (t) com colunas (pátio, espécie). Cada série mantém o
+    # último valor nas datas em que só os outros pátios têm medição.
+    patios = listar_patios(pasta) if patios is None else list(patios)
+    series = _em_paralelo(lambda caminho: carregar_agregados(caminho).serie_estoque(frequencia), patios, pasta)
+    series = {patio: s for patio, s in series.items() if not s.empty}
+    if not series:
+        return pd.DataFrame()
+    return pd.concat(series, axis=1, names=['Pátio', 'Tipo_Madeira']).sort_index().ffill().fillna(0.0)
+
+
+def situacao_patios(pasta=PASTA_PATIOS):
+    # Medições no banco principal, corte e partições arquivadas de cada pátio
+    def situacao(caminho):
+        with conectar(caminho) as con:
+            linhas = con.execute('SELECT COUNT(*) FROM medicoes').fetchone()[0]
+            corte = corte_arquivo(con)
+        particoes = listar_particoes(caminho)
+        return {'medicoes_ativas': linhas, 'arquivado_ate': corte or '-', 'particoes': len(particoes),
+                'medicoes_arquivadas': int(particoes['linhas'].sum()),
+                'tamanho_mb': os.path.getsize(caminho) / 1e6}
+
+    situacoes = _em_paralelo(situacao, listar_patios(pasta), pasta)
+    return pd.DataFrame.from_dict(situacoes, orient='index').rename_axis('Pátio')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Pátios: criação, arquivamento e visão consolidada')
+    parser.add_argument('--pasta', default=PASTA_PATIOS)
+    sub = parser.add_subparsers(dest='comando', required=True)
+    sub.add_parser('listar')
+    criar = sub.add_parser('criar')
+    criar.add_argument('patio')
+    arquivamento = sub.add_parser('arquivar', help='fecha os meses anteriores ao mês indicado')
+    arquivamento.add_argument('patio')
+    arquivamento.add_argument('--ate', required=True, help='AAAA-MM (exclusive)')
+    compactacao = sub.add_parser('compactar', help='junta as partições mensais de anos fechados')
+    compactacao.add_argument('patio')
+    compactacao.add_argument('--ate-ano', type=int, required=True)
+    consolidar = sub.add_parser('consolidar')
+    consolidar.add_argument('--inicio', help='AAAA-MM')
+    consolidar.add_argument('--fim', help='AAAA-MM')
+    args = parser.parse_args(argv)
+
+    if args.comando in ('arquivar', 'compactar') and args.patio not in listar_patios(args.pasta):
+        parser.error(f'pátio {args.patio} não encontrado em {args.pasta}')
+
+    if args.comando == 'listar':
+        print(situacao_patios(args.pasta).to_string())
+    elif args.comando == 'criar':
+        try:
+            print(f'Pátio criado em {criar_patio(args.patio, args.pasta)}.')
+        except ValueError as e:
+            parser.error(str(e))
+    elif args.comando == 'arquivar':
+        criadas = arquivar(args.ate, caminho_patio(args.patio, args.pasta))
+        print(f'{len(criadas)} partições criadas: {", ".join(criadas) or "nenhum mês novo a arquivar"}')
+    elif args.comando == 'compactar':
+        criadas = compactar(args.ate_ano, caminho_patio(args.patio, args.pasta))
+        print(f'{len(criadas)} partições anuais criadas: {", ".join(criadas) or "nada a compactar"}')
+    else:
+        print(resumo_patios(pasta=args.pasta, mes_inicio=args.inicio, mes_fim=args.fim).to_string())
+
+
+if __name__ == '__main__':
+    main()
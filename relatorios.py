@@ -0,0 +1,331 @@
+import atexit
+import hashlib
+import itertools
+import os
+import shutil
+import tempfile
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from fpdf import FPDF
+
+from instrumentacao import etapa, execucao, nivel_atual
+
+# ==============================================================================
+# GERAÇÃO DE PDF (COM LOGOTIPO)
+# ==============================================================================
+
+LOGO = 'Arauco.jpg'
+
+# Tamanho dos blocos gravados no arquivo de saída
+TAMANHO_BLOCO = 1 << 20
+
+# A cada quantas linhas da tabela o progresso é informado
+PASSO_PROGRESSO = 500
+
+# Logo já decodificado, reaproveitado por todas as páginas e relatórios
+_logo_info = None
+
+
+class _Buffer:
+    # Substitui a string do buffer do FPDF durante a montagem final: `+=`
+    # acumula em lista e `len()` devolve o tamanho usado nos offsets do PDF
+    def __init__(self):
+        self.partes = []
+        self.tamanho = 0
+
+    def __iadd__(self, texto):
+        self.partes.append(texto)
+        self.tamanho += len(texto)
+        return self
+
+    def __len__(self):
+        return self.tamanho
+
+
+class PDFReport(FPDF):
+    # O FPDF concatena cada comando ao texto da página (e depois ao documento
+    # inteiro), o que fica quadrático com milhares de células. Aqui os comandos
+    # são acumulados em listas e unidos uma única vez.
+    def _beginpage(self, *args, **kwargs):
+        super()._beginpage(*args, **kwargs)
+        self._comandos_pagina = []
+
+    def _out(self, s):
+        if self.state != 2:
+            return super()._out(s)
+        if isinstance(s, bytes):
+            s = s.decode('latin-1')
+        self._comandos_pagina.append(f'{s}\n')
+
+    def _endpage(self):
+        self.pages[self.page] += ''.join(self._comandos_pagina)
+        self._comandos_pagina = []
+        super()._endpage()
+
+    def _enddoc(self):
+        self.buffer = _Buffer()
+        super()._enddoc()
+        self.buffer = ''.join(self.buffer.partes)
+
+    def _registrar_logo(self):
+        # O FPDF decodifica a imagem no primeiro uso de cada documento; aqui o
+        # resultado é guardado no módulo e injetado nos documentos seguintes
+        global _logo_info
+        if LOGO not in self.images:
+            if _logo_info is None:
+                _logo_info = self._parsejpg(LOGO)
+            self.images[LOGO] = dict(_logo_info, i=len(self.images) + 1)
+
+    def header(self):
+        # Verifica se o arquivo existe para não dar erro se faltar a imagem
+        if os.path.exists(LOGO):
+            self._registrar_logo()
+            # Logo Esquerda
+            self.image(LOGO, 10, 8, 30)
+            # Logo Direita
+            self.image(LOGO, 255, 8, 30)
+
+        self.set_font('Helvetica', 'B', 14)
+        self.cell(0, 10, 'Relatorio de Controle de Estoque - Arauco', 0, 1, 'C')
+        self.set_font('Helvetica', 'I', 10)
+        self.cell(0, 5, f'Gerado em: {datetime.now().strftime("%d/%m/%Y %H:%M")}', 0, 1, 'C')
+        self.ln(15)
+
+    def footer(self):
+        self.set_y(-15)
+        self.set_font('Helvetica', 'I', 8)
+        self.cell(0, 10, f'Pagina {self.page_no()}', 0, 0, 'C')
+
+
+def _texto_latin1(serie):
+    # As fontes padrão do PDF só cobrem latin-1
+    return serie.astype(str).str.encode('latin-1', 'replace').str.decode('latin-1').to_numpy()
+
+
+def _formatar(valores, formato):
+    return np.char.mod(formato, valores.to_numpy(dtype=float))
+
+
+def formatar_linhas(df_dados):
+    # Formata todas as células da tabela de uma vez (colunas inteiras), em vez
+    # de linha a linha
+    com_ticket = df_dados['Peso_Tickets_Ton'].to_numpy(dtype=float) > 0
+    colunas = [
+        df_dados['Data'].dt.strftime('%d/%m/%Y').to_numpy(dtype=str),
+        _texto_latin1(df_dados['Pilha_ID']),
+        _texto_latin1(df_dados['Tipo_Madeira']),
+        _formatar(df_dados['Volume_Drone_Estereo'], '%.0f'),
+        _formatar(df_dados['Densidade_Aplicada'], '%.0f'),
+        _formatar(df_dados['Peso_Teorico_Ton'], '%.0f'),
+        np.where(com_ticket, _formatar(df_dados['Peso_Tickets_Ton'], '%.0f'), '-'),
+        np.where(com_ticket, _formatar(df_dados['Erro_Percentual'], '%+.1f%%'), '-'),
+        _formatar(df_dados['Var_Anterior_Pct'], '%.1f%%'),
+    ]
+    return zip(*(c.tolist() for c in colunas))
+
+
+def _gravar_em_blocos(pdf, arquivo):
+    # Grava o documento em blocos, sem montar uma cópia inteira em bytes
+    if pdf.state < 3:
+        pdf.close()
+    buffer = pdf.buffer
+    for inicio in range(0, len(buffer), TAMANHO_BLOCO):
+        arquivo.write(buffer[inicio:inicio + TAMANHO_BLOCO].encode('latin-1', 'replace'))
+
+
+def criar_pdf(df_dados, destino=None, progresso=None):
+    # Sem `destino` devolve os bytes do PDF; com um arquivo binário aberto,
+    # grava nele e o devolve. `progresso(fracao)` é chamado durante a tabela.
+    pdf = PDFReport(orientation='L', unit='mm', format='A4')
+    pdf.add_page()
+
+    # 1. Sumário
+    pdf.set_font('Helvetica', 'B', 12)
+    pdf.cell(0, 10, '1. Resumo Executivo', 0, 1, 'L')
+
+    total_vol = df_dados['Volume_Drone_Estereo'].sum()
+    total_peso = df_dados['Peso_Teorico_Ton'].sum()
+
+    df_pinus = df_dados[(df_dados['Tipo_Madeira'] == 'Pinus') & (df_dados['Peso_Tickets_Ton'] > 0)]
+    df_euca = df_dados[(df_dados['Tipo_Madeira'] == 'Eucalipto') & (df_dados['Peso_Tickets_Ton'] > 0)]
+
+    erro_pinus = df_pinus['Erro_Percentual'].abs().mean() if not df_pinus.empty else 0
+    erro_euca = df_euca['Erro_Percentual'].abs().mean() if not df_euca.empty else 0
+
+    pdf.set_font('Helvetica', '', 10)
+    pdf.cell(80, 8, f"Volume Total: {total_vol:,.0f} m3", 0, 0)
+    pdf.cell(80, 8, f"Estoque Total: {total_peso:,.0f} Ton", 0, 1)
+
+    pdf.set_text_color(34, 139, 34)
+    pdf.cell(80, 8, f"Erro Medio PINUS: {erro_pinus:.2f}%", 0, 0)
+    pdf.set_text_color(0, 0, 139)
+    pdf.cell(80, 8, f"Erro Medio EUCALIPTO: {erro_euca:.2f}%", 0, 1)
+
+    pdf.set_text_color(0, 0, 0)
+    pdf.ln(5)
+
+    # 2. Tabela
+    pdf.set_font('Helvetica', 'B', 12)
+    pdf.cell(0, 10, '2. Detalhamento', 0, 1, 'L')
+
+    widths = [25, 25, 25, 30, 20, 30, 30, 25, 25]
+    headers = ['Data', 'Pilha', 'Tipo', 'Vol (m3)', 'Dens', 'Est.(t)', 'Real(t)', 'Erro %', 'Var %']
+
+    pdf.set_font('Helvetica', 'B', 9)
+    pdf.set_fill_color(230, 230, 230)
+
+    for i, h in enumerate(headers):
+        pdf.cell(widths[i], 8, h, 1, 0, 'C', True)
+    pdf.ln()
+
+    pdf.set_font('Helvetica', '', 9)
+    celula = pdf.cell
+    total = max(len(df_dados), 1)
+    for n, data_row in enumerate(formatar_linhas(df_dados), 1):
+        for largura, datum in zip(widths, data_row):
+            celula(largura, 7, datum, 1, 0, 'C')
+        pdf.ln()
+        if progresso is not None and n % PASSO_PROGRESSO == 0:
+            progresso(n / total)
+
+    if destino is None:
+        return pdf.output(dest='S').encode('latin-1', 'replace')
+    _gravar_em_blocos(pdf, destino)
+    return destino
+
+
+def criar_csv(df_dados, destino):
+    df_dados.to_csv(destino, index=False, encoding='utf-8')
+    return destino
+
+
+# ==============================================================================
+# GERAÇÃO EM SEGUNDO PLANO
+# ==============================================================================
+# Os relatórios só são gerados quando pedidos, em threads fora da execução do
+# Streamlit. Cada tarefa é identificada pelo hash das linhas selecionadas: a
+# mesma seleção nunca é renderizada duas vezes enquanto estiver no cache. O
+# pool e a pasta dos arquivos só são criados no primeiro pedido (importar o
+# módulo para usar criar_pdf/criar_csv não cria nada) e são encerrados e
+# apagados na saída do processo.
+
+MAX_TAREFAS = 16
+
+_executor = None
+_diretorio = None
+_tarefas = OrderedDict()
+_trava_tarefas = threading.Lock()
+_numeracao = itertools.count()
+
+_GERADORES = {
+    'pdf': criar_pdf,
+    'csv': lambda df, destino, progresso: criar_csv(df, destino),
+}
+
+
+class TarefaRelatorio:
+    def __init__(self, chave, formato, numero):
+        self.chave = chave
+        self.formato = formato
+        # Nome único por tarefa: um pedido refeito para a mesma seleção não
+        # reaproveita o arquivo de uma tarefa anterior ainda em uso
+        self.arquivo = os.path.join(_diretorio, f'{chave}_{numero}.{formato}')
+        self.progresso = 0.0
+        self.future = None
+        # O arquivo só é apagado quando nenhuma sessão guarda mais a tarefa
+        # (sair do cache não basta: quem a obteve ainda pode abri-lo)
+        weakref.finalize(self, _remover, self.arquivo)
+
+    @property
+    def concluida(self):
+        return self.future.done()
+
+    @property
+    def erro(self):
+        return self.future.exception() if self.concluida else None
+
+    def _executar(self, df_dados, nivel=None):
+        # Grava em arquivo temporário e só então publica o nome final. Medido
+        # como uma execução à parte, no nível da sessão que pediu.
+        temporario = self.arquivo + '.tmp'
+        try:
+            with execucao(f'relatorio_{self.formato}', nivel), etapa(f'criar_{self.formato}'):
+                with open(temporario, 'wb') as destino:
+                    _GERADORES[self.formato](df_dados, destino, progresso=self._atualizar)
+            os.replace(temporario, self.arquivo)
+        except BaseException:
+            _remover(temporario)
+            raise
+        self.progresso = 1.0
+
+    def _atualizar(self, fracao):
+        self.progresso = fracao
+
+
+def _remover(arquivo):
+    try:
+        os.remove(arquivo)
+    except OSError:
+        pass
+
+
+def chave_selecao(df_dados, formato):
+    h = hashlib.sha1(pd.util.hash_pandas_object(df_dados, index=True).to_numpy().tobytes())
+    h.update(','.join(map(str, df_dados.columns)).encode())
+    return f'{formato}_{h.hexdigest()[:20]}'
+
+
+def obter_tarefa(df_dados, formato):
+    # Tarefa já pedida para esta seleção, ou None (não inicia nada)
+    chave = chave_selecao(df_dados, formato)
+    with _trava_tarefas:
+        tarefa = _tarefas.get(chave)
+        if tarefa is not None:
+            _tarefas.move_to_end(chave)
+        return tarefa
+
+
+def _iniciar():
+    # Chamada com _trava_tarefas
+    global _executor, _diretorio
+    if _executor is None:
+        _diretorio = tempfile.mkdtemp(prefix='relatorios_arauco_')
+        _executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='relatorio')
+        atexit.register(_encerrar)
+    return _executor
+
+
+def _encerrar():
+    # Descarta os pedidos na fila, espera os que estão rodando e apaga os arquivos
+    _executor.shutdown(wait=True, cancel_futures=True)
+    shutil.rmtree(_diretorio, ignore_errors=True)
+
+
+def solicitar_relatorio(df_dados, formato):
+    chave = chave_selecao(df_dados, formato)
+    with _trava_tarefas:
+        tarefa = _tarefas.get(chave)
+        if tarefa is None or tarefa.erro is not None:
+            executor = _iniciar()
+            tarefa = TarefaRelatorio(chave, formato, next(_numeracao))
+            tarefa.future = executor.submit(tarefa._executar, df_dados, nivel_atual())
+            _tarefas[chave] = tarefa
+            _descartar_antigas()
+        _tarefas.move_to_end(chave)
+        return tarefa
+
+
+def _descartar_antigas():
+    # Remove do cache as tarefas concluídas mais antigas além do limite; o
+    # arquivo de cada uma sai quando ela deixa de ser referenciada
+    for chave in list(_tarefas):
+        if len(_tarefas) <= MAX_TAREFAS:
+            break
+        if _tarefas[chave].concluida:
+            del _tarefas[chave]
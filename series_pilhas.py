@@ -0,0 +1,212 @@
+import threading
+import weakref
+
+import numpy as np
+import pandas as pd
+
+from calculos import codigos_especie, peso_teorico, tabela_densidade
+from parametros import ESPECIES
+
+# ==============================================================================
+# SÉRIES TEMPORAIS POR PILHA
+# ==============================================================================
+# O histórico é reordenado por (pilha, data, id) em arrays contíguos: a série
+# de uma pilha é uma fatia [limites[p], limites[p + 1]) e qualquer consulta por
+# pilha e data é uma busca binária numa chave única (código da pilha x dias),
+# em O(log n). A mesma chave resolve "última leitura até a data" de todas as
+# pilhas de uma vez.
+
+# Mínimo de leituras com ticket para ajustar a tendência do fator real
+MIN_TICKETS_TENDENCIA = 3
+# A tendência extrapolada fica limitada a esta faixa em torno do fator médio
+LIMITE_TENDENCIA = (0.5, 1.5)
+
+_trava = threading.Lock()
+# Por DataFrame (id do objeto); a entrada sai quando o DataFrame é coletado
+_em_cache = {}
+
+
+def _dias(datas):
+    # Dias desde 1970-01-01 (escalar ou array)
+    if np.ndim(datas) == 0:
+        return pd.Timestamp(datas).to_datetime64().astype('datetime64[D]').astype('int64')
+    return np.asarray(pd.to_datetime(datas), dtype='datetime64[D]').astype('int64')
+
+
+class SeriesPilhas:
+    def __init__(self, df):
+        pilhas = df['Pilha_ID'].astype('category').cat
+        nomes = pilhas.categories.astype(str).to_numpy()
+        ordem_nomes = np.argsort(nomes, kind='stable')
+        posto = np.empty(len(nomes), dtype='int64')
+        posto[ordem_nomes] = np.arange(len(nomes))
+        codigos = posto[pilhas.codes.to_numpy()]
+        dias = df['Data'].to_numpy(dtype='datetime64[D]').astype('int64')
+        ids = df.index.to_numpy()
+        ordem = np.lexsort((ids, dias, codigos))
+
+        self.pilhas = nomes[ordem_nomes]
+        self.codigos = codigos[ordem]
+        self.dias = dias[ordem]
+        self.ids = ids[ordem]
+        self.limites = np.searchsorted(self.codigos, np.arange(len(self.pilhas) + 1))
+
+        # Chave ordenada: código da pilha x largura + dias desde o primeiro dia
+        self._dia_base = int(dias.min()) if len(dias) else 0
+        self._largura = (int(dias.max()) - self._dia_base + 2) if len(dias) else 2
+        self.chaves = self.codigos * self._largura + (self.dias - self._dia_base)
+
+        colunas = lambda c: df[c].to_numpy(dtype=float)[ordem]  # noqa: E731
+        self.volume = colunas('Volume_Drone_Estereo')
+        self.peso = colunas('Peso_Teorico_Ton')
+        self.tickets = colunas('Peso_Tickets_Ton')
+        self.fator_real = colunas('Fator_Conversao_Real')
+        self.densidade = colunas('Densidade_Aplicada')
+        self.fator_teorico = colunas('Fator_Teorico')
+        self.especies = np.asarray(codigos_especie(df['Tipo_Madeira']))[ordem]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _chave(self, codigo, dia):
+        # Dias fora do histórico são presos às bordas, para não invadir a
+        # faixa de chaves da pilha vizinha
+        return codigo * self._largura + np.clip(dia - self._dia_base, -1, self._largura - 1)
+
+    def codigo(self, pilha):
+        p = np.searchsorted(self.pilhas, pilha)
+        if p == len(self.pilhas) or self.pilhas[p] != pilha:
+            raise KeyError(pilha)
+        return p
+
+    def intervalo(self, pilha, data_inicio=None, data_fim=None):
+        # Posições [início, fim) das leituras da pilha no período
+        p = self.codigo(pilha)
+        inicio, fim = self.limites[p], self.limites[p + 1]
+        if data_inicio is not None:
+            inicio = np.searchsorted(self.chaves, self._chave(p, _dias(data_inicio)), 'left')
+        if data_fim is not None:
+            fim = np.searchsorted(self.chaves, self._chave(p, _dias(data_fim)), 'right')
+        return int(inicio), int(max(inicio, fim))
+
+    def serie(self, pilha, data_inicio=None, data_fim=None):
+        inicio, fim = self.intervalo(pilha, data_inicio, data_fim)
+        fatia = slice(inicio, fim)
+        return pd.DataFrame({
+            'Data': self.dias[fatia].astype('datetime64[D]').astype('datetime64[ns]'),
+            'Volume_Drone_Estereo': self.volume[fatia],
+            'Peso_Teorico_Ton': self.peso[fatia],
+            'Peso_Tickets_Ton': self.tickets[fatia],
+            'Fator_Conversao_Real': self.fator_real[fatia],
+        }, index=pd.Index(self.ids[fatia], name='id'))
+
+    def ultimas(self, data=None):
+        # Posição da última leitura de cada pilha até `data` (-1 se nenhuma)
+        codigos = np.arange(len(self.pilhas))
+        if data is None:
+            posicoes = self.limites[1:] - 1
+        else:
+            posicoes = np.searchsorted(self.chaves, self._chave(codigos, _dias(data)), 'right') - 1
+        return np.where(posicoes >= self.limites[:-1], posicoes, -1)
+
+
+def series_pilhas(df):
+    # Um por histórico em memória, como o de consultas.indice_medicoes
+    with _trava:
+        series = _em_cache.get(id(df))
+        if series is None:
+            series = _em_cache[id(df)] = SeriesPilhas(df)
+            weakref.finalize(df, _em_cache.pop, id(df), None)
+        return series
+
+
+# ==============================================================================
+# PROJEÇÃO DO ESTOQUE
+# ==============================================================================
+# Para cada pilha, a partir da última leitura (volume constante):
+#  - densidade: a aplicada na última leitura segue a tendência sazonal de
+#    secagem de DENSIDADE_MENSAL (razão entre o mês alvo e o da leitura);
+#  - fator real: reta ajustada por mínimos quadrados às leituras com ticket
+#    da pilha (somas por pilha com bincount, todas as pilhas de uma vez) e
+#    extrapolada até a data alvo.
+# Com tendência (MIN_TICKETS_TENDENCIA leituras com ticket) o peso projetado
+# é volume x fator real projetado; com menos tickets, o fator médio corrigido
+# pela secagem; sem tickets, o peso teórico com a densidade projetada.
+
+def _projetar(series, dias_alvo, data_base=None):
+    posicoes = series.ultimas(data_base)
+    validas = np.flatnonzero(posicoes >= 0)
+    pos = posicoes[validas]
+    dia_ultimo = series.dias[pos]
+    especies = series.especies[pos]
+    meses_alvo = dias_alvo.astype('datetime64[D]').astype('datetime64[M]').astype(int) % 12
+    mes_ultimo = dia_ultimo.astype('datetime64[D]').astype('datetime64[M]').astype(int) % 12
+
+    # Secagem: razão da densidade de tabela entre o mês alvo e o da leitura [P, H]
+    tabela = tabela_densidade()
+    conhecida = especies >= 0
+    e = np.where(conhecida, especies, 0)
+    razao = tabela[meses_alvo[None, :], e[:, None]] / tabela[mes_ultimo, e][:, None]
+    razao[~conhecida] = 1.0
+    densidade = series.densidade[pos][:, None] * razao
+    peso_densidade = peso_teorico(series.volume[pos][:, None], series.fator_teorico[pos][:, None], densidade)
+
+    # Tendência do fator real: x em dias relativos à última leitura da pilha
+    n_pilhas = len(series.pilhas)
+    com_ticket = series.fator_real > 0
+    if data_base is not None:
+        com_ticket &= series.dias <= _dias(data_base)
+    codigos = series.codigos[com_ticket]
+    dia_ref = np.zeros(n_pilhas, dtype='int64')
+    dia_ref[validas] = dia_ultimo
+    x = (series.dias[com_ticket] - dia_ref[codigos]).astype(float)
+    y = series.fator_real[com_ticket]
+    somas = lambda pesos: np.bincount(codigos, pesos, minlength=n_pilhas)[validas]  # noqa: E731
+    n, sx, sy, sxx, sxy = somas(None), somas(x), somas(y), somas(x * x), somas(x * y)
+    denominador = n * sxx - sx * sx
+    with np.errstate(divide='ignore', invalid='ignore'):
+        media = np.where(n > 0, sy / n, np.nan)
+        tendencia = np.where((n >= MIN_TICKETS_TENDENCIA) & (denominador > 0),
+                             (n * sxy - sx * sy) / denominador, 0.0)
+        intercepto = np.where(n > 0, (sy - tendencia * sx) / n, np.nan)
+    horizonte = (dias_alvo[None, :] - dia_ultimo[:, None]).astype(float)
+    fator = np.clip(intercepto[:, None] + tendencia[:, None] * horizonte,
+                    LIMITE_TENDENCIA[0] * media[:, None], LIMITE_TENDENCIA[1] * media[:, None])
+
+    volume = series.volume[pos][:, None]
+    metodo = np.select([n >= MIN_TICKETS_TENDENCIA, n > 0], ['tendencia_fator', 'fator_medio'], 'densidade')
+    peso = np.select([(n >= MIN_TICKETS_TENDENCIA)[:, None], (n > 0)[:, None]],
+                     [volume * fator, volume * media[:, None] * razao], peso_densidade)
+    return {
+        'validas': validas, 'pos': pos, 'metodo': metodo, 'n_tickets': n, 'tendencia': tendencia,
+        'densidade': densidade, 'fator': np.where((n > 0)[:, None], fator, np.nan), 'peso': peso,
+    }
+
+
+def prever_estoque(series, data_alvo, data_base=None):
+    # Projeção de cada pilha na data alvo, a partir das leituras até data_base
+    dias_alvo = np.atleast_1d(_dias(data_alvo))
+    projecao = _projetar(series, dias_alvo, data_base)
+    pos = projecao['pos']
+    especies = np.asarray(ESPECIES + ['?'], dtype=object)[series.especies[pos]]
+    return pd.DataFrame({
+        'Tipo_Madeira': especies,
+        'Ultima_Leitura': series.dias[pos].astype('datetime64[D]').astype('datetime64[ns]'),
+        'Volume_Drone_Estereo': series.volume[pos],
+        'Peso_Atual_Ton': series.peso[pos],
+        'Densidade_Projetada': projecao['densidade'][:, 0],
+        'Fator_Real_Projetado': projecao['fator'][:, 0],
+        'Tendencia_Fator_Dia': projecao['tendencia'],
+        'Leituras_Com_Ticket': projecao['n_tickets'].astype(int),
+        'Peso_Projetado_Ton': projecao['peso'][:, 0],
+        'Metodo': projecao['metodo'],
+    }, index=pd.Index(series.pilhas[projecao['validas']], name='Pilha_ID'))
+
+
+def projecao_estoque(series, datas_alvo, data_base=None):
+    # Estoque projetado (t) por espécie em cada data: [datas x espécies]
+    dias_alvo = _dias(datas_alvo)
+    projecao = _projetar(series, dias_alvo, data_base)
+    especies = series.especies[projecao['pos']]
+    colunas = {e: projecao['peso'][especies == i].sum(axis=0) for i, e in enumerate(ESPECIES)}
+    return pd.DataFrame(colunas, index=pd.DatetimeIndex(dias_alvo.astype('datetime64[D]'), name='Data'))
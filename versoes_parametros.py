@@ -0,0 +1,261 @@
+import argparse
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from armazenamento import (COLUNAS_VARIACAO, DB_FILE, SCHEMA, ConflitoVersao, MesArquivado, ancoras_arquivadas,
+                           atualizar_medicoes, calcular_variacoes, conectar, corte_arquivo, escritor_exclusivo,
+                           load_data, periodo_aberto, transacao_escrita, variacoes_mudaram, versao_dados)
+from calculos import calcular, codigos_especie
+from parametros import ESPECIES
+from particoes import listar_particoes
+
+# ==============================================================================
+# PARÂMETROS DE ENGENHARIA VERSIONADOS
+# ==============================================================================
+# Cada versão é um conjunto completo de densidades mensais e fatores de
+# empilhamento com uma data de vigência. Uma medição usa a versão mais recente
+# cuja vigência seja anterior ou igual à sua data, e grava o número dessa versão
+# em Versao_Parametros. Ao publicar uma revisão, `recalcular_historico`
+# re-deriva de uma só vez todas as linhas afetadas. Meses arquivados
+# (particoes.py) não são recalculados: uma versão só pode entrar em vigor a
+# partir do corte do arquivo.
+#
+# Uso pela linha de comando:
+#   python versoes_parametros.py listar
+#   python versoes_parametros.py nova --vigencia 2024-01-01 --densidades tabela.csv --fator Pinus=0.66 --recalcular
+#   python versoes_parametros.py recalcular
+
+# Quantas vezes o recálculo é refeito se outra gravação alterar o histórico
+# entre a leitura e a gravação
+TENTATIVAS_RECALCULO = 3
+
+COLUNAS_RECALCULADAS = [
+    'Densidade_Aplicada', 'Fator_Teorico', 'Peso_Teorico_Ton',
+    'Fator_Conversao_Real', 'Erro_Ton', 'Erro_Percentual', 'Versao_Parametros'
+]
+COLUNAS_FLOAT32 = [c for c in COLUNAS_RECALCULADAS if SCHEMA[c] == 'float32']
+
+
+class TabelaParametros:
+    # Todas as versões em arrays, ordenadas por vigência:
+    # densidades[versão, mês - 1, espécie] e fatores[versão, espécie]
+    def __init__(self, versoes, vigencias, densidades, fatores):
+        self.versoes = versoes
+        self.vigencias = vigencias
+        self.densidades = densidades
+        self.fatores = fatores
+
+    def indices(self, datas):
+        datas = pd.to_datetime(pd.Series(datas)).to_numpy(dtype='datetime64[ns]')
+        return np.searchsorted(self.vigencias, datas, side='right') - 1
+
+    def aplicar(self, datas, especies):
+        # (versão, densidade padrão, fator) de cada medição, em uma passada
+        i = self.indices(datas)
+        meses = pd.DatetimeIndex(pd.to_datetime(pd.Series(datas))).month.to_numpy()
+        codigo = codigos_especie(especies)
+        conhecida = codigo >= 0
+        codigo = np.where(conhecida, codigo, 0)
+        densidade = np.where(conhecida, self.densidades[i, meses - 1, codigo], np.nan)
+        fator = np.where(conhecida, self.fatores[i, codigo], np.nan)
+        return self.versoes[i], densidade, fator
+
+    def vigente(self, data):
+        # (versão, {mês: {espécie: densidade}}, {espécie: fator}) para uma data
+        i = self.indices([data])[0]
+        densidades = {mes: {e: float(self.densidades[i, mes - 1, j]) for j, e in enumerate(ESPECIES)}
+                      for mes in range(1, 13)}
+        fatores = {e: float(self.fatores[i, j]) for j, e in enumerate(ESPECIES)}
+        return int(self.versoes[i]), densidades, fatores
+
+
+def carregar_tabela(caminho=DB_FILE):
+    with conectar(caminho) as con:
+        return _ler_tabela(con)
+
+
+def _ler_tabela(con):
+    versoes = pd.read_sql_query('SELECT versao, vigencia FROM parametros_versoes ORDER BY vigencia, versao', con)
+    valores = pd.read_sql_query('SELECT versao, mes, especie, densidade, fator FROM parametros_valores', con)
+
+    posicao = pd.Series(np.arange(len(versoes)), index=versoes['versao'])
+    v = posicao.loc[valores['versao']].to_numpy()
+    e = codigos_especie(valores['especie'].to_numpy())
+    densidades = np.full((len(versoes), 12, len(ESPECIES)), np.nan)
+    fatores = np.full((len(versoes), len(ESPECIES)), np.nan)
+    densidades[v, valores['mes'].to_numpy() - 1, e] = valores['densidade'].to_numpy()
+    fatores[v, e] = valores['fator'].to_numpy()
+
+    vigencias = pd.to_datetime(versoes['vigencia']).to_numpy(dtype='datetime64[ns]')
+    return TabelaParametros(versoes['versao'].to_numpy(), vigencias, densidades, fatores)
+
+
+def listar_versoes(caminho=DB_FILE):
+    with conectar(caminho) as con:
+        return pd.read_sql_query('SELECT * FROM parametros_versoes ORDER BY vigencia, versao', con)
+
+
+def criar_versao(vigencia, densidades=None, fatores=None, descricao='', caminho=DB_FILE):
+    # Nova versão a partir da vigente na data de vigência, sobrescrevendo só os
+    # valores informados: densidades {mês: {espécie: kg/m³}}, fatores {espécie: F_e}
+    # A base é lida dentro da transação: duas revisões simultâneas não partem
+    # da mesma versão sem ver uma à outra
+    with transacao_escrita(caminho) as con:
+        corte = corte_arquivo(con)
+        if corte and pd.Timestamp(vigencia) < pd.Timestamp(corte):
+            raise MesArquivado(f'Vigência {pd.Timestamp(vigencia):%d/%m/%Y} anterior ao corte do arquivo '
+                               f'({pd.Timestamp(corte):%d/%m/%Y}): os meses arquivados não são recalculados.')
+        _, base_densidades, base_fatores = _ler_tabela(con).vigente(vigencia)
+        for mes, valores in (densidades or {}).items():
+            base_densidades[int(mes)].update(valores)
+        base_fatores.update(fatores or {})
+
+        versao = con.execute(
+            'INSERT INTO parametros_versoes (vigencia, descricao, criada_em) VALUES (?, ?, ?)',
+            (pd.Timestamp(vigencia).strftime('%Y-%m-%d'), descricao,
+             datetime.now().strftime('%Y-%m-%d %H:%M:%S'))).lastrowid
+        con.executemany(
+            'INSERT INTO parametros_valores VALUES (?, ?, ?, ?, ?)',
+            [(versao, mes, e, base_densidades[mes][e], base_fatores[e]) for mes in range(1, 13) for e in ESPECIES])
+    return versao
+
+
+def linhas_desatualizadas(df, tabela):
+    # Re-deriva as medições cuja versão (ou valores) não bate com a vigente.
+    # Densidades digitadas manualmente são mantidas; o fator sempre segue a versão.
+    versao, densidade, fator = tabela.aplicar(df['Data'], df['Tipo_Madeira'])
+    manual = df['Densidade_Manual'].to_numpy(dtype=bool)
+    densidade = np.where(manual, df['Densidade_Aplicada'].to_numpy(dtype=float), densidade)
+
+    desatualizada = ((versao != df['Versao_Parametros'].to_numpy())
+                     | ~np.isclose(densidade, df['Densidade_Aplicada'].to_numpy(dtype=float))
+                     | ~np.isclose(fator, df['Fator_Teorico'].to_numpy(dtype=float)))
+    desatualizada &= ~np.isnan(densidade)
+
+    novas = df.loc[desatualizada, ['Pilha_ID', 'Volume_Drone_Estereo', 'Peso_Tickets_Ton']].assign(
+        Densidade_Aplicada=densidade[desatualizada],
+        Fator_Teorico=fator[desatualizada],
+        Versao_Parametros=versao[desatualizada],
+    )
+    return novas.assign(**calcular(novas['Volume_Drone_Estereo'].to_numpy(), novas['Fator_Teorico'].to_numpy(),
+                                   novas['Densidade_Aplicada'].to_numpy(), novas['Peso_Tickets_Ton'].to_numpy()))
+
+
+def recalcular_historico(caminho=DB_FILE):
+    # Recalcula em lote todo o histórico afetado por revisões de parâmetros. Os
+    # valores são calculados fora da transação e gravados só se o banco ainda
+    # estiver na versão lida; senão o cálculo é refeito sobre os dados novos.
+    # A última tentativa bloqueia as inserções do processo enquanto calcula.
+    for _ in range(TENTATIVAS_RECALCULO - 1):
+        try:
+            return _recalcular(caminho)
+        except ConflitoVersao:
+            pass
+    with escritor_exclusivo():
+        return _recalcular(caminho)
+
+
+def _recalcular(caminho):
+    df = load_data(caminho)
+    if df.empty:
+        return 0
+    novas = linhas_desatualizadas(df, carregar_tabela(caminho))
+    if novas.empty:
+        return 0
+
+    # As variações são recalculadas em memória sobre o histórico inteiro e
+    # gravadas junto, no mesmo UPDATE, só onde mudaram. Meses arquivados ficam
+    # como estão; a última leitura arquivada de cada pilha serve de anterior.
+    peso = df['Peso_Teorico_Ton'].to_numpy(dtype=float).copy()
+    peso[df.index.get_indexer(novas.index)] = novas['Peso_Teorico_Ton'].to_numpy(dtype=float)
+    base = df[['Pilha_ID', 'Data']].assign(Peso_Teorico_Ton=peso)
+    with conectar(caminho) as con:
+        ancoras = ancoras_arquivadas(con)
+    if not ancoras.empty:
+        ancoras = ancoras.assign(Data=pd.to_datetime(ancoras['Data'], format='ISO8601'))
+        base = pd.concat([ancoras[base.columns], base.astype({'Pilha_ID': str})])
+    var_ton, var_pct = (v[len(ancoras):] for v in calcular_variacoes(base))
+    ids = novas.index.union(df.index[variacoes_mudaram(df, var_ton, var_pct)])
+
+    # Os valores gravados saem de `novas` (float64); nas linhas em que só as
+    # variações mudam, as colunas que o cache guarda em float32 são relidas
+    # do banco para não voltarem arredondadas
+    atualizacao = df.loc[ids, COLUNAS_RECALCULADAS].astype({c: 'float64' for c in COLUNAS_FLOAT32})
+    so_variacao = ids.difference(novas.index)
+    if len(so_variacao):
+        with conectar(caminho) as con:
+            gravadas = pd.read_sql_query(f'SELECT id, {", ".join(COLUNAS_FLOAT32)} FROM medicoes', con,
+                                         index_col='id').reindex(so_variacao)
+        if gravadas.isna().any().any():
+            raise ConflitoVersao('O histórico foi alterado durante o recálculo.')
+        atualizacao.loc[so_variacao, COLUNAS_FLOAT32] = gravadas.to_numpy()
+    atualizacao.loc[novas.index, COLUNAS_RECALCULADAS] = novas[COLUNAS_RECALCULADAS].astype(atualizacao.dtypes)
+    posicoes = df.index.get_indexer(ids)
+    atualizacao['Var_Anterior_Ton'] = var_ton[posicoes]
+    atualizacao['Var_Anterior_Pct'] = var_pct[posicoes]
+    atualizar_medicoes(atualizacao, COLUNAS_RECALCULADAS + COLUNAS_VARIACAO, caminho, versao_dados(df))
+    return len(novas)
+
+
+def _relatar_recalculo(caminho):
+    print(f'{recalcular_historico(caminho)} medições recalculadas.')
+    arquivadas = int(listar_particoes(caminho)['linhas'].sum())
+    if arquivadas:
+        print(f'{arquivadas} medições arquivadas (antes de {periodo_aberto(caminho):%m/%Y}) não foram recalculadas.')
+
+
+def _ler_densidades(arquivo):
+    # CSV no formato da tabela do manual: Mes, Pinus, Eucalipto
+    tabela = pd.read_csv(arquivo, sep=None, engine='python').set_index('Mes')
+    return {int(mes): {e: float(v) for e, v in linha.items() if e in ESPECIES and pd.notna(v)}
+            for mes, linha in tabela.iterrows()}
+
+
+def _fator(texto):
+    # --fator Especie=valor, com a espécie escrita como em ESPECIES
+    especie, separador, valor = texto.partition('=')
+    if especie not in ESPECIES:
+        raise argparse.ArgumentTypeError(f'espécie desconhecida em {texto!r} (use {", ".join(ESPECIES)})')
+    try:
+        valor = float(valor) if separador else None
+    except ValueError:
+        valor = None
+    if valor is None or not valor > 0:
+        raise argparse.ArgumentTypeError(f'use Especie=valor com valor positivo, não {texto!r}')
+    return especie, valor
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Versões dos parâmetros de engenharia')
+    parser.add_argument('--banco', default=DB_FILE)
+    sub = parser.add_subparsers(dest='comando', required=True)
+    sub.add_parser('listar')
+    sub.add_parser('recalcular')
+    nova = sub.add_parser('nova')
+    nova.add_argument('--vigencia', required=True, help='AAAA-MM-DD')
+    nova.add_argument('--descricao', default='')
+    nova.add_argument('--densidades', help='CSV com colunas Mes, Pinus, Eucalipto')
+    nova.add_argument('--fator', action='append', default=[], type=_fator, help='Especie=valor (pode repetir)')
+    nova.add_argument('--recalcular', action='store_true')
+    args = parser.parse_args(argv)
+
+    if args.comando == 'listar':
+        print(listar_versoes(args.banco).to_string(index=False))
+    elif args.comando == 'nova':
+        fatores = dict(args.fator)
+        densidades = _ler_densidades(args.densidades) if args.densidades else None
+        try:
+            versao = criar_versao(args.vigencia, densidades, fatores, args.descricao, args.banco)
+        except MesArquivado as e:
+            parser.error(str(e))
+        print(f'Versão {versao} criada.')
+        if args.recalcular:
+            _relatar_recalculo(args.banco)
+    else:
+        _relatar_recalculo(args.banco)
+
+
+if __name__ == '__main__':
+    main()